@@ -51,10 +51,22 @@ Distributed under the GNU GPL v3 or later.
 
 from _arv import (
     _sizes,
+    Cohort,
     Genome,
     Genotype,
+    iter_file,
+    iter_file_batches,
     load,
+    load_binary,
+    load_cohort,
+    load_many,
+    load_sharded,
+    load_shared,
+    load_stream,
+    loads,
+    ShardedGenome,
     SNP,
+    unlink_shared,
 )
 
 from .match import unphased_match
@@ -70,9 +82,21 @@ __version__ = "0.9.3"
 
 __all__ = [
     "_sizes",
+    "Cohort",
     "Genome",
     "Genotype",
+    "iter_file",
+    "iter_file_batches",
     "load",
+    "load_binary",
+    "load_cohort",
+    "load_many",
+    "load_sharded",
+    "load_shared",
+    "load_stream",
+    "loads",
+    "ShardedGenome",
     "SNP",
+    "unlink_shared",
     "unphased_match",
 ]
@@ -0,0 +1,435 @@
+"""
+Benchmarks arv on synthetic genomes.
+
+Run with ``python -m arv.bench``. It writes a synthetic 23andMe raw genome
+file, times parsing, random access, iteration, bulk lookups and reports on
+it, and prints the results as JSON with percentiles, so that they can be
+tracked over time without using anybody's real genome:
+
+    $ python -m arv.bench --snps 600000 --layout v5 --output results.json
+
+The synthetic files follow the layout of real ones, with the header,
+internal i-IDs, the X, Y and MT chromosomes, no-calls and, for newer
+layouts, insertions and deletions. The genotypes are random, except that the
+RSIDs used by ``arv.traits`` are always present, with genotypes that its rules
+match.
+
+Part of arv
+Copyright 2017 Christian Stigen Larsen
+Distributed under the GPL v3 or later. See COPYING.
+"""
+
+import argparse
+from arv.rules import Rule
+import arv
+import arv.traits
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+if sys.version_info[:2] >= (3, 3):
+    mark_time = time.perf_counter
+else:
+    mark_time = time.time
+
+# Chromosome lengths in GRCh37, which 23andMe positions refer to
+CHROMOSOMES = [
+    ("1", 249250621), ("2", 243199373), ("3", 198022430), ("4", 191154276),
+    ("5", 180915260), ("6", 171115067), ("7", 159138663), ("8", 146364022),
+    ("9", 141213431), ("10", 135534747), ("11", 135006516),
+    ("12", 133851895), ("13", 115169878), ("14", 107349540),
+    ("15", 102531392), ("16", 90354753), ("17", 81195210), ("18", 78077248),
+    ("19", 59128983), ("20", 63025520), ("21", 48129895), ("22", 51304566),
+    ("X", 155270560), ("Y", 59373566), ("MT", 16569),
+]
+
+# Share of the SNPs on the Y-chromosome and in mitochondrial DNA. The rest
+# are spread over the other chromosomes by length.
+Y_SHARE = 0.004
+MT_SHARE = 0.005
+
+# How the file layouts differ: line endings, share of internal i-IDs, share
+# of insertions and deletions, and the date in the header.
+LAYOUTS = {
+    "v3": {"newline": "\r\n", "internal": 0.02, "indels": 0.0,
+           "date": "Mon Jan 16 10:27:45 2012"},
+    "v4": {"newline": "\n", "internal": 0.05, "indels": 0.002,
+           "date": "Tue Mar 10 08:14:31 2015"},
+    "v5": {"newline": "\n", "internal": 0.03, "indels": 0.003,
+           "date": "Wed Mar 15 12:34:56 2017"},
+}
+
+HEADER = """\
+# This data file generated by 23andMe at: {date}
+#
+# Below is a text version of your data.  Fields are TAB-separated
+# Each line corresponds to a single SNP.  For each SNP, we provide its identifier
+# (an rsid or an internal id), its location on the reference human genome, and the
+# genotype call oriented with respect to the plus strand on the human reference sequence.
+# We are using reference human assembly build 37 (also known as Annotation Release 104).
+# Note that it is possible that data downloaded at different times may be different due to ongoing
+# improvements in our ability to call genotypes. More information about these changes can be found at:
+# https://www.23andme.com/you/download/revisions/
+#
+# More information on reference human assembly build 37 (aka Annotation Release 104):
+# http://www.ncbi.nlm.nih.gov/mapview/map_search.cgi?taxid=9606
+#
+# rsid\tchromosome\tposition\tgenotype
+"""
+
+# Pairs of alleles that SNPs usually have
+ALLELES = [("A", "G"), ("C", "T"), ("A", "C"), ("G", "T"), ("A", "T"),
+           ("C", "G")]
+
+# The RSIDs that reports look at, so that generating them does some work
+TRAIT_RSIDS = [
+    1051730, 10165485, 10936599, 11100479, 12913832, 1426654, 1535, 1667394,
+    174575, 17646946, 17822931, 1799884, 1799971, 1805007, 1815739, 1851665,
+    2736100, 2814778, 4481887, 4988235, 560887, 601338, 6113491, 6269,
+    6444175, 6625163, 671, 713598, 7193788, 755017, 762551, 7903146, 9420907,
+]
+
+NOCALL_SHARE = 0.01
+
+def _rule_genotypes():
+    """The genotypes matched by the rules in ``arv.traits``, by RSID."""
+    genotypes = {}
+    for value in vars(arv.traits).values():
+        if isinstance(value, Rule):
+            genotypes[value.rsid] = sorted(key for key in value.phenotypes if
+                    key is not None)
+    return genotypes
+
+def _counts(snps, male):
+    """Number of SNPs on each chromosome."""
+    small = {"Y": int(snps * Y_SHARE) if male else 0,
+             "MT": int(snps * MT_SHARE)}
+    rest = snps - sum(small.values())
+    total = sum(length for name, length in CHROMOSOMES if name not in small)
+
+    counts = []
+    for name, length in CHROMOSOMES:
+        if name in small:
+            counts.append((name, small[name]))
+        else:
+            counts.append((name, rest * length // total))
+
+    # Put what rounding left over on chromosome 1
+    name, count = counts[0]
+    counts[0] = (name, count + snps - sum(count for _, count in counts))
+    return counts
+
+def _genotype(rng, chromosome, male, indels):
+    """A random genotype for a SNP on the chromosome."""
+    r = rng.random()
+    if r < NOCALL_SHARE:
+        return "--"
+
+    single = chromosome in ("Y", "MT") or (chromosome == "X" and male)
+
+    if r < NOCALL_SHARE + indels:
+        return rng.choice(("D", "I")) if single else rng.choice(("DD", "DI",
+            "II"))
+
+    ref, alt = rng.choice(ALLELES)
+    if single:
+        return ref if rng.random() < 0.7 else alt
+
+    r = rng.random()
+    if r < 0.5:
+        return ref + ref
+    elif r < 0.8:
+        return ref + alt
+    else:
+        return alt + alt
+
+def generate(filename, snps=600000, layout="v5", male=True, seed=0):
+    """Writes a synthetic 23andMe raw genome file.
+
+    Arguments:
+        filename: Where to write it.
+
+        snps (optional): Number of SNPs. Default is 600000, about as many as
+                         in a real v4 or v5 file.
+
+        layout (optional): "v3", "v4" or "v5", the versions of 23andMe's
+                           chip. Default is "v5".
+
+        male (optional): Whether to include a Y-chromosome. Default is True.
+
+        seed (optional): Seed for the random generator. The same arguments
+                         always give the same file.
+
+    Returns:
+        The number of SNPs written.
+    """
+    if layout not in LAYOUTS:
+        raise ValueError("Unknown layout: %r" % layout)
+    if snps < len(TRAIT_RSIDS):
+        raise ValueError("Need at least %d SNPs" % len(TRAIT_RSIDS))
+
+    config = LAYOUTS[layout]
+    newline = config["newline"]
+    rng = random.Random(seed)
+    rules = _rule_genotypes()
+
+    # Unique IDs, with the trait RSIDs at random places on the autosomes,
+    # since the rules expect two alleles
+    counts = _counts(snps, male)
+    autosomal = sum(count for name, count in counts[:22])
+    internal = int(snps * config["internal"])
+    rsids = set(TRAIT_RSIDS)
+    while len(rsids) < snps - internal:
+        rsids.update(rng.sample(range(1, 1 << 30), snps - internal -
+            len(rsids)))
+    rsids.difference_update(TRAIT_RSIDS)
+    ids = ["rs%d" % rsid for rsid in sorted(rsids)]
+    ids.extend("i%d" % n for n in rng.sample(range(1000000, 7000000),
+        internal))
+    rng.shuffle(ids)
+    for rsid in TRAIT_RSIDS:
+        ids.insert(rng.randint(0, autosomal - 1), "rs%d" % rsid)
+
+    with open(filename, "wb") as f:
+        header = HEADER.format(date=config["date"]).replace("\n", newline)
+        f.write(header.encode("ascii"))
+
+        n = 0
+        for chromosome, count in counts:
+            length = dict(CHROMOSOMES)[chromosome]
+            positions = sorted(rng.sample(range(1, length), count))
+            lines = []
+            for position in positions:
+                if ids[n] in rules:
+                    genotype = rng.choice(rules[ids[n]])
+                else:
+                    genotype = _genotype(rng, chromosome, male,
+                            config["indels"])
+                lines.append("%s\t%s\t%d\t%s%s" % (ids[n], chromosome,
+                    position, genotype, newline))
+                n += 1
+            f.write("".join(lines).encode("ascii"))
+
+    return n
+
+def percentile(values, p):
+    """The p-th percentile of the values, interpolating between the closest
+    ranks."""
+    values = sorted(values)
+    if not values:
+        raise ValueError("No values")
+    k = (len(values) - 1) * p / 100.0
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+def summarize(seconds, operations):
+    """Statistics of the times of a benchmark, in seconds."""
+    median = percentile(seconds, 50)
+    return {
+        "runs": len(seconds),
+        "operations": operations,
+        "min": min(seconds),
+        "mean": sum(seconds) / len(seconds),
+        "p50": median,
+        "p90": percentile(seconds, 90),
+        "p99": percentile(seconds, 99),
+        "max": max(seconds),
+        "operations_per_second": operations / median if median > 0 else None,
+    }
+
+def measure(function, repeat):
+    """Runs the function repeat times, returning the time of each run. The
+    garbage collector is paused while timing, like timeit does."""
+    seconds = []
+    enabled = gc.isenabled()
+    try:
+        for n in range(repeat):
+            gc.collect()
+            gc.disable()
+            start = mark_time()
+            function()
+            seconds.append(mark_time() - start)
+            if enabled:
+                gc.enable()
+    finally:
+        if enabled:
+            gc.enable()
+    return seconds
+
+def _iterate(iterable):
+    count = 0
+    for item in iterable:
+        count += 1
+    return count
+
+def benchmarks(filename, lookups=10000, seed=0):
+    """The benchmarks for a genome file, as a list of tuples of (name,
+    function, operations per run)."""
+    genome = arv.load(filename, ethnicity="european")
+    keys = list(genome.keys())
+    rng = random.Random(seed)
+    sample = [rng.choice(keys) for n in range(lookups)]
+    size = len(genome)
+
+    def random_access():
+        for key in sample:
+            genome[key]
+
+    def bulk_lookup():
+        genome.lookup_many(sample)
+
+    result = [
+        ("parse", lambda: arv.load(filename), size),
+        ("parse_4_threads", lambda: arv.load(filename, threads=4), size),
+        ("random_access", random_access, len(sample)),
+        ("iterate_keys", lambda: _iterate(genome.keys()), size),
+        ("iterate_values", lambda: _iterate(genome.values()), size),
+        ("iterate_items", lambda: _iterate(genome.items()), size),
+        ("report", lambda: arv.traits.traits_report(genome), 1),
+    ]
+
+    try:
+        import numpy
+        result.insert(3, ("bulk_lookup", bulk_lookup, len(sample)))
+    except ImportError:
+        pass
+
+    return result
+
+def run(filename, repeat=10, names=None, lookups=10000, seed=0,
+        stream=None):
+    """Runs the benchmarks on a genome file and returns their statistics.
+
+    Arguments:
+        filename: Genome file.
+
+        repeat (optional): Times to run each benchmark.
+
+        names (optional): Names of the benchmarks to run. Default is all.
+
+        lookups (optional): Number of random RSIDs for the lookup benchmarks.
+
+        seed (optional): Seed for picking the random RSIDs.
+
+        stream (optional): If given, progress is written to it.
+
+    Returns:
+        A dict from benchmark name to a dict of statistics, see
+        ``summarize``.
+    """
+    results = {}
+    for name, function, operations in benchmarks(filename, lookups, seed):
+        if names is not None and name not in names:
+            continue
+        if stream is not None:
+            stream.write("%s ... " % name)
+            stream.flush()
+        results[name] = summarize(measure(function, repeat), operations)
+        if stream is not None:
+            stream.write("p50 %.4fs\n" % results[name]["p50"])
+            stream.flush()
+    return results
+
+def _environment():
+    return {
+        "arv": arv.__version__,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+    }
+
+def _parse_args(args=None):
+    p = argparse.ArgumentParser(prog="python -m arv.bench",
+            description="Benchmarks arv on a synthetic 23andMe genome file",
+            epilog=arv.__copyright__)
+
+    p.add_argument("--snps", default=600000, type=int,
+            help="Number of SNPs in the synthetic genome (default: 600000)")
+
+    p.add_argument("--layout", default="v5", choices=sorted(LAYOUTS),
+            help="23andMe file layout (default: v5)")
+
+    p.add_argument("--female", default=False, action="store_true",
+            help="Generate a genome without a Y-chromosome")
+
+    p.add_argument("--seed", default=0, type=int,
+            help="Random seed (default: 0)")
+
+    p.add_argument("--repeat", "-r", default=10, type=int,
+            help="Times to run each benchmark (default: 10)")
+
+    p.add_argument("--lookups", default=10000, type=int,
+            help="Random RSIDs to look up (default: 10000)")
+
+    p.add_argument("--benchmark", "-b", action="append", dest="names",
+            help="Benchmark to run, may be repeated (default: all)")
+
+    p.add_argument("--genome", default=None,
+            help="Benchmark this genome file instead of a synthetic one")
+
+    p.add_argument("--generate", default=None, metavar="FILENAME",
+            help="Only write the synthetic genome to the given file")
+
+    p.add_argument("--output", "-o", default="-",
+            help="Where to write the JSON results (default: stdout)")
+
+    opts = p.parse_args(args)
+
+    if opts.repeat < 1:
+        p.error("--repeat must be positive")
+
+    return opts
+
+def main(args=None):
+    opts = _parse_args(args)
+
+    if opts.generate is not None:
+        generate(opts.generate, opts.snps, opts.layout, not opts.female,
+                opts.seed)
+        return
+
+    tmpdir = None
+    try:
+        if opts.genome is not None:
+            filename = opts.genome
+            config = {"genome": os.path.basename(filename)}
+        else:
+            tmpdir = tempfile.mkdtemp()
+            filename = os.path.join(tmpdir, "genome.txt")
+            sys.stderr.write("Generating %d SNPs ... " % opts.snps)
+            sys.stderr.flush()
+            generate(filename, opts.snps, opts.layout, not opts.female,
+                    opts.seed)
+            sys.stderr.write("done\n")
+            config = {"snps": opts.snps, "layout": opts.layout, "male": not
+                    opts.female}
+
+        config.update({"repeat": opts.repeat, "lookups": opts.lookups,
+            "seed": opts.seed, "bytes": os.path.getsize(filename)})
+
+        results = run(filename, opts.repeat, opts.names, opts.lookups,
+                opts.seed, stream=sys.stderr)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    output = json.dumps({"environment": _environment(), "config": config,
+        "unit": "seconds", "results": results}, indent=2, sort_keys=True)
+
+    if opts.output == "-":
+        sys.stdout.write(output + "\n")
+    else:
+        with open(opts.output, "w") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+On-disk cache of parsed genomes.
+
+Parsed genomes are stored in arv's binary format in a cache directory, keyed
+by the size, modification time and inode of the original file, so a hit reads
+nothing but the cached entry. Loading a cached genome memory maps the binary
+file instead of parsing the text again. Genomes loaded through the cache are
+read-only, with "sorted" storage, whether they were cached or not.
+
+Files that may be rewritten in place with the same size and modification
+time can also be keyed by a checksum of their contents, which then reads the
+whole file on every load. Set ``ARV_CACHE_CHECKSUM`` or pass ``checksum=True``
+to ``arv.cache.load`` for this. Cached entries are then verified as well.
+
+The cache is used by ``arv.load`` when given a ``cache_dir`` or when the
+environment variable ``ARV_CACHE_DIR`` is set:
+
+    >>> genome = arv.load("genome.txt", cache_dir="/var/cache/arv")
+
+The cache directory is kept below ``ARV_CACHE_MAX_BYTES`` bytes (1 GiB by
+default) by evicting the least recently used entries.
+
+Part of arv
+Copyright 2017 Christian Stigen Larsen
+Distributed under the GPL v3 or later. See COPYING.
+"""
+
+import os
+import threading
+
+DEFAULT_MAX_BYTES = 1 << 30
+SUFFIX = ".arv"
+
+_lock = threading.Lock()
+_stats = {
+    "evictions": 0,
+    "hits": 0,
+    "misses": 0,
+    "store_errors": 0,
+    "stores": 0,
+}
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+def stats():
+    """Returns a dict with counters for cache hits, misses, stores, store
+    errors and evictions in this process."""
+    with _lock:
+        return dict(_stats)
+
+def reset_stats():
+    """Sets all counters to zero."""
+    with _lock:
+        for key in _stats:
+            _stats[key] = 0
+
+def max_bytes():
+    """The maximum size of the cache directory, from ARV_CACHE_MAX_BYTES."""
+    return int(os.getenv("ARV_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+
+def checksum_enabled():
+    """True if cache keys include a checksum of the file's contents, from
+    ARV_CACHE_CHECKSUM."""
+    return bool(os.getenv("ARV_CACHE_CHECKSUM"))
+
+def cache_key(filename, checksum=False):
+    """Returns the cache key for the given genome file.
+
+    The key is made up of the file's size, modification time, device and
+    inode, and a checksum of its contents if checksum is True.
+    """
+    st = os.stat(filename)
+    mtime = getattr(st, "st_mtime_ns", int(st.st_mtime * 1e9))
+    key = "%x-%x-%x-%x" % (st.st_size, mtime, st.st_dev, st.st_ino)
+    if checksum:
+        import _arv
+        key += "-%016x" % _arv._checksum_file(filename)
+    return key
+
+def entry_path(cache_dir, filename, checksum=False):
+    """Returns the path of the cache entry for the given genome file."""
+    return os.path.join(cache_dir, cache_key(filename, checksum) + SUFFIX)
+
+def _entries(cache_dir):
+    """Returns (last use, size, path) for each entry in the cache."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(SUFFIX):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue # removed by someone else
+        entries.append((st.st_mtime, st.st_size, path))
+    return entries
+
+def evict(cache_dir, limit=None):
+    """Removes the least recently used entries until the cache takes up at
+    most limit bytes. Returns the number of entries removed."""
+    if limit is None:
+        limit = max_bytes()
+
+    entries = sorted(_entries(cache_dir))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+
+    for _, size, path in entries:
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+            _count("evictions")
+        except OSError:
+            pass
+        total -= size
+
+    return removed
+
+def _store(genome, cache_dir, path):
+    """Atomically writes the genome to the cache, as ``Genome.save`` writes
+    to a temporary file that is renamed over the target."""
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    genome.save(path)
+
+def load(filename, cache_dir, name=None, ethnicity=None, orientation=1,
+        threads=1, checksum=None):
+    """Loads a genome file through the cache.
+
+    Uses the cached genome if there is one, otherwise parses the file and
+    stores it in the cache. Failing to write to the cache is not an error.
+    Either way, the genome is read-only with "sorted" storage. Set checksum
+    to key the cache on the file's contents too and verify cached entries,
+    which defaults to ``checksum_enabled()``. See ``arv.load`` for a
+    description of the other arguments.
+    """
+    import _arv
+
+    if checksum is None:
+        checksum = checksum_enabled()
+    path = entry_path(cache_dir, filename, checksum)
+
+    try:
+        genome = _arv.load_binary(path, verify=checksum)
+        _count("hits")
+        try:
+            os.utime(path, None) # mark as recently used
+        except OSError:
+            pass
+    except RuntimeError:
+        genome = None
+
+    if genome is None:
+        _count("misses")
+        genome = _arv.load(filename, threads=threads, cache_dir="")
+
+        try:
+            _store(genome, cache_dir, path)
+            _count("stores")
+            evict(cache_dir)
+        except (IOError, OSError, RuntimeError):
+            _count("store_errors")
+
+        # Like a cached genome, whether or not it could be stored
+        genome.convert_storage("sorted")
+
+    genome.name = name if name is not None else filename
+    genome.ethnicity = ethnicity if ethnicity is not None else ""
+    genome.orientation = orientation
+    return genome
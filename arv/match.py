@@ -8,6 +8,11 @@ Distributed under the GPL v3 or later. See COPYING.
 
 import arv
 
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
 def assert_european(genome):
     """If ethnicity is set, make sure it's European."""
     if genome.ethnicity not in [None, "european"]:
@@ -38,12 +43,11 @@ def unphased_match(snp, phenotypes):
         Matching phenotype. If the `phenotypes` dict has a `None` key, it will
         be returned in case there is no match.
     """
-    if isinstance(snp, str):
-        genotype = snp
-    elif isinstance(snp, arv.Genotype):
+    if isinstance(snp, (arv.Genotype, arv.SNP)):
+        # Shared, interned string, so this doesn't allocate
         genotype = str(snp)
-    elif isinstance(snp, arv.SNP):
-        genotype = str(snp.genotype)
+    elif isinstance(snp, _string_types):
+        genotype = snp
     else:
         raise TypeError(type(snp))
 
@@ -52,9 +56,10 @@ def unphased_match(snp, phenotypes):
         return phenotypes[genotype]
 
     # Look for "JI"
-    genotype = "".join(reversed(str(snp)))
-    if genotype in phenotypes:
-        return phenotypes[genotype]
+    if len(genotype) == 2 and genotype[0] != genotype[1]:
+        genotype = genotype[1] + genotype[0]
+        if genotype in phenotypes:
+            return phenotypes[genotype]
 
     # Use default value?
     if None in phenotypes:
@@ -0,0 +1,165 @@
+"""
+Declarative genotype rules, compiled to a native lookup program.
+
+A ``Rule`` maps the unphased genotype of a single RSID to a phenotype, just
+like a call to ``unphased_match``:
+
+    >>> rule = Rule("Lactose intolerance", "rs4988235", {
+    ...     "AA": "Likely lactose tolerant",
+    ...     "AG": "Likely lactose tolerant",
+    ...     "GG": "Likely lactose intolerant",
+    ...     None: "Unable to determine"})
+    >>> rule(genome)
+    'Likely lactose tolerant'
+
+``compile_rules`` turns a list of rules into a ``RuleSet`` that evaluates all
+of them for a genome in one native pass, by looking up each RSID and mapping
+its genotype code through a table to a phenotype. ``Report`` does the same for
+a mix of rules and ordinary trait functions, producing the same output as
+``arv.util.make_report``.
+
+Part of arv
+Copyright 2017 Christian Stigen Larsen
+Distributed under the GPL v3 or later. See COPYING.
+"""
+
+from arv.match import assert_european, unphased_match
+from arv.util import make_report, report_title
+import _arv
+
+NUCLEOTIDES = {"-": 0, "A": 1, "G": 2, "C": 3, "T": 4, "D": 5, "I": 6}
+
+# Genotype codes have six bits
+TABLE_SIZE = 64
+
+def genotype_code(genotype):
+    """Returns the code of a genotype string like "AG", "A" or "--", as in
+    ``Genotype.code``, or None if it is not a valid genotype."""
+    if not 1 <= len(genotype) <= 2:
+        return None
+    if genotype[-1] == "-" and genotype != "--":
+        return None # written as "A", never as "A-"
+    try:
+        first = NUCLEOTIDES[genotype[0]]
+        second = NUCLEOTIDES[genotype[1]] if len(genotype) == 2 else 0
+    except KeyError:
+        return None
+    return first << 3 | second
+
+class Rule(object):
+    """Maps the unphased genotype of an RSID to a phenotype.
+
+    Arguments:
+        title: Title of the rule in reports.
+        rsid: The RSID to look up.
+        phenotypes: Dict mapping genotype to phenotype, as for
+                    ``unphased_match``. The phenotype for the key None is used
+                    for genotypes without a match.
+        european (optional): Only applicable to Europeans, see
+                             ``assert_european``.
+
+    Calling a rule with a genome works like a trait function, raising KeyError
+    if the RSID or a matching genotype is missing.
+    """
+    def __init__(self, title, rsid, phenotypes, european=False):
+        self.title = title
+        self.rsid = rsid
+        self.phenotypes = dict(phenotypes)
+        self.european = european
+        self.__doc__ = "%s." % title
+
+    def __repr__(self):
+        return "<Rule: %r %s>" % (self.title, self.rsid)
+
+    def __call__(self, genome):
+        if self.european:
+            assert_european(genome)
+        return unphased_match(genome[self.rsid], self.phenotypes)
+
+    def table(self, phenotype_index):
+        """Returns the rule's lookup table, mapping each genotype code to a
+        phenotype index, or -1 for no match. The index of a phenotype is given
+        by the function phenotype_index."""
+        default = -1
+        if None in self.phenotypes:
+            default = phenotype_index(self.phenotypes[None])
+
+        table = [default] * TABLE_SIZE
+
+        # Exact matches take precedence over reversed ones
+        for reverse in (True, False):
+            for genotype, phenotype in self.phenotypes.items():
+                if genotype is None:
+                    continue
+                code = genotype_code(genotype[::-1] if reverse else genotype)
+                if code is not None:
+                    table[code] = phenotype_index(phenotype)
+
+        return table
+
+class RuleSet(object):
+    """Rules compiled to a native program. Create with ``compile_rules``."""
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.phenotypes = []
+        self.program = _arv.RuleProgram()
+
+        indices = {}
+        def phenotype_index(phenotype):
+            key = (type(phenotype), phenotype)
+            if key not in indices:
+                indices[key] = len(self.phenotypes)
+                self.phenotypes.append(phenotype)
+            return indices[key]
+
+        for rule in self.rules:
+            self.program.add(rule.rsid, rule.table(phenotype_index))
+
+    def __len__(self):
+        return len(self.rules)
+
+    def evaluate(self, genome):
+        """Returns a list with the phenotype for each rule, or None where the
+        RSID or a matching genotype is missing. Ethnicity is not checked."""
+        phenotypes = self.phenotypes
+        return [phenotypes[index] if index >= 0 else None for index in
+                self.program.evaluate(genome)]
+
+def compile_rules(rules):
+    """Compiles rules into a ``RuleSet``."""
+    return RuleSet(rules)
+
+class Report(object):
+    """A report made from trait functions and rules.
+
+    Calling it gives the same result as ``make_report`` with the same list,
+    but all the rules are evaluated together in one native pass.
+    """
+    def __init__(self, functions):
+        self.functions = list(functions)
+        self.rules = compile_rules(f for f in self.functions if
+                isinstance(f, Rule))
+
+    def __call__(self, genome, verbose=False):
+        results = iter(self.rules.evaluate(genome))
+        report = {}
+
+        for func in self.functions:
+            if not isinstance(func, Rule):
+                report.update(make_report(genome, [func], verbose))
+                continue
+
+            result = next(results)
+
+            if func.european:
+                try:
+                    assert_european(genome)
+                except ValueError as e:
+                    if verbose:
+                        report[report_title(func)] = "Error: %s" % e
+                    continue
+
+            if result is not None:
+                report[report_title(func)] = result
+
+        return report
@@ -10,11 +10,11 @@ Distributed under the GPL v3 or later. See COPYING.
 """
 
 from arv.match import unphased_match, assert_european
-from arv.util import make_report
+from arv.rules import Report, Rule
+import arv
+import multiprocessing
 
-def bitter_taste(genome):
-    "Bitter taste perception."
-    return unphased_match(genome["rs713598"], {
+bitter_taste = Rule("Bitter taste perception", "rs713598", {
         "CC": "Probably can't taste certain bitter flavours",
         "CG": "Can taste bitter flavours that others can't",
         "GG": "Can taste bitter flavours that others can't",
@@ -37,42 +37,31 @@ def breastfeeding_iq(genome):
 
     return s
 
-def alcohol_flush_reaction(genome):
-    "Alcohol flush reaction."
-    return unphased_match(genome["rs671"], {
+alcohol_flush_reaction = Rule("Alcohol flush reaction", "rs671", {
         "AA": "Extreme reaction (no copies of the ALDH2 gene)",
         "AG": "Moderate reaction (one copy of the ALDH2 gene)",
         "GG": "Little to no reaction (two copies of the ALDH2 gene)",
         None: "Unable to determine"})
 
-def earwax_type(genome):
-    "Earwax type."
-    return unphased_match(genome["rs17822931"], {
+earwax_type = Rule("Earwax type", "rs17822931", {
         "CC": "Wet earwax (sticky, honey-colored)",
         "CT": "Wet earwax (sticky, honey-colored)",
         "TT": "Dry earwax (flaky, pale)",
         None: "Unable to determine"})
 
-def eye_color(genome):
-    "Eye color."
-    assert_european(genome)
-    return unphased_match(genome["rs12913832"], {
+eye_color = Rule("Eye color", "rs12913832", {
         "AA": "Brown eyes, although 14% have green and 1% have blue",
         "AG": "Most likely brown or green, but 7% have blue",
         "GG": "Most likely blue, but 30% have green and 1% brown",
-        None: "Unable to determine"})
+        None: "Unable to determine"}, european=True)
 
-def lactose_intolerance(genome):
-    "Lactose intolerance."
-    return unphased_match(genome["rs4988235"], {
+lactose_intolerance = Rule("Lactose intolerance", "rs4988235", {
         "AA": "Likely lactose tolerant",
         "AG": "Likely lactose tolerant",
         "GG": "Likely lactose intolerant",
         None: "Unable to determine"})
 
-def malaria_resistance(genome):
-    "Malaria resistance (Duffy antigen)."
-    return unphased_match(genome["rs2814778"], {
+malaria_resistance = Rule("Malaria resistance (Duffy antigen)", "rs2814778", {
         "CC": "Likely resistant to P. vivax",
         "CT": "Likely to have some resistance to P. vivax",
         "TT": "Likely not resistant to P. vivax",
@@ -92,95 +81,70 @@ def male_pattern_baldness(genome):
     # rs6113491, A->C is risk mutation (AA has OR 1.77)
     # TODO: Attempt to match ORs
 
-def norovirus_resistance(genome):
-    """Norovirus resistance (most common strain)."""
-    return unphased_match(genome["rs601338"], {
+norovirus_resistance = Rule("Norovirus resistance (most common strain)",
+        "rs601338", {
         "AA": "Resistant to most common strain",
         "AG": "Likely not resistant to most common strain",
         "GG": "Likely not resistant to most common strain",
         None: "Unable to determine"})
 
-def muscle_performance(genome):
-    """Muscle performance."""
-    return unphased_match(genome["rs1815739"], {
+muscle_performance = Rule("Muscle performance", "rs1815739", {
         "CC": "Likely sprinter, perhaps endurance athlete (two copies)",
         "CT": "Likely sprinter, perhaps endurance athlete (one copy)",
         "TT": "Unlikely sprinter, but likely endurance athlete (no copies)",
         None: "Unable to determine"})
 
-def smoking_behaviour(genome):
-    """Smoking behaviour."""
-    assert_european(genome)
-    return unphased_match(genome["rs1051730"], {
+smoking_behaviour = Rule("Smoking behaviour", "rs1051730", {
         "AA": "Likely to smoke more than average",
         "AG": "Likely to smoke a little bit more than average",
         "GG": "Likely to smoke typical amount of cigarettes per day",
-        None: "Unable to determine"})
+        None: "Unable to determine"}, european=True)
 
-def red_hair(genome):
-    """Hair color; odds for red hair."""
-    return unphased_match(genome["rs1805007"], {
+red_hair = Rule("Hair color; odds for red hair", "rs1805007", {
         "CC": "Typical odds for red hair",
         "CT": "Substantially increased odds for red hair",
         "TT": "Greatly increased odds for red hair",
         None: "Unable to determine"})
 
-def blond_vs_brown_hair(genome):
-    """Hair color; blond versus brown."""
-    return unphased_match(genome["rs1667394"], {
+blond_vs_brown_hair = Rule("Hair color; blond versus brown", "rs1667394", {
         "CC": "Greatly decreased odds of having blond hair vs. brown",
         "CT": "Decreased odds of having blond hair vs. brown",
         "TT": "Typical odds of having blond hair vs. brown hair",
         None: "Unable to determine"})
 
-def pain_sensitivity(genome):
-    """Pain sensitivity."""
-    return unphased_match(genome["rs6269"], {
+pain_sensitivity = Rule("Pain sensitivity", "rs6269", {
         "AA": "Increased sensitivity to pain",
         "AG": "Typical sensitivity to pain",
         "GG": "Less sensitive to pain",
         None: "Unable to determine"})
 
-def caffeine_metabolism(genome):
-    """Caffeine metabolism."""
-    assert_european(genome)
-    return unphased_match(genome["rs762551"], {
+caffeine_metabolism = Rule("Caffeine metabolism", "rs762551", {
         "AA": "Fast metabolizer",
         "AC": "Slow metabolizer",
         "CC": "Slow metabolizer",
-        None: "Unable to determine"})
+        None: "Unable to determine"}, european=True)
 
-def heroin_addiction(genome):
-    """Heroin addiction."""
-    assert_european(genome)
-    return unphased_match(genome["rs1799971"], {
+heroin_addiction = Rule("Heroin addiction", "rs1799971", {
         "AA": "Typical odds of addiction",
         "AG": "Higher odds of addiction",
         "GG": "Higher odds of addiction",
-        None: "Unable to determine"})
+        None: "Unable to determine"}, european=True)
 
-def hair_curl(genome):
-    assert_european(genome)
-    return unphased_match(genome["rs17646946"], {
+hair_curl = Rule("Hair curl", "rs17646946", {
         "AA": "Straighter hair on average",
         "AG": "Straighter hair on average",
-        "GG": "Slightly curlier hair on average"})
+        "GG": "Slightly curlier hair on average"}, european=True)
 
-def hiv_aids_resistance(genome):
-    """Resistance to HIV/AIDS."""
-    return unphased_match(genome["i3003626"], {
+hiv_aids_resistance = Rule("Resistance to HIV/AIDS", "i3003626", {
         "DD": "Some resistance to most common strain of HIV",
         "DI": "Not resistant, but may have slower disease progression",
         "II": "Not resistant"})
 
-def aspargus_detection(genome):
-    """Aspargus metabolite detection."""
-    assert_european(genome)
-    return unphased_match(genome["rs4481887"], {
+aspargus_detection = Rule("Aspargus metabolite detection", "rs4481887", {
         "AA": "Higher odds of smelling aspargus in urine",
         "AG": "Medium odds of smelling aspargus in urine",
         "GG": "Typical odds of smelling aspargus in urine",
-        None: "Unable to determine"})
+        None: "Unable to determine"}, european=True)
 
 def adiponectin_levels(genome):
     """Adiponectin levels."""
@@ -243,39 +207,121 @@ def birth_weight(genome):
     return "From %.1fg to %.1fg (sum: %.1fg) compared to typical weight" % (
             min(weight), max(weight), sum(weight))
 
-def blood_glucose(genome):
-    """Blood glucose."""
-    assert_european(genome)
-    return unphased_match(genome["rs560887"], {
+blood_glucose = Rule("Blood glucose", "rs560887", {
         "CC": "Average fasting plasma glucose levels of 5.18mmol/L",
         "CT": "Average fasting plasma glucose levels of 5.12mmol/L",
         "TT": "Average fasting plasma glucose levels of 5.06mmol/L",
-        None: "Unable to determine"})
+        None: "Unable to determine"}, european=True)
+
+_traits_report = Report([
+    adiponectin_levels,
+    alcohol_flush_reaction,
+    aspargus_detection,
+    biological_age,
+    birth_weight,
+    bitter_taste,
+    blond_vs_brown_hair,
+    blood_glucose,
+    breastfeeding_iq,
+    caffeine_metabolism,
+    earwax_type,
+    eye_color,
+    hair_curl,
+    heroin_addiction,
+    hiv_aids_resistance,
+    lactose_intolerance,
+    malaria_resistance,
+    male_pattern_baldness,
+    muscle_performance,
+    norovirus_resistance,
+    pain_sensitivity,
+    red_hair,
+    smoking_behaviour,
+])
 
 def traits_report(genome):
     """Infer traits from genome."""
-    return make_report(genome, [
-        adiponectin_levels,
-        alcohol_flush_reaction,
-        aspargus_detection,
-        biological_age,
-        birth_weight,
-        bitter_taste,
-        blond_vs_brown_hair,
-        blood_glucose,
-        breastfeeding_iq,
-        caffeine_metabolism,
-        earwax_type,
-        eye_color,
-        hair_curl,
-        heroin_addiction,
-        hiv_aids_resistance,
-        lactose_intolerance,
-        malaria_resistance,
-        male_pattern_baldness,
-        muscle_performance,
-        norovirus_resistance,
-        pain_sensitivity,
-        red_hair,
-        smoking_behaviour,
-    ])
+    return _traits_report(genome)
+
+def _file_traits_report(filename, ethnicity):
+    """Loads a genome file and returns its traits report. Runs in worker
+    processes, so only the filename and the report cross process
+    boundaries."""
+    return traits_report(arv.load(filename, ethnicity=ethnicity))
+
+def traits_report_many(genomes_or_paths, workers=0, window=None,
+        ethnicity=None, return_exceptions=False):
+    """Runs ``traits_report`` for many genomes, yielding results as they
+    complete.
+
+    Files are loaded and reported on by a pool of worker processes, so that
+    only filenames and reports are sent between processes. ``Genome`` objects
+    are reported on in this process while waiting for the workers.
+
+    At most ``window`` files are handed to the pool at a time, and new ones
+    are only submitted as results are consumed, so memory use stays bounded
+    no matter how many files there are.
+
+    Arguments:
+        genomes_or_paths: Iterable of filenames and ``Genome`` objects. It is
+                          consumed lazily.
+
+        workers (optional): Number of worker processes. Zero means one per CPU
+                            core. Default is 0.
+
+        window (optional): Maximum number of files in flight. Default is twice
+                           the number of workers.
+
+        ethnicity (optional): Ethnicity to load files with, see ``arv.load``.
+
+        return_exceptions (optional): If True, errors are yielded in place of
+                                      reports. If False (the default), the
+                                      first error is raised.
+
+    Yields:
+        Tuples of (genome or filename, report), in completion order.
+    """
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+    if not workers:
+        workers = multiprocessing.cpu_count()
+    if window is None:
+        window = 2 * workers
+    if window < 1:
+        raise ValueError("window must be positive")
+
+    def finished(future):
+        item = futures.pop(future)
+        try:
+            return item, future.result()
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            return item, e
+
+    futures = {}
+    items = iter(genomes_or_paths)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        try:
+            for item in items:
+                if isinstance(item, arv.Genome):
+                    yield item, traits_report(item)
+                    continue
+
+                future = pool.submit(_file_traits_report, item, ethnicity)
+                futures[future] = item
+
+                # Wait for a slot in the window
+                while len(futures) >= window:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield finished(future)
+
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield finished(future)
+        finally:
+            for future in futures:
+                future.cancel()
@@ -8,16 +8,21 @@ Copyright 2014, 2016, 2017 Christian Stigen Larsen
 Distributed under the GPL v3 or later. See COPYING.
 """
 
+def report_title(func):
+    """Returns the title of a report function, which is the first sentence of
+    its docstring, or else made from its name."""
+    if func.__doc__ is not None:
+        return func.__doc__[:func.__doc__.index(".")]
+    else:
+        return func.__name__.replace("_", " ").capitalize()
+
 def make_report(genome, functions, verbose=False):
     """Runs each function with genome as argument, returning a dict of
     results."""
     report = {}
 
     for func in functions:
-        if func.__doc__ is not None:
-            title = func.__doc__[:func.__doc__.index(".")]
-        else:
-            title = func.__name__.replace("_", " ").capitalize()
+        title = report_title(func)
 
         try:
             result = func(genome)
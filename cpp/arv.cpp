@@ -8,29 +8,13 @@
  * Distributed under the GNU GPL v3 or later. See COPYING.
  */
 
-#include <google/dense_hash_map>
+#include <algorithm>
+#include <memory>
+#include <mutex>
+#include <stdexcept>
 
 #include "arv.hpp"
-
-namespace {
-
-struct RSIDHash {
-  inline std::size_t operator() (const arv::RSID& rsid) const
-  {
-    return static_cast<std::size_t>(rsid);
-  }
-};
-
-struct RSIDEq {
-  inline bool operator()(const arv::RSID& a, const arv::RSID& b) const
-  {
-    return a == b;
-  }
-};
-
-typedef google::dense_hash_map<arv::RSID, arv::SNP, RSIDHash, RSIDEq> SNPMap;
-
-} // anonymus namespace
+#include "storage.hpp"
 
 namespace arv {
 
@@ -89,6 +73,11 @@ bool Genotype::operator==(const Genotype& g) const
   return first == g.first && second == g.second;
 }
 
+bool Genotype::unphased_equal(const Genotype& g) const
+{
+  return *this == g || (first == g.second && second == g.first);
+}
+
 bool Genotype::operator<(const Genotype& g) const
 {
   if ( first < g.first )
@@ -113,6 +102,11 @@ std::string Genotype::to_string() const
   return std::string(s);
 }
 
+std::uint8_t Genotype::code() const
+{
+  return static_cast<std::uint8_t>(first << 3 | second);
+}
+
 SNP::SNP() :
   chromosome(CHR_NO),
   position(0),
@@ -192,110 +186,133 @@ bool SNP::operator==(const Genotype& g) const
   return genotype == g;
 }
 
-struct GenomeIteratorImpl {
-  SNPMap::const_iterator it;
-
-  GenomeIteratorImpl(SNPMap::const_iterator& i):
-    it(i)
-  {
-  }
-};
-
 GenomeIterator::GenomeIterator():
-  pimpl(NULL)
+  storage(NULL),
+  cursor()
 {
 }
 
-GenomeIterator::GenomeIterator(GenomeIteratorImpl* p):
-  pimpl(p)
+GenomeIterator::GenomeIterator(const std::shared_ptr<const Storage>& s,
+    const Cursor& c):
+  storage(s),
+  cursor(c)
 {
 }
 
-GenomeIterator::~GenomeIterator()
+void GenomeIterator::next()
 {
-  delete pimpl;
+  storage->next(cursor);
 }
 
-GenomeIterator::GenomeIterator(const GenomeIterator& o):
-  pimpl(new GenomeIteratorImpl(o.pimpl->it))
+RsidSNP GenomeIterator::value() const
 {
+  return storage->value(cursor);
 }
 
-GenomeIterator& GenomeIterator::operator=(const GenomeIterator& o)
+std::size_t GenomeIterator::read(RsidSNP* out, const std::size_t max)
 {
-  if ( pimpl != o.pimpl ) {
-    delete pimpl;
-    pimpl = new GenomeIteratorImpl(o.pimpl->it);
-  }
-  return *this;
+  return storage->read(cursor, out, max);
 }
 
-void GenomeIterator::next()
+bool GenomeIterator::operator==(const GenomeIterator& o) const
 {
-  ++pimpl->it;
+  return storage->equal(cursor, o.cursor);
 }
 
-RsidSNP GenomeIterator::value() const
+bool GenomeIterator::operator!=(const GenomeIterator& o) const
 {
-  return *pimpl->it;
+  return !(*this == o);
 }
 
-bool GenomeIterator::operator==(const GenomeIterator& o) const
+static inline std::uint64_t position_key(const SNP& snp)
 {
-  return pimpl->it == o.pimpl->it;
+  return static_cast<std::uint64_t>(snp.chromosome) << 32 | snp.position;
 }
 
-bool GenomeIterator::operator!=(const GenomeIterator& o) const
+static bool by_position(const RsidSNP& a, const RsidSNP& b)
 {
-  return pimpl->it != o.pimpl->it;
+  const std::uint64_t ka = position_key(a.second);
+  const std::uint64_t kb = position_key(b.second);
+  return ka < kb || (ka == kb && a.first < b.first);
 }
 
 struct Genome::GenomeImpl {
-  SNPMap snps;
-
-  GenomeImpl(const std::size_t size) :
-    snps(size)
+  // Shared with iterators, which keep the old storage alive if it is replaced
+  std::shared_ptr<Storage> storage;
+
+  // SNPs sorted by (chromosome, position), built on first use
+  mutable std::vector<RsidSNP> position_index;
+  mutable bool position_index_valid;
+  mutable std::mutex position_index_mutex;
+
+  GenomeImpl(Storage* s) :
+    storage(s),
+    position_index(),
+    position_index_valid(false),
+    position_index_mutex()
   {
-    snps.set_empty_key(0);
   }
 
   GenomeImpl(const GenomeImpl& g) :
-    snps(g.snps)
+    storage(g.storage->clone()),
+    position_index(),
+    position_index_valid(false),
+    position_index_mutex()
   {
-    snps.set_empty_key(0);
   }
 
   GenomeImpl& operator=(const GenomeImpl& g)
   {
-    if ( this != &g )
-      snps = g.snps;
+    if ( this != &g ) {
+      storage.reset(g.storage->clone());
+      invalidate();
+    }
 
     return *this;
   }
 
-  bool contains(const RSID& rsid) const {
-    return snps.find(rsid) != snps.end();
+  const SNP& operator[](const RSID& rsid) const {
+    const SNP* snp = storage->find(rsid);
+    return snp != NULL ? *snp : NONE_SNP;
   }
 
-  const SNP& operator[](const RSID& rsid) const {
-    return !contains(rsid)? NONE_SNP : const_cast<SNPMap&>(snps)[rsid];
+  void invalidate()
+  {
+    std::lock_guard<std::mutex> lock(position_index_mutex);
+    position_index_valid = false;
+    std::vector<RsidSNP>().swap(position_index);
   }
 
-  std::string genotype(const RSID& id) const {
-    const SNP& snp = operator[](id);
-    return snp.genotype.to_string();
+  const std::vector<RsidSNP>& positions() const
+  {
+    std::lock_guard<std::mutex> lock(position_index_mutex);
+
+    if ( !position_index_valid ) {
+      position_index.clear();
+      position_index.reserve(storage->size());
+
+      const Cursor end = storage->end();
+      for ( Cursor c = storage->begin(); !storage->equal(c, end);
+            storage->next(c) )
+        position_index.push_back(storage->value(c));
+
+      std::sort(position_index.begin(), position_index.end(), by_position);
+      position_index_valid = true;
+    }
+
+    return position_index;
   }
 };
 
 Genome::Genome():
   y_chromosome(false),
-  pimpl(new GenomeImpl(0))
+  pimpl(new GenomeImpl(new HashStorage(0)))
 {
 }
 
 Genome::Genome(const std::size_t size):
   y_chromosome(false),
-  pimpl(new GenomeImpl(size))
+  pimpl(new GenomeImpl(new HashStorage(size)))
 {
 }
 
@@ -324,24 +341,75 @@ const SNP& Genome::operator[](const RSID& rsid) const
   return (*pimpl)[rsid];
 }
 
+const SNP* Genome::find(const RSID& rsid) const
+{
+  return pimpl->storage->find(rsid);
+}
+
 bool Genome::has(const RSID& rsid) const
 {
-  return pimpl->contains(rsid);
+  return pimpl->storage->find(rsid) != NULL;
 }
 
 std::size_t Genome::size() const
 {
-  return pimpl->snps.size();
+  return pimpl->storage->size();
 }
 
 double Genome::load_factor() const
 {
-  return pimpl->snps.load_factor();
+  return pimpl->storage->load_factor();
+}
+
+bool Genome::read_only() const
+{
+  return pimpl->storage->read_only();
 }
 
 void Genome::insert(const RsidSNP& obj)
 {
-  pimpl->snps.insert(obj);
+  pimpl->storage->insert(obj);
+
+  if ( pimpl->position_index_valid )
+    pimpl->invalidate();
+}
+
+void Genome::reserve(const std::size_t size)
+{
+  pimpl->storage->reserve(size);
+}
+
+std::size_t Genome::memory_usage() const
+{
+  std::lock_guard<std::mutex> lock(pimpl->position_index_mutex);
+  return pimpl->storage->memory_usage() +
+    pimpl->position_index.capacity() * sizeof(RsidSNP);
+}
+
+const Storage& Genome::storage() const
+{
+  return *pimpl->storage;
+}
+
+void Genome::set_storage(Storage* storage)
+{
+  pimpl->storage.reset(storage);
+  pimpl->invalidate();
+}
+
+std::vector<RsidSNP> Genome::region(const Chromosome& chromosome,
+    const Position& start, const Position& end) const
+{
+  if ( end < start )
+    return std::vector<RsidSNP>();
+
+  const std::vector<RsidSNP>& index = pimpl->positions();
+  const RsidSNP first(INT32_MIN, SNP(chromosome, start, Genotype()));
+  const RsidSNP last(INT32_MAX, SNP(chromosome, end, Genotype()));
+
+  return std::vector<RsidSNP>(
+      std::lower_bound(index.begin(), index.end(), first, by_position),
+      std::upper_bound(index.begin(), index.end(), last, by_position));
 }
 
 bool Genome::operator==(const Genome& o) const
@@ -349,8 +417,18 @@ bool Genome::operator==(const Genome& o) const
   // cheap tests first
   if ( !(y_chromosome == o.y_chromosome && size() == o.size() ) )
     return false;
-  else
-    return o.pimpl->snps == pimpl->snps;
+
+  const Storage& storage = *pimpl->storage;
+  const Cursor end = storage.end();
+
+  for ( Cursor c = storage.begin(); !storage.equal(c, end); storage.next(c) ) {
+    const RsidSNP item = storage.value(c);
+    const SNP* snp = o.pimpl->storage->find(item.first);
+    if ( snp == NULL || !(*snp == item.second) )
+      return false;
+  }
+
+  return true;
 }
 
 bool Genome::operator!=(const Genome& o) const
@@ -360,16 +438,95 @@ bool Genome::operator!=(const Genome& o) const
 
 GenomeIterator Genome::begin() const
 {
-  auto i = const_cast<const SNPMap&>(pimpl->snps).begin();
-  auto p = new GenomeIteratorImpl(i);
-  return GenomeIterator(p);
+  return GenomeIterator(pimpl->storage, pimpl->storage->begin());
 }
 
 GenomeIterator Genome::end() const
 {
-  auto i = const_cast<const SNPMap&>(pimpl->snps).end();
-  auto p = new GenomeIteratorImpl(i);
-  return GenomeIterator(p);
+  return GenomeIterator(pimpl->storage, pimpl->storage->end());
+}
+
+std::size_t lookup_many(const Genome& genome, const RSID* rsids,
+    const std::size_t count, std::uint8_t* chromosomes, Position* positions,
+    std::uint8_t* genotypes, bool* found)
+{
+  // Look up a block of RSIDs before reading any of their SNPs, so that the
+  // SNPs of array based storages can be fetched from memory in parallel
+  static const std::size_t BLOCK = 32;
+
+  const Storage& storage = genome.storage();
+  const SNP* snps[BLOCK];
+  std::size_t hits = 0;
+
+  for ( std::size_t start = 0; start < count; start += BLOCK ) {
+    const std::size_t stop = std::min(count, start + BLOCK);
+
+    for ( std::size_t n = start; n < stop; ++n ) {
+      snps[n - start] = storage.find(rsids[n]);
+#ifdef __GNUC__
+      __builtin_prefetch(snps[n - start]);
+#endif
+    }
+
+    for ( std::size_t n = start; n < stop; ++n ) {
+      const SNP* snp = snps[n - start];
+
+      if ( snp != NULL ) {
+        chromosomes[n] = static_cast<std::uint8_t>(snp->chromosome);
+        positions[n] = snp->position;
+        genotypes[n] = snp->genotype.code();
+        found[n] = true;
+        ++hits;
+      } else {
+        chromosomes[n] = CHR_NO;
+        positions[n] = 0;
+        genotypes[n] = 0;
+        found[n] = false;
+      }
+    }
+  }
+
+  return hits;
+}
+
+void export_columns(const Genome& genome, RSID* rsids,
+    std::uint8_t* chromosomes, Position* positions, std::uint8_t* genotypes)
+{
+  const Storage& storage = genome.storage();
+  const Cursor end = storage.end();
+  std::size_t n = 0;
+
+  for ( Cursor c = storage.begin(); !storage.equal(c, end); storage.next(c) ) {
+    const RsidSNP item = storage.value(c);
+    rsids[n] = item.first;
+    chromosomes[n] = static_cast<std::uint8_t>(item.second.chromosome);
+    positions[n] = item.second.position;
+    genotypes[n] = item.second.genotype.code();
+    ++n;
+  }
+}
+
+void convert_storage(Genome& genome, const std::string& type)
+{
+  const Storage& storage = genome.storage();
+  std::unique_ptr<Storage> converted;
+
+  if ( type == "hash" ) {
+    converted.reset(new HashStorage(storage.size()));
+
+    const Cursor end = storage.end();
+    for ( Cursor c = storage.begin(); !storage.equal(c, end); storage.next(c) )
+      converted->insert(storage.value(c));
+  } else if ( type == "sorted" )
+    converted.reset(new SortedStorage(storage));
+  else if ( type == "eytzinger" )
+    converted.reset(new EytzingerStorage(storage));
+  else if ( type == "compressed" )
+    converted.reset(new CompressedStorage(storage));
+  else
+    throw std::runtime_error("Unknown storage type: " + type);
+
+  genome.set_storage(converted.release());
 }
 
 } // namespace arv
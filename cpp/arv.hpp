@@ -13,9 +13,12 @@
 
 #include <cstddef>
 #include <cstdint>
+#include <memory>
 #include <string>
 #include <vector>
 
+#include <google/dense_hash_map>
+
 namespace arv {
 
 typedef std::uint32_t Position;
@@ -55,7 +58,7 @@ enum Chromosome {
 };
 
 // We can get this down to a byte if we want to
-#pragma pack(1)
+#pragma pack(push, 1)
 struct Genotype {
   Nucleotide first  : 3;
   Nucleotide second : 3;
@@ -67,10 +70,20 @@ struct Genotype {
   bool operator==(const Genotype& g) const;
   bool operator<(const Genotype& g) const;
 
+  /*!
+   * Equal disregarding phasing, i.e. in either order, so that AG equals GA.
+   */
+  bool unphased_equal(const Genotype& g) const;
+
   std::string to_string() const;
+
+  /*!
+   * The genotype packed into a byte as (first << 3) | second. Zero means no
+   * call.
+   */
+  std::uint8_t code() const;
 };
 
-#pragma pack(1)
 struct SNP {
   Chromosome chromosome : 5;
   Position position;
@@ -90,19 +103,53 @@ struct SNP {
   bool operator>(const SNP&) const;
   bool operator>=(const SNP&) const;
 };
+#pragma pack(pop)
 
 extern const SNP NONE_SNP;
 
-struct GenomeIteratorImpl;
+class Storage;
 
 typedef std::pair<RSID, SNP> RsidSNP;
 
+struct RSIDHash {
+  inline std::size_t operator() (const RSID& rsid) const
+  {
+    return static_cast<std::size_t>(rsid);
+  }
+};
+
+struct RSIDEq {
+  inline bool operator()(const RSID& a, const RSID& b) const
+  {
+    return a == b;
+  }
+};
+
+typedef google::dense_hash_map<RSID, SNP, RSIDHash, RSIDEq> SNPMap;
+
+/*!
+ * A position within a Storage. Hash maps use the iterator, array based
+ * storages use the index. Storages that decode RSIDs as they go keep the
+ * current one in rsid.
+ */
+struct Cursor {
+  SNPMap::const_iterator it;
+  std::size_t index;
+  RSID rsid;
+
+  Cursor() : it(), index(0), rsid(0)
+  {
+  }
+};
+
+/*!
+ * Walks through the SNPs of a Genome. It is only a storage pointer and a
+ * cursor, so copying it is cheap and never allocates. It shares ownership of
+ * the storage, so it stays valid if the genome's storage is replaced.
+ */
 struct GenomeIterator {
   GenomeIterator();
-  GenomeIterator(const GenomeIterator&);
-  GenomeIterator(GenomeIteratorImpl*);
-  GenomeIterator& operator=(const GenomeIterator&);
-  ~GenomeIterator();
+  GenomeIterator(const std::shared_ptr<const Storage>&, const Cursor&);
 
   bool operator==(const GenomeIterator&) const;
   bool operator!=(const GenomeIterator&) const;
@@ -110,8 +157,16 @@ struct GenomeIterator {
   void next();
   RsidSNP value() const;
 
+  /*!
+   * Copies up to max SNPs into out and moves past them. Returns how many
+   * were copied, zero at the end. Much faster than calling value() and
+   * next() for each SNP.
+   */
+  std::size_t read(RsidSNP* out, const std::size_t max);
+
 private:
-  GenomeIteratorImpl* pimpl;
+  std::shared_ptr<const Storage> storage;
+  Cursor cursor;
 };
 
 struct Genome {
@@ -131,6 +186,19 @@ struct Genome {
    */
   const SNP& operator[](const RSID& id) const;
 
+  /*!
+   * Look up SNP, returning NULL if not found.
+   */
+  const SNP* find(const RSID& id) const;
+
+  /*!
+   * All SNPs on the chromosome with start <= position <= end, sorted by
+   * position. Uses an index sorted by (chromosome, position) that is built
+   * on first use and kept until the genome is modified.
+   */
+  std::vector<RsidSNP> region(const Chromosome& chromosome,
+      const Position& start, const Position& end) const;
+
   /*!
    * Checks if hash table contains given RSID.
    */
@@ -141,11 +209,37 @@ struct Genome {
    */
   void insert(const RsidSNP&);
 
+  /*!
+   * Make room for at least the given number of SNPs without rehashing.
+   */
+  void reserve(const std::size_t size);
+
+  /*!
+   * True if SNPs can't be inserted, e.g. for genomes backed by a memory
+   * mapped binary file.
+   */
+  bool read_only() const;
+
+  /*!
+   * The underlying SNP storage.
+   */
+  const Storage& storage() const;
+
+  /*!
+   * Replaces the underlying SNP storage, taking ownership of it.
+   */
+  void set_storage(Storage* storage);
+
   /*!
    * Underlying hash table's load factor. (For developer purposes)
    */
   double load_factor() const;
 
+  /*!
+   * Approximate number of bytes used by the SNP storage and indices.
+   */
+  std::size_t memory_usage() const;
+
   /*!
    * Number of SNPs.
    */
@@ -165,12 +259,238 @@ private:
 Nucleotide complement(const Nucleotide& n);
 
 /*!
- * Parse a 23andMe genome text file and put contents into genome.
+ * Problems found when validating lines.
  */
-void parse_file(const std::string& filename, Genome&);
+enum ParseError {
+  ERROR_MALFORMED,          // wrong number of fields, non-digits, etc.
+  ERROR_OVERFLOW,           // RSID or position too large
+  ERROR_UNKNOWN_CHROMOSOME, // not 1-25, X, Y or MT
+  ERROR_INVALID_GENOTYPE,   // not one or two of A, C, G, T, D, I and -
+  ERROR_TRUNCATED,          // last line or compressed data cut short
+  ERROR_KINDS
+};
+
+struct ParseIssue {
+  std::size_t line;
+  ParseError error;
+  std::string text;
+};
+
+/*!
+ * The result of parsing in validating mode. Lines with errors are counted
+ * and skipped, and the first max_issues of them are kept with their line
+ * numbers, starting at one.
+ */
+struct ParseReport {
+  std::size_t lines;
+  std::size_t snps;
+  std::size_t comments;
+  std::size_t blanks;
+  std::size_t errors[ERROR_KINDS];
+  std::vector<ParseIssue> issues;
+  std::size_t max_issues;
+
+  explicit ParseReport(const std::size_t max_issues = 100);
+
+  /*!
+   * Total number of errors.
+   */
+  std::size_t error_count() const;
+
+  void add(const ParseError error, const std::size_t line, const char* s,
+      const char* end);
+
+  /*!
+   * Adds the counts and issues of a report for the lines following the ones
+   * of this one.
+   */
+  void append(const ParseReport&);
+};
+
+/*!
+ * Parse a 23andMe genome text file and put contents into genome. Files
+ * compressed with gzip or zip are decompressed on the fly.
+ *
+ * With more than one thread, the file is split into chunks at line boundaries
+ * that are parsed concurrently and then merged into the genome. Zero threads
+ * means one per hardware thread.
+ *
+ * Given a report, every line is validated strictly. Invalid lines and a final
+ * line without a newline are reported and skipped instead of being parsed as
+ * well as possible, and truncated compressed data is reported instead of
+ * thrown.
+ */
+void parse_file(const std::string& filename, Genome&,
+    std::size_t threads = 1, ParseReport* report = NULL);
+
+/*!
+ * Parse a 23andMe genome text held in memory, which may also be gzip or zip
+ * compressed. The data is parsed in place, without copying it. See
+ * parse_file for threads and report.
+ */
+void parse_buffer(const char* data, const std::size_t size, Genome&,
+    std::size_t threads = 1, ParseReport* report = NULL);
+
+/*!
+ * Parses a 23andMe genome text incrementally from chunks of any size, for
+ * example when decompressing or reading from a pipe. Complete lines are
+ * parsed in place, and only a partial last line is buffered between chunks.
+ */
+class StreamParser {
+public:
+  /*!
+   * Validates the lines if given a report, see parse_file.
+   */
+  explicit StreamParser(Genome& genome, ParseReport* report = NULL);
+
+  /*!
+   * Parse a chunk of text.
+   */
+  void feed(const char* data, const std::size_t size);
+
+  /*!
+   * Parse what's left after the last chunk, i.e. a final line without a
+   * terminating newline.
+   */
+  void finish();
+
+private:
+  Genome& genome;
+  ParseReport* report;
+  std::vector<char> partial;
+
+  void append_partial(const char* s, const char* end);
+};
+
+/*!
+ * Parse several 23andMe genome text files, each into its own genome, using a
+ * pool of worker threads. Zero workers means one per hardware thread. If any
+ * file fails to parse, the error for the first such file is rethrown after
+ * all workers have finished.
+ */
+void parse_files(const std::vector<std::string>& filenames,
+    const std::vector<Genome*>& genomes, std::size_t workers = 0);
+
+/*!
+ * Parses up to max SNPs from [s, end) into out, leaving s at the start of
+ * the next line. Returns the number of SNPs, which is less than max only if
+ * s reached end. For going through a text in batches without keeping the
+ * SNPs in a genome.
+ */
+std::size_t parse_snps(const char*& s, const char* end, RsidSNP* out,
+    const std::size_t max);
+
+/*!
+ * Parses an RSID given as rs<digits>, or i<digits> for internal IDs, which
+ * become negative. Returns false if the string is anything else or does not
+ * fit.
+ */
+bool parse_rsid(const char* s, const std::size_t length, RSID& rsid);
+
+struct ByteRange {
+  std::size_t begin;
+  std::size_t end;
+};
+
+/*!
+ * Where the lines of each chromosome are in an uncompressed genome file, so
+ * that chromosomes can be parsed one at a time. Files are usually sorted by
+ * chromosome, giving one range each. Lines whose chromosome field can't be
+ * read are indexed under CHR_NO.
+ */
+struct ShardIndex {
+  std::vector<ByteRange> ranges[CHR_MT + 1];
+  std::size_t lines[CHR_MT + 1];
+
+  ShardIndex();
+};
+
+/*!
+ * Finds the chromosome of each line, without parsing anything else. This is
+ * a quick first pass, much faster than parsing the whole file.
+ */
+void index_shards(const char* data, const std::size_t size, ShardIndex&);
+
+/*!
+ * Parses the lines of one chromosome into the genome.
+ */
+void parse_shard(const char* data, const ShardIndex&, const Chromosome,
+    Genome&);
 
 Genotype complement(const Genotype& g);
 
+/*!
+ * Looks up many RSIDs at once, storing the fields of each SNP in the given
+ * arrays of size count. Chromosomes and genotype codes are zero, and found
+ * is false, for RSIDs not in the genome. Returns the number found.
+ */
+std::size_t lookup_many(const Genome&, const RSID* rsids,
+    const std::size_t count, std::uint8_t* chromosomes, Position* positions,
+    std::uint8_t* genotypes, bool* found);
+
+/*!
+ * Copies all SNPs into the given arrays, which must have room for
+ * genome.size() elements, in the order of iteration. Chromosomes and
+ * genotypes are stored as in lookup_many.
+ */
+void export_columns(const Genome&, RSID* rsids, std::uint8_t* chromosomes,
+    Position* positions, std::uint8_t* genotypes);
+
+/*!
+ * Replaces the genome's storage with a copy of the given type: "hash" for the
+ * default, mutable hash map, "sorted" or "eytzinger" for read-only arrays
+ * taking ten bytes per SNP, or "compressed" for read-only arrays with delta
+ * coded RSIDs. Eytzinger order gives the fastest lookups.
+ */
+void convert_storage(Genome&, const std::string& type);
+
+/*!
+ * Metadata stored along with the SNPs in the binary genome format.
+ */
+struct GenomeInfo {
+  std::string name;
+  std::string ethnicity;
+  int orientation;
+
+  GenomeInfo();
+};
+
+/*!
+ * Save genome in arv's versioned and checksummed binary format, with SNPs
+ * sorted by RSID.
+ */
+void save_binary(const std::string& filename, const Genome&,
+    const GenomeInfo&);
+
+/*!
+ * Memory maps a genome saved with save_binary. SNPs are looked up directly in
+ * the mapping, and the genome becomes read-only.
+ */
+void load_binary(const std::string& filename, Genome&, GenomeInfo&,
+    const bool verify = true);
+
+/*!
+ * Writes a genome in the binary format to a new POSIX shared memory object,
+ * so that other processes can attach to it by name with load_shared. Fails
+ * if the name is already in use.
+ */
+void save_shared(const std::string& name, const Genome&, const GenomeInfo&);
+
+/*!
+ * Maps a genome from a shared memory object created by save_shared. The
+ * pages are shared with every other process attached to it, and the genome
+ * becomes read-only. The checksum is only verified when asked to, since that
+ * touches every page.
+ */
+void load_shared(const std::string& name, Genome&, GenomeInfo&,
+    const bool verify = false);
+
+/*!
+ * Removes the name of a shared memory object. Processes that already have it
+ * mapped keep using it, and the memory is freed when the last one is done.
+ */
+void unlink_shared(const std::string& name);
+
 } // namespace arv
 
 #endif // include guard
@@ -0,0 +1,301 @@
+/*
+ * arv
+ * Copyright 2017 Christian Stigen Larsen
+ * Distributed under the GNU GPL v3 or later. See COPYING.
+ */
+
+#include "binary.hpp"
+
+#include <algorithm>
+#include <atomic>
+#include <cstdio>
+#include <cstring>
+#include <stdexcept>
+#include <string>
+#include <sys/mman.h>
+#include <unistd.h>
+#include <vector>
+
+#include "file.hpp"
+#include "filesize.hpp"
+#include "mmap.hpp"
+#include "storage.hpp"
+
+namespace arv {
+
+static_assert(sizeof(BinaryHeader) == 64, "Binary header must be 64 bytes");
+
+static std::size_t align8(const std::size_t n)
+{
+  return (n + 7) & ~static_cast<std::size_t>(7);
+}
+
+/*!
+ * Byte offsets of the parts following the header.
+ */
+struct BinaryLayout {
+  std::size_t name;
+  std::size_t ethnicity;
+  std::size_t rsids;
+  std::size_t snps;
+  std::size_t size;
+
+  BinaryLayout(const std::size_t count, const std::size_t name_size,
+      const std::size_t ethnicity_size) :
+    name(sizeof(BinaryHeader)),
+    ethnicity(name + name_size),
+    rsids(align8(ethnicity + ethnicity_size)),
+    snps(rsids + count*sizeof(RSID)),
+    size(align8(snps + count*sizeof(SNP)))
+  {
+  }
+};
+
+std::uint64_t checksum(const char* data, const std::size_t size)
+{
+  // FNV-1a over 64-bit words, folding the high bits down after each step
+  const std::uint64_t prime = 1099511628211ULL;
+  std::uint64_t hash = 14695981039346656037ULL;
+  std::size_t n = 0;
+
+  for ( ; n + sizeof(std::uint64_t) <= size; n += sizeof(std::uint64_t) ) {
+    std::uint64_t word;
+    memcpy(&word, data + n, sizeof(word));
+    hash = (hash ^ word) * prime;
+    hash ^= hash >> 32;
+  }
+
+  for ( ; n < size; ++n ) {
+    hash = (hash ^ static_cast<unsigned char>(data[n])) * prime;
+    hash ^= hash >> 32;
+  }
+
+  return hash;
+}
+
+std::uint64_t checksum_file(const std::string& filename)
+{
+  File fd(filename.c_str(), O_RDONLY);
+  const std::size_t size = filesize(fd);
+
+  if ( size == 0 )
+    return checksum(NULL, 0);
+
+  MMap fmap(0, size, PROT_READ, MAP_PRIVATE, fd, 0);
+  return checksum(fmap.c_str(), size);
+}
+
+std::size_t binary_size(const Genome& genome, const GenomeInfo& info)
+{
+  return BinaryLayout(genome.size(), info.name.size(),
+      info.ethnicity.size()).size;
+}
+
+void write_binary(char* out, const Genome& genome, const GenomeInfo& info)
+{
+  const std::vector<RsidSNP> items(sorted_items(genome.storage()));
+
+  const BinaryLayout layout(items.size(), info.name.size(),
+      info.ethnicity.size());
+  memset(out, 0, layout.size);
+
+  BinaryHeader header;
+  memset(&header, 0, sizeof(header));
+  memcpy(header.magic, BINARY_MAGIC, sizeof(header.magic));
+  header.byte_order = BINARY_BYTE_ORDER;
+  header.version = BINARY_VERSION;
+  header.size = layout.size;
+  header.count = items.size();
+  header.flags = genome.y_chromosome ? BINARY_FLAG_Y_CHROMOSOME : 0;
+  header.orientation = info.orientation;
+  header.name_size = info.name.size();
+  header.ethnicity_size = info.ethnicity.size();
+  header.snp_size = sizeof(SNP);
+
+  memcpy(out + layout.name, info.name.data(), info.name.size());
+  memcpy(out + layout.ethnicity, info.ethnicity.data(),
+      info.ethnicity.size());
+
+  RSID* rsids = reinterpret_cast<RSID*>(out + layout.rsids);
+  SNP* snps = reinterpret_cast<SNP*>(out + layout.snps);
+
+  for ( std::size_t n = 0; n < items.size(); ++n ) {
+    rsids[n] = items[n].first;
+    snps[n] = items[n].second;
+  }
+
+  header.checksum = checksum(out + sizeof(header), layout.size -
+      sizeof(header));
+  memcpy(out, &header, sizeof(header));
+}
+
+void read_binary(const char* data, const std::size_t size,
+    const std::shared_ptr<const void>& owner, Genome& genome,
+    GenomeInfo& info, const bool verify)
+{
+  BinaryHeader header;
+
+  if ( size < sizeof(header) )
+    throw std::runtime_error("Not an arv genome: too small");
+
+  memcpy(&header, data, sizeof(header));
+
+  if ( memcmp(header.magic, BINARY_MAGIC, sizeof(header.magic)) != 0 )
+    throw std::runtime_error("Not an arv genome: bad magic");
+
+  if ( header.byte_order != BINARY_BYTE_ORDER )
+    throw std::runtime_error("Unsupported arv genome: wrong byte order");
+
+  if ( header.version != BINARY_VERSION )
+    throw std::runtime_error("Unsupported arv genome version " +
+        std::to_string(header.version));
+
+  if ( header.snp_size != sizeof(SNP) )
+    throw std::runtime_error("Unsupported arv genome: wrong SNP size");
+
+  // Bound the header fields by the file size before computing offsets, so
+  // that a corrupt count cannot make them wrap around
+  const std::size_t body = size - sizeof(header);
+
+  if ( static_cast<std::uint64_t>(header.name_size) + header.ethnicity_size >
+      body )
+    throw std::runtime_error("Corrupt arv genome: wrong name size");
+
+  if ( header.count > body / (sizeof(RSID) + sizeof(SNP)) )
+    throw std::runtime_error("Corrupt arv genome: wrong count");
+
+  const BinaryLayout layout(header.count, header.name_size,
+      header.ethnicity_size);
+
+  if ( header.size != layout.size || layout.size > size )
+    throw std::runtime_error("Corrupt arv genome: wrong size");
+
+  if ( verify && header.checksum != checksum(data + sizeof(header),
+        layout.size - sizeof(header)) )
+    throw std::runtime_error("Corrupt arv genome: checksum mismatch");
+
+  info.name.assign(data + layout.name, header.name_size);
+  info.ethnicity.assign(data + layout.ethnicity, header.ethnicity_size);
+  info.orientation = header.orientation;
+
+  genome.set_storage(new SortedStorage(owner,
+        reinterpret_cast<const RSID*>(data + layout.rsids),
+        reinterpret_cast<const SNP*>(data + layout.snps),
+        header.count));
+  genome.y_chromosome = (header.flags & BINARY_FLAG_Y_CHROMOSOME) != 0;
+}
+
+GenomeInfo::GenomeInfo() :
+  name(),
+  ethnicity(),
+  orientation(1)
+{
+}
+
+void save_binary(const std::string& filename, const Genome& genome,
+    const GenomeInfo& info)
+{
+  static std::atomic<unsigned> saves(0);
+  const std::size_t size = binary_size(genome, info);
+
+  // Write to a temporary file that is renamed over the target, since the
+  // genome may be memory mapped from the target itself
+  const std::string tmp = filename + ".tmp" + std::to_string(getpid()) +
+    "." + std::to_string(saves++);
+
+  try {
+    File fd(tmp.c_str(), O_RDWR | O_CREAT | O_EXCL,
+        S_IRUSR | S_IWUSR | S_IRGRP | S_IROTH);
+
+    if ( ftruncate(fd, size) < 0 )
+      throw std::runtime_error("Could not resize " + tmp);
+
+    {
+      MMap fmap(0, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+      write_binary(static_cast<char*>(fmap.ptr()), genome, info);
+    }
+
+    if ( fsync(fd) < 0 )
+      throw std::runtime_error("Could not sync " + tmp);
+
+    if ( rename(tmp.c_str(), filename.c_str()) < 0 )
+      throw std::runtime_error("Could not rename " + tmp + " to " +
+          filename);
+  } catch ( ... ) {
+    unlink(tmp.c_str());
+    throw;
+  }
+}
+
+void load_binary(const std::string& filename, Genome& genome,
+    GenomeInfo& info, const bool verify)
+{
+  File fd(filename.c_str(), O_RDONLY);
+  const std::size_t size = filesize(fd);
+
+  if ( size < sizeof(BinaryHeader) )
+    throw std::runtime_error("Not an arv genome: " + filename);
+
+  // The mapping outlives the file descriptor, and is shared by all copies
+  // of the genome
+  std::shared_ptr<MMap> fmap(new MMap(0, size, PROT_READ, MAP_SHARED, fd,
+        0));
+  read_binary(fmap->c_str(), size, fmap, genome, info, verify);
+}
+
+/*!
+ * Shared memory names must start with a slash, which we add if missing.
+ */
+static std::string shared_name(const std::string& name)
+{
+  if ( name.empty() || name == "/" )
+    throw std::runtime_error("Empty shared memory name");
+  return name[0] == '/' ? name : "/" + name;
+}
+
+void save_shared(const std::string& name, const Genome& genome,
+    const GenomeInfo& info)
+{
+  const std::string path = shared_name(name);
+  const std::size_t size = binary_size(genome, info);
+
+  SharedFile fd(path.c_str(), O_RDWR | O_CREAT | O_EXCL,
+      S_IRUSR | S_IWUSR | S_IRGRP | S_IROTH);
+
+  // Don't leave a half-written object behind for others to attach to
+  try {
+    if ( ftruncate(fd, size) < 0 )
+      throw std::runtime_error("Could not resize shared memory " + path);
+
+    MMap fmap(0, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    write_binary(static_cast<char*>(fmap.ptr()), genome, info);
+  } catch ( ... ) {
+    shm_unlink(path.c_str());
+    throw;
+  }
+}
+
+void load_shared(const std::string& name, Genome& genome, GenomeInfo& info,
+    const bool verify)
+{
+  const std::string path = shared_name(name);
+  SharedFile fd(path.c_str(), O_RDONLY);
+  const std::size_t size = filesize(fd);
+
+  if ( size < sizeof(BinaryHeader) )
+    throw std::runtime_error("Not an arv genome: " + path);
+
+  std::shared_ptr<MMap> fmap(new MMap(0, size, PROT_READ, MAP_SHARED, fd,
+        0));
+  read_binary(fmap->c_str(), size, fmap, genome, info, verify);
+}
+
+void unlink_shared(const std::string& name)
+{
+  const std::string path = shared_name(name);
+
+  if ( shm_unlink(path.c_str()) < 0 )
+    throw std::runtime_error("Could not unlink shared memory " + path);
+}
+
+} // namespace arv
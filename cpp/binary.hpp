@@ -0,0 +1,76 @@
+/*
+ * arv
+ * Copyright 2017 Christian Stigen Larsen
+ * Distributed under the GNU GPL v3 or later. See COPYING.
+ */
+
+#ifndef ARV_BINARY_HPP
+#define ARV_BINARY_HPP
+
+#include <cstddef>
+#include <cstdint>
+#include <memory>
+#include <string>
+
+#include "arv.hpp"
+
+namespace arv {
+
+/*!
+ * Header of the binary genome format. It is followed by the name and
+ * ethnicity strings, the sorted RSID array and the SNP array, each array
+ * starting on an 8-byte boundary.
+ */
+struct BinaryHeader {
+  char magic[8];                // BINARY_MAGIC
+  std::uint32_t byte_order;     // BINARY_BYTE_ORDER, in writer's byte order
+  std::uint32_t version;        // BINARY_VERSION
+  std::uint64_t size;           // Total size, including header
+  std::uint64_t checksum;       // Checksum of everything after the header
+  std::uint64_t count;          // Number of SNPs
+  std::uint32_t flags;          // BINARY_FLAG_*
+  std::int32_t orientation;
+  std::uint32_t name_size;
+  std::uint32_t ethnicity_size;
+  std::uint32_t snp_size;       // sizeof(SNP)
+  std::uint32_t reserved;
+};
+
+const char BINARY_MAGIC[8] = {'A', 'R', 'V', 'G', 'E', 'N', 'O', 'M'};
+const std::uint32_t BINARY_BYTE_ORDER = 0x01020304;
+const std::uint32_t BINARY_VERSION = 1;
+const std::uint32_t BINARY_FLAG_Y_CHROMOSOME = 1;
+
+/*!
+ * 64-bit checksum used by the binary format.
+ */
+std::uint64_t checksum(const char* data, const std::size_t size);
+
+/*!
+ * Checksum of a file's contents.
+ */
+std::uint64_t checksum_file(const std::string& filename);
+
+/*!
+ * Number of bytes needed to store the genome in the binary format.
+ */
+std::size_t binary_size(const Genome&, const GenomeInfo&);
+
+/*!
+ * Writes the genome in the binary format to out, which must have room for
+ * binary_size() bytes.
+ */
+void write_binary(char* out, const Genome&, const GenomeInfo&);
+
+/*!
+ * Makes the genome use the binary formatted data in place. The owner must
+ * keep the data alive, and is kept for as long as the genome uses it. Throws
+ * if the data is not a valid genome.
+ */
+void read_binary(const char* data, const std::size_t size,
+    const std::shared_ptr<const void>& owner, Genome&, GenomeInfo&,
+    const bool verify);
+
+} // namespace arv
+
+#endif // guard
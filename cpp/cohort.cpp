@@ -0,0 +1,189 @@
+/*
+ * arv
+ * Copyright 2017 Christian Stigen Larsen
+ * Distributed under the GNU GPL v3 or later. See COPYING.
+ */
+
+#include "cohort.hpp"
+
+#include <algorithm>
+#include <stdexcept>
+#include <thread>
+
+namespace arv {
+
+static Genotype from_code(const std::uint8_t code)
+{
+  return Genotype(static_cast<Nucleotide>(code >> 3),
+                  static_cast<Nucleotide>(code & 7));
+}
+
+Cohort::Cohort(const std::size_t genomes) :
+  columns(genomes),
+  stride((genomes + 1) / 2),
+  index(),
+  row_rsids(),
+  palettes(),
+  cells()
+{
+  index.set_empty_key(0);
+}
+
+std::size_t Cohort::genomes() const
+{
+  return columns;
+}
+
+std::size_t Cohort::size() const
+{
+  return row_rsids.size();
+}
+
+void Cohort::reserve(const std::size_t rows)
+{
+  index.resize(rows);
+  row_rsids.reserve(rows);
+  palettes.reserve(rows * PALETTE_SIZE);
+  cells.reserve(rows * stride);
+}
+
+std::size_t Cohort::find(const RSID& rsid) const
+{
+  const RowMap::const_iterator it = index.find(rsid);
+  return it != index.end() ? it->second : npos;
+}
+
+RSID Cohort::rsid(const std::size_t row) const
+{
+  return row_rsids[row];
+}
+
+std::size_t Cohort::row(const RSID& rsid)
+{
+  const std::size_t row = row_rsids.size();
+  const std::pair<RowMap::iterator, bool> r = index.insert(
+      std::make_pair(rsid, static_cast<std::uint32_t>(row)));
+
+  if ( !r.second )
+    return r.first->second;
+
+  row_rsids.push_back(rsid);
+  palettes.resize(palettes.size() + PALETTE_SIZE, 0);
+  cells.resize(cells.size() + stride, 0);
+  return row;
+}
+
+std::uint8_t Cohort::palette_index(const std::size_t row,
+    const Genotype& genotype)
+{
+  const std::uint8_t code = genotype.code();
+  std::uint8_t* palette = &palettes[row * PALETTE_SIZE];
+
+  for ( std::size_t n = 0; n < PALETTE_SIZE; ++n ) {
+    if ( palette[n] == code )
+      return static_cast<std::uint8_t>(n + 1);
+
+    if ( palette[n] == 0 ) {
+      palette[n] = code;
+      return static_cast<std::uint8_t>(n + 1);
+    }
+  }
+
+  throw std::runtime_error("Too many distinct genotypes for one RSID");
+}
+
+void Cohort::add(const std::size_t column, const Genome& genome)
+{
+  if ( column >= columns )
+    throw std::out_of_range("No such genome in cohort");
+
+  const Storage& storage = genome.storage();
+  const Cursor end = storage.end();
+  const std::size_t shift = (column & 1) * 4;
+
+  for ( Cursor c = storage.begin(); !storage.equal(c, end); storage.next(c) ) {
+    const RsidSNP item = storage.value(c);
+    const std::size_t r = row(item.first);
+
+    // No-calls are stored as missing
+    if ( item.second.genotype.code() == 0 )
+      continue;
+
+    std::uint8_t& cell = cells[r * stride + column / 2];
+    cell = static_cast<std::uint8_t>((cell & ~(0xf << shift)) |
+        palette_index(r, item.second.genotype) << shift);
+  }
+}
+
+Genotype Cohort::genotype(const std::size_t row, const std::size_t column)
+  const
+{
+  const std::uint8_t cell = (cells[row * stride + column / 2] >>
+      ((column & 1) * 4)) & 0xf;
+
+  if ( cell == 0 )
+    return Genotype();
+
+  return from_code(palettes[row * PALETTE_SIZE + cell - 1]);
+}
+
+void Cohort::genotypes(const std::size_t row, std::uint8_t* out) const
+{
+  // Decode through a lookup table for the row, two cells per byte
+  std::uint8_t codes[16] = {0};
+  std::copy(&palettes[row * PALETTE_SIZE],
+            &palettes[row * PALETTE_SIZE] + PALETTE_SIZE, codes + 1);
+
+  const std::uint8_t* cell = &cells[row * stride];
+
+  for ( std::size_t n = 0; n + 1 < columns; n += 2, ++cell ) {
+    out[n] = codes[*cell & 0xf];
+    out[n + 1] = codes[*cell >> 4];
+  }
+
+  if ( columns & 1 )
+    out[columns - 1] = codes[*cell & 0xf];
+}
+
+std::size_t Cohort::memory_usage() const
+{
+  return sizeof(*this) +
+    index.bucket_count() * sizeof(RowMap::value_type) +
+    row_rsids.capacity() * sizeof(RSID) +
+    palettes.capacity() +
+    cells.capacity();
+}
+
+void load_cohort(const std::vector<std::string>& filenames, Cohort& cohort,
+    std::size_t workers)
+{
+  if ( filenames.size() != cohort.genomes() )
+    throw std::invalid_argument("Need exactly one file per genome");
+
+  if ( workers == 0 )
+    workers = std::thread::hardware_concurrency();
+  if ( workers == 0 )
+    workers = 1;
+
+  // Parse a batch of files in parallel, then merge them into the matrix
+  for ( std::size_t first = 0; first < filenames.size(); first += workers ) {
+    const std::size_t last = std::min(filenames.size(), first + workers);
+    const std::vector<std::string> batch(filenames.begin() + first,
+        filenames.begin() + last);
+    std::vector<Genome> genomes(batch.size());
+    std::vector<Genome*> pointers;
+
+    for ( std::size_t n = 0; n < genomes.size(); ++n )
+      pointers.push_back(&genomes[n]);
+
+    parse_files(batch, pointers, workers);
+
+    if ( first == 0 )
+      cohort.reserve(genomes[0].size() + genomes[0].size() / 8);
+
+    for ( std::size_t n = 0; n < genomes.size(); ++n )
+      cohort.add(first + n, genomes[n]);
+  }
+}
+
+} // namespace arv
@@ -0,0 +1,106 @@
+/*
+ * arv
+ * Copyright 2017 Christian Stigen Larsen
+ * Distributed under the GNU GPL v3 or later. See COPYING.
+ */
+
+#ifndef ARV_COHORT_HPP
+#define ARV_COHORT_HPP
+
+#include <cstddef>
+#include <cstdint>
+#include <string>
+#include <vector>
+
+#include <google/dense_hash_map>
+
+#include "arv.hpp"
+#include "storage.hpp"
+
+namespace arv {
+
+/*!
+ * Genotypes of many genomes in a single matrix, with one row per RSID and a
+ * 4-bit cell per genome. Each row has a palette of up to PALETTE_SIZE
+ * distinct genotypes that the cells refer to. A zero cell means that the
+ * genome has no call for the RSID, or doesn't have it at all.
+ */
+class Cohort {
+public:
+  static const std::size_t PALETTE_SIZE = 15;
+  static const std::size_t npos = static_cast<std::size_t>(-1);
+
+  explicit Cohort(const std::size_t genomes);
+
+  /*!
+   * Stores the genotypes of a genome in the given column, adding rows for
+   * new RSIDs. Throws if a row would get more than PALETTE_SIZE distinct
+   * genotypes.
+   */
+  void add(const std::size_t column, const Genome&);
+
+  /*!
+   * Make room for the given number of rows.
+   */
+  void reserve(const std::size_t rows);
+
+  /*!
+   * Number of genomes.
+   */
+  std::size_t genomes() const;
+
+  /*!
+   * Number of rows, i.e. distinct RSIDs in all genomes.
+   */
+  std::size_t size() const;
+
+  /*!
+   * Row for the RSID, or npos.
+   */
+  std::size_t find(const RSID& rsid) const;
+
+  RSID rsid(const std::size_t row) const;
+
+  /*!
+   * Genotype of one genome, a no-call if missing.
+   */
+  Genotype genotype(const std::size_t row, const std::size_t column) const;
+
+  /*!
+   * Copies the genotype codes (see Genotype::code) of all genomes for the
+   * row to out, which must have room for genomes() bytes. Missing genotypes
+   * are zero.
+   */
+  void genotypes(const std::size_t row, std::uint8_t* out) const;
+
+  /*!
+   * Approximate number of bytes used.
+   */
+  std::size_t memory_usage() const;
+
+private:
+  typedef google::dense_hash_map<RSID, std::uint32_t, RSIDHash, RSIDEq>
+    RowMap;
+
+  std::size_t columns;
+  std::size_t stride;
+  RowMap index;
+  std::vector<RSID> row_rsids;
+  std::vector<std::uint8_t> palettes;
+  std::vector<std::uint8_t> cells;
+
+  std::size_t row(const RSID& rsid);
+  std::uint8_t palette_index(const std::size_t row, const Genotype& genotype);
+};
+
+/*!
+ * Parses the files with a pool of workers and adds them to the cohort, in
+ * order. At most one genome per worker is held in memory at a time. Zero
+ * workers means one per hardware thread.
+ */
+void load_cohort(const std::vector<std::string>& filenames, Cohort&,
+    std::size_t workers = 0);
+
+} // namespace arv
+
+#endif // guard
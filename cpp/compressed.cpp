@@ -0,0 +1,249 @@
+/*
+ * arv
+ * Copyright 2017 Christian Stigen Larsen
+ * Distributed under the GNU GPL v3 or later. See COPYING.
+ */
+
+#include "compressed.hpp"
+
+#include <algorithm>
+#include <cstdint>
+#include <cstring>
+#include <stdexcept>
+#include <string>
+#include <vector>
+#include <zlib.h>
+
+namespace arv {
+
+// Size of the buffer holding decompressed text. Compressed input is read
+// directly from the memory mapped file.
+static const std::size_t BUFFER_SIZE = 1 << 18;
+
+// zlib counts input bytes with 32-bit integers
+static const std::size_t MAX_INPUT_CHUNK = 1 << 30;
+
+static const std::uint32_t ZIP_LOCAL_HEADER = 0x04034b50;
+static const std::uint32_t ZIP_CENTRAL_HEADER = 0x02014b50;
+static const std::uint32_t ZIP_END_OF_DIRECTORY = 0x06054b50;
+
+static std::uint16_t read16(const char* p)
+{
+  const unsigned char* u = reinterpret_cast<const unsigned char*>(p);
+  return static_cast<std::uint16_t>(u[0] | u[1] << 8);
+}
+
+static std::uint32_t read32(const char* p)
+{
+  return read16(p) | static_cast<std::uint32_t>(read16(p + 2)) << 16;
+}
+
+bool is_gzip(const char* data, const std::size_t size)
+{
+  return size >= 2 &&
+    static_cast<unsigned char>(data[0]) == 0x1f &&
+    static_cast<unsigned char>(data[1]) == 0x8b;
+}
+
+bool is_zip(const char* data, const std::size_t size)
+{
+  return size >= 4 && read32(data) == ZIP_LOCAL_HEADER;
+}
+
+/*!
+ * Thrown when compressed data ends before its stream does.
+ */
+struct TruncatedInput : public std::runtime_error {
+  TruncatedInput() :
+    std::runtime_error("Truncated compressed file")
+  {
+  }
+};
+
+/*!
+ * Owns a zlib inflate stream.
+ */
+struct Inflater {
+  z_stream stream;
+
+  Inflater(const int window_bits)
+  {
+    memset(&stream, 0, sizeof(stream));
+    if ( inflateInit2(&stream, window_bits) != Z_OK )
+      throw std::runtime_error("Could not initialize zlib");
+  }
+
+  ~Inflater()
+  {
+    inflateEnd(&stream);
+  }
+};
+
+/*!
+ * Inflates a single deflate stream, feeding the output to the parser. The
+ * window bits select between zlib, gzip and raw deflate streams. Returns the
+ * number of input bytes consumed.
+ */
+static std::size_t inflate_into(const char* data, const std::size_t size,
+    const int window_bits, StreamParser& parser)
+{
+  std::vector<char> buffer(BUFFER_SIZE);
+  Inflater z(window_bits);
+  std::size_t consumed = 0;
+  int status = Z_OK;
+
+  while ( status != Z_STREAM_END ) {
+    if ( z.stream.avail_in == 0 ) {
+      if ( consumed == size )
+        throw TruncatedInput();
+
+      const std::size_t chunk = std::min(size - consumed, MAX_INPUT_CHUNK);
+      z.stream.next_in = reinterpret_cast<Bytef*>(const_cast<char*>(data +
+            consumed));
+      z.stream.avail_in = static_cast<uInt>(chunk);
+      consumed += chunk;
+    }
+
+    z.stream.next_out = reinterpret_cast<Bytef*>(&buffer[0]);
+    z.stream.avail_out = static_cast<uInt>(buffer.size());
+
+    status = inflate(&z.stream, Z_NO_FLUSH);
+
+    if ( status != Z_OK && status != Z_STREAM_END )
+      throw std::runtime_error(std::string("Could not decompress file: ") +
+          (z.stream.msg != NULL ? z.stream.msg : "zlib error"));
+
+    parser.feed(&buffer[0], buffer.size() - z.stream.avail_out);
+  }
+
+  return consumed - z.stream.avail_in;
+}
+
+/*!
+ * Inflates into the parser, recording truncated data in the report if there
+ * is one, after the lines that could be parsed.
+ */
+template <typename Function>
+static void inflate_checked(StreamParser& parser, ParseReport* report,
+    Function inflate_all)
+{
+  try {
+    inflate_all();
+  } catch ( const TruncatedInput& ) {
+    if ( report == NULL )
+      throw;
+
+    // The last line is reported as truncated unless it happened to end with
+    // a newline
+    const std::size_t truncated = report->errors[ERROR_TRUNCATED];
+    parser.finish();
+
+    if ( report->errors[ERROR_TRUNCATED] == truncated ) {
+      const char* nothing = "";
+      report->add(ERROR_TRUNCATED, report->lines + 1, nothing, nothing);
+    }
+    return;
+  }
+
+  parser.finish();
+}
+
+void parse_gzip(const char* data, const std::size_t size, Genome& genome,
+    ParseReport* report)
+{
+  StreamParser parser(genome, report);
+
+  inflate_checked(parser, report, [&]() {
+    std::size_t pos = 0;
+
+    // A gzip file may consist of several members, which should be
+    // concatenated. Anything else after the last member is ignored, like
+    // gzip does.
+    while ( pos < size && is_gzip(data + pos, size - pos) )
+      pos += inflate_into(data + pos, size - pos, 16 + MAX_WBITS, parser);
+  });
+}
+
+void parse_zip(const char* data, const std::size_t size, Genome& genome,
+    ParseReport* report)
+{
+  const std::size_t EOCD_SIZE = 22;
+  const std::size_t CENTRAL_HEADER_SIZE = 46;
+  const std::size_t LOCAL_HEADER_SIZE = 30;
+
+  if ( size < EOCD_SIZE )
+    throw std::runtime_error("Invalid zip file");
+
+  // The end of central directory record is followed by a comment of at most
+  // 64k, so search backwards for it
+  const char* eocd = NULL;
+  const char* lowest = data + (size > EOCD_SIZE + 0xffff ?
+      size - EOCD_SIZE - 0xffff : 0);
+
+  for ( const char* p = data + size - EOCD_SIZE; p >= lowest; --p ) {
+    if ( read32(p) == ZIP_END_OF_DIRECTORY ) {
+      eocd = p;
+      break;
+    }
+  }
+
+  if ( eocd == NULL )
+    throw std::runtime_error("Invalid zip file: no central directory");
+
+  const std::size_t entries = read16(eocd + 10);
+  std::size_t pos = read32(eocd + 16);
+
+  // Find the first file, skipping directories
+  for ( std::size_t n = 0; n < entries; ++n ) {
+    if ( pos + CENTRAL_HEADER_SIZE > size ||
+         read32(data + pos) != ZIP_CENTRAL_HEADER )
+      throw std::runtime_error("Invalid zip file: bad central directory");
+
+    const char* entry = data + pos;
+    const std::uint16_t flags = read16(entry + 8);
+    const std::uint16_t method = read16(entry + 10);
+    const std::size_t compressed_size = read32(entry + 20);
+    const std::size_t name_size = read16(entry + 28);
+    const std::size_t extra_size = read16(entry + 30);
+    const std::size_t comment_size = read16(entry + 32);
+    const std::size_t offset = read32(entry + 42);
+
+    pos += CENTRAL_HEADER_SIZE + name_size + extra_size + comment_size;
+
+    if ( pos > size )
+      throw std::runtime_error("Invalid zip file: bad central directory");
+
+    if ( name_size > 0 && entry[CENTRAL_HEADER_SIZE + name_size - 1] == '/' )
+      continue;
+
+    if ( flags & 1 )
+      throw std::runtime_error("Encrypted zip files are not supported");
+
+    if ( offset + LOCAL_HEADER_SIZE > size ||
+         read32(data + offset) != ZIP_LOCAL_HEADER )
+      throw std::runtime_error("Invalid zip file: bad local header");
+
+    const std::size_t start = offset + LOCAL_HEADER_SIZE +
+      read16(data + offset + 26) + read16(data + offset + 28);
+
+    if ( start > size || compressed_size > size - start )
+      throw std::runtime_error("Invalid zip file: truncated");
+
+    if ( method != 0 && method != Z_DEFLATED )
+      throw std::runtime_error("Unsupported zip compression method");
+
+    StreamParser parser(genome, report);
+
+    inflate_checked(parser, report, [&]() {
+      if ( method == 0 )
+        parser.feed(data + start, compressed_size);
+      else
+        inflate_into(data + start, compressed_size, -MAX_WBITS, parser);
+    });
+    return;
+  }
+
+  throw std::runtime_error("Zip file contains no files");
+}
+
+} // namespace arv
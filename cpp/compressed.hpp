@@ -0,0 +1,37 @@
+/*
+ * arv
+ * Copyright 2017 Christian Stigen Larsen
+ * Distributed under the GNU GPL v3 or later. See COPYING.
+ */
+
+#ifndef ARV_COMPRESSED_HPP
+#define ARV_COMPRESSED_HPP
+
+#include <cstddef>
+
+#include "arv.hpp"
+
+namespace arv {
+
+bool is_gzip(const char* data, const std::size_t size);
+bool is_zip(const char* data, const std::size_t size);
+
+/*!
+ * Decompresses gzip data into a small buffer, parsing it as it goes.
+ * Concatenated gzip members are supported. Given a report, the lines are
+ * validated and truncated data is reported instead of thrown.
+ */
+void parse_gzip(const char* data, const std::size_t size, Genome&,
+    ParseReport* report = NULL);
+
+/*!
+ * Decompresses the first file in a zip archive into a small buffer, parsing
+ * it as it goes. Supports stored and deflated files. See parse_gzip for the
+ * report.
+ */
+void parse_zip(const char* data, const std::size_t size, Genome&,
+    ParseReport* report = NULL);
+
+} // namespace arv
+
+#endif // guard
@@ -12,13 +12,14 @@
 
 #include <unistd.h>
 #include <fcntl.h>
+#include <sys/mman.h>
 #include <stdexcept>
 #include <string>
 
 namespace arv {
 
-File::File(const char* filename, const int flags):
-  fd(open(filename, flags, S_IRUSR))
+File::File(const char* filename, const int flags, const int mode):
+  fd(open(filename, flags, mode))
 {
   if ( fd < 0 ) {
     std::string msg = "Could not open ";
@@ -30,4 +31,17 @@ File::~File() {
   close(fd);
 }
 
+SharedFile::SharedFile(const char* name, const int flags, const int mode):
+  fd(shm_open(name, flags, mode))
+{
+  if ( fd < 0 ) {
+    std::string msg = "Could not open shared memory ";
+    throw std::runtime_error((msg + name).c_str());
+  }
+}
+
+SharedFile::~SharedFile() {
+  close(fd);
+}
+
 } // ns arv
@@ -11,12 +11,14 @@
 #ifndef ARV_FILE_HPP
 #define ARV_FILE_HPP
 
+#include <sys/stat.h>
+
 namespace arv {
 
 class File {
   int fd;
 public:
-  File(const char* filename, const int flags);
+  File(const char* filename, const int flags, const int mode = S_IRUSR);
   ~File();
 
   inline operator int() const {
@@ -24,6 +26,21 @@ public:
   }
 };
 
+/*!
+ * A POSIX shared memory object, opened with shm_open. The object itself is
+ * not removed when closed; see unlink_shared.
+ */
+class SharedFile {
+  int fd;
+public:
+  SharedFile(const char* name, const int flags, const int mode = S_IRUSR);
+  ~SharedFile();
+
+  inline operator int() const {
+    return fd;
+  }
+};
+
 } // ns arv
 
 #endif // guard
@@ -0,0 +1,196 @@
+/*
+ * arv
+ * Copyright 2017 Christian Stigen Larsen
+ * Distributed under the GNU GPL v3 or later. See COPYING.
+ *
+ * Fuzz target for the parser. Build it with libFuzzer and run it on some
+ * genome files:
+ *
+ *   clang++ -g -O1 -std=c++11 -fsanitize=fuzzer,address,undefined -Icpp \
+ *     cpp/fuzz_parse.cpp cpp/arv.cpp cpp/binary.cpp cpp/compressed.cpp \
+ *     cpp/file.cpp cpp/filesize.cpp cpp/mmap.cpp cpp/parse.cpp \
+ *     cpp/scan.cpp cpp/storage.cpp -lz -lrt -pthread -o fuzz_parse
+ *   ./fuzz_parse corpus/ tests/fake_genome.txt
+ *
+ * Without clang, define ARV_FUZZ_MAIN to get a simple driver that mutates
+ * the given files at random:
+ *
+ *   g++ -g -O1 -std=c++11 -fsanitize=address,undefined -DARV_FUZZ_MAIN ...
+ *   ./fuzz_parse tests/fake_genome.txt tests/fake_genome_female.txt
+ *
+ * Each input is parsed with every supported scanner, normally and while
+ * validating. The target aborts if the scanners disagree or a report does
+ * not add up, and the sanitizers catch any reads past the input. Threads are
+ * covered by the tests, as inputs need to be large to be split.
+ */
+
+#include <cstdint>
+#include <cstdio>
+#include <cstdlib>
+#include <stdexcept>
+#include <vector>
+
+#include "arv.hpp"
+#include "compressed.hpp"
+#include "scan.hpp"
+
+using namespace arv;
+
+static void check(const bool condition, const char* message)
+{
+  if ( !condition ) {
+    fprintf(stderr, "fuzz_parse: %s\n", message);
+    abort();
+  }
+}
+
+static bool same_report(const ParseReport& a, const ParseReport& b)
+{
+  if ( a.lines != b.lines || a.snps != b.snps || a.comments != b.comments ||
+       a.blanks != b.blanks || a.issues.size() != b.issues.size() )
+    return false;
+
+  for ( std::size_t n = 0; n < ERROR_KINDS; ++n )
+    if ( a.errors[n] != b.errors[n] )
+      return false;
+
+  for ( std::size_t n = 0; n < a.issues.size(); ++n )
+    if ( a.issues[n].line != b.issues[n].line ||
+         a.issues[n].error != b.issues[n].error ||
+         a.issues[n].text != b.issues[n].text )
+      return false;
+
+  return true;
+}
+
+extern "C" int LLVMFuzzerTestOneInput(const std::uint8_t* data,
+    std::size_t size)
+{
+  // An exactly sized copy, so reading past the end is caught
+  char* input = static_cast<char*>(malloc(size > 0 ? size : 1));
+  memcpy(input, data, size);
+
+  const bool compressed = is_gzip(input, size) || is_zip(input, size);
+  bool first = true;
+  Genome expected(0);
+  Genome expected_strict(0);
+  ParseReport expected_report;
+
+  for ( int s = SCANNER_SCALAR; s <= SCANNER_AVX2; ++s ) {
+    const Scanner scanner = static_cast<Scanner>(s);
+    if ( !scanner_supported(scanner) )
+      continue;
+    set_scanner(scanner);
+
+    Genome genome(0);
+    Genome strict(0);
+    ParseReport report;
+
+    try {
+      parse_buffer(input, size, genome);
+      parse_buffer(input, size, strict, 1, &report);
+    } catch ( const std::runtime_error& ) {
+      // Only bad compressed data may throw
+      check(compressed, "uncompressed input threw");
+      break;
+    }
+
+    check(strict.size() <= report.snps, "more SNPs than reported");
+    check(report.issues.size() <= report.error_count(),
+        "more issues than errors");
+
+    // Truncated compressed data is an error without a line of its own
+    if ( !compressed )
+      check(report.snps + report.comments + report.blanks +
+          report.error_count() == report.lines, "report does not add up");
+
+    for ( GenomeIterator it = strict.begin(); it != strict.end(); it.next() )
+      check(it.value().second.chromosome != CHR_NO &&
+          it.value().second.chromosome <= CHR_MT,
+          "invalid chromosome accepted");
+
+    if ( first ) {
+      expected = genome;
+      expected_strict = strict;
+      expected_report = report;
+      first = false;
+    } else {
+      check(genome == expected, "scanners disagree");
+      check(strict == expected_strict, "scanners disagree when validating");
+      check(same_report(report, expected_report), "reports differ");
+    }
+  }
+
+  set_scanner(best_scanner());
+  free(input);
+  return 0;
+}
+
+#ifdef ARV_FUZZ_MAIN
+#include <fstream>
+#include <iterator>
+#include <random>
+
+static std::vector<char> mutate(std::vector<char> data, std::mt19937& random)
+{
+  static const char CHARS[] = "\t\n\r 0123456789rsiXYMTACGTDI-#";
+  const std::size_t mutations = 1 + random() % 8;
+
+  for ( std::size_t n = 0; n < mutations && !data.empty(); ++n ) {
+    const std::size_t pos = random() % data.size();
+
+    switch ( random() % 4 ) {
+      case 0:
+        data[pos] = CHARS[random() % (sizeof(CHARS) - 1)];
+        break;
+      case 1:
+        data[pos] = static_cast<char>(random());
+        break;
+      case 2:
+        data.insert(data.begin() + pos, CHARS[random() % (sizeof(CHARS) - 1)]);
+        break;
+      default:
+        data.erase(data.begin() + pos);
+        break;
+    }
+  }
+
+  // Sometimes cut it short
+  if ( random() % 4 == 0 && !data.empty() )
+    data.resize(random() % data.size());
+
+  return data;
+}
+
+int main(int argc, char** argv)
+{
+  if ( argc < 2 ) {
+    fprintf(stderr, "Usage: %s file ... [iterations]\n", argv[0]);
+    return 1;
+  }
+
+  std::vector<std::vector<char> > seeds;
+  unsigned long iterations = 10000;
+
+  for ( int n = 1; n < argc; ++n ) {
+    std::ifstream file(argv[n], std::ios::binary);
+    if ( !file ) {
+      iterations = strtoul(argv[n], NULL, 10);
+      continue;
+    }
+    seeds.push_back(std::vector<char>(std::istreambuf_iterator<char>(file),
+          std::istreambuf_iterator<char>()));
+  }
+
+  std::mt19937 random(1);
+
+  for ( unsigned long n = 0; n < iterations && !seeds.empty(); ++n ) {
+    const std::vector<char> data = mutate(seeds[n % seeds.size()], random);
+    LLVMFuzzerTestOneInput(reinterpret_cast<const std::uint8_t*>(
+          data.empty() ? "" : &data[0]), data.size());
+  }
+
+  printf("%lu inputs ok\n", iterations);
+  return 0;
+}
+#endif
@@ -8,10 +8,22 @@
  * Distributed under the GNU GPL V3 or later. See COPYING.
  */
 
+#include <algorithm>
+#include <atomic>
+#include <cstdint>
+#include <cstring>
+#include <exception>
+#include <functional>
+#include <stdexcept>
+#include <thread>
+#include <vector>
+
 #include "arv.hpp"
+#include "compressed.hpp"
 #include "file.hpp"
 #include "filesize.hpp"
 #include "mmap.hpp"
+#include "scan.hpp"
 
 #ifdef __GNUC__
 #define likely(x)   __builtin_expect((x),1)
@@ -23,55 +35,69 @@
 
 namespace arv {
 
-static Nucleotide CharToNucleotide[256] = {NONE};
+struct NucleotideTable {
+  Nucleotide table[256];
 
-static void skip_comments(const char*& s)
-{
-  while ( *s == '#' )
-    while ( *s++ != '\n' )
-      ; // loop
-}
+  NucleotideTable()
+  {
+    for ( std::size_t n = 0; n < 256; ++n )
+      table[n] = NONE;
+
+    table[static_cast<unsigned char>('A')] = A;
+    table[static_cast<unsigned char>('C')] = C;
+    table[static_cast<unsigned char>('D')] = D;
+    table[static_cast<unsigned char>('G')] = G;
+    table[static_cast<unsigned char>('I')] = I;
+    table[static_cast<unsigned char>('T')] = T;
+  }
+};
+
+static const NucleotideTable CharToNucleotide;
 
 static bool iswhite(const char c)
 {
   return c=='\t' || c=='\n' || c=='\r';
 }
 
-static const char*& skipwhite(const char*& s)
+static const char*& skipwhite(const char*& s, const char* end)
 {
-  while ( iswhite(*s) ) ++s;
+  while ( s < end && iswhite(*s) ) ++s;
   return s;
 }
 
-static uint32_t parse_uint32(const char*& s)
+static uint32_t parse_uint32(const char*& s, const char* end)
 {
   uint32_t n = 0;
 
-  while ( isdigit(*s) )
+  while ( s < end && isdigit(*s) )
     n = n*10 - '0' + *s++;
 
   return n;
 }
 
-static int32_t parse_int32(const char*& s)
+static int32_t parse_int32(const char*& s, const char* end)
 {
-  int32_t n = 0;
-
-  while ( isdigit(*s) )
-    n = n*10 - '0' + *s++;
-
-  return n;
+  // Wraps around on overflow, which would be undefined for signed integers
+  return static_cast<int32_t>(parse_uint32(s, end));
 }
 
-static Nucleotide parse_nucleotide(const char*& s)
+static Nucleotide parse_nucleotide(const char*& s, const char* end)
 {
-  return CharToNucleotide[static_cast<short>(*s++)];
+  if ( unlikely(s >= end) )
+    return NONE;
+
+  return CharToNucleotide.table[static_cast<unsigned char>(*s++)];
 }
 
-static Chromosome parse_chromo(const char*& s)
+static Chromosome parse_chromo(const char*& s, const char* end)
 {
-  if ( likely(isdigit(*s)) )
-      return static_cast<Chromosome>(parse_uint32(s));
+  if ( unlikely(s >= end) )
+    return CHR_NO;
+
+  if ( likely(isdigit(*s)) ) {
+    const uint32_t n = parse_uint32(s, end);
+    return n <= CHR_MT ? static_cast<Chromosome>(n) : CHR_NO;
+  }
 
   const char c = *s++;
 
@@ -79,7 +105,7 @@ static Chromosome parse_chromo(const char*& s)
     return CHR_X;
 
   if ( c == 'M' ) {
-    ++s; // skip T in "MT"
+    if ( s < end ) ++s; // skip T in "MT"
     return CHR_MT;
   }
 
@@ -89,88 +115,1025 @@ static Chromosome parse_chromo(const char*& s)
   return CHR_NO;
 }
 
-static Genotype parse_genotype(const char*& s)
+static Genotype parse_genotype(const char*& s, const char* end)
 {
-  const Nucleotide first = parse_nucleotide(s);
-  const Nucleotide second = parse_nucleotide(s);
+  const Nucleotide first = parse_nucleotide(s, end);
+
+  // Y-chromosome and MT genotypes only have a single nucleotide, so don't
+  // consume the line ending.
+  if ( s >= end || iswhite(*s) || *s == '\0' )
+    return Genotype(first, NONE);
+
+  const Nucleotide second = parse_nucleotide(s, end);
   return Genotype(first, second);
 }
 
-static void skipline(const char*& s)
+static void skipline(const char*& s, const char* end)
+{
+  while ( s < end && *s != '\n' ) ++s;
+}
+
+static void skip_comments(const char*& s, const char* end)
 {
-  while ( *s != '\n' ) ++s;
+  while ( s < end && *s == '#' ) {
+    skipline(s, end);
+    if ( s < end ) ++s;
+  }
 }
 
 /**
- * Reads a 23andMe-formatted genome file.  It currently uses reference human
- * assembly build 37 (annotation release 104).
+ * Parses the line starting at s into out. Returns false if the line does not
+ * hold a SNP (comments, blank lines and so on). In either case, s is left at
+ * the line's terminating newline, or at end.
  */
-void parse_file(const std::string& name, Genome& genome)
+static bool parse_line(const char*& s, const char* end, RsidSNP& out)
 {
-  using namespace arv;
+  bool internal = false; // rsid or internal id
 
-  CharToNucleotide[static_cast<short>('-')] = NONE;
-  CharToNucleotide[static_cast<short>('A')] = A;
-  CharToNucleotide[static_cast<short>('C')] = C;
-  CharToNucleotide[static_cast<short>('D')] = D;
-  CharToNucleotide[static_cast<short>('G')] = G;
-  CharToNucleotide[static_cast<short>('I')] = I;
-  CharToNucleotide[static_cast<short>('T')] = T;
+  if ( *s == 'r' )
+    internal = false;
+  else if ( *s == 'i' )
+    internal = true;
+  else {
+    skipline(s, end);
+    return false;
+  }
 
-  File fd(name.c_str(), O_RDONLY);
-  MMap fmap(0, filesize(fd), PROT_READ, MAP_PRIVATE, fd, 0);
-  auto s = fmap.c_str();
+  RSID& rsid = out.first;
+  SNP& snp = out.second;
 
-  skip_comments(s);
+  // Skip i/rs prefix and parse number
+  if ( !internal )
+    rsid = parse_int32(s += 2, end);
+  else
+    rsid = -parse_int32(s += 1, end);
 
-  // Local cache of SNPs and RSIDs, for more locality and hence more speed. Its
-  // size is somewhat arbitrary, but shouldn't be too big.
-  const std::size_t BUFFER_SIZE = 200;
-  RsidSNP buffer[BUFFER_SIZE];
-  size_t buffer_pos = 0;
+  snp.chromosome = parse_chromo(skipwhite(s, end), end);
+  snp.position = parse_uint32(skipwhite(s, end), end);
+  snp.genotype = parse_genotype(skipwhite(s, end), end);
 
-  bool internal = false; // rsid or internal id
+  skipline(s, end);
+  return true;
+}
 
-  for ( ; *s; ++s ) {
-    if ( *s == 'r' )
-      internal = false;
-    else if ( *s == 'i' )
-      internal = true;
+/**
+ * Finds the tabs and newlines of a buffer in bulk, 64 bytes at a time, and
+ * hands them out one by one.
+ */
+class SeparatorIndex {
+  const SeparatorMask mask_of;
+  const char* end;
+  const char* block;
+  std::uint64_t block_mask;
+  std::uint64_t pending;
+
+  void load(const char* s)
+  {
+    block = s;
+
+    if ( end - s >= 64 )
+      block_mask = mask_of(s);
     else {
-      skipline(s);
-      continue;
+      char tail[64];
+      memset(tail, 0, sizeof(tail));
+      memcpy(tail, s, end - s);
+      block_mask = mask_of(tail);
     }
+  }
 
-    RSID& rsid = buffer[buffer_pos].first;
-    SNP& snp = buffer[buffer_pos].second;
+public:
+  SeparatorIndex(const SeparatorMask f, const char* s, const char* e) :
+    mask_of(f),
+    end(e),
+    block(s),
+    block_mask(0),
+    pending(0)
+  {
+    if ( s < end )
+      load(s);
+    pending = block_mask;
+  }
 
-    // Skip i/rs prefix and parse number
-    if ( !internal )
-      rsid = parse_int32(s += 2);
+  /**
+   * Returns the next tab or newline, or end if there are no more.
+   */
+  inline const char* pop()
+  {
+    while ( pending == 0 ) {
+      if ( block + 64 >= end )
+        return end;
+      load(block + 64);
+      pending = block_mask;
+    }
+
+    const char* p = block + __builtin_ctzll(pending);
+    pending &= pending - 1;
+    return p;
+  }
+
+  /**
+   * Continues from s, which must not be before the current block.
+   */
+  void seek(const char* s)
+  {
+    if ( s >= end ) {
+      pending = 0;
+      block = end;
+      return;
+    }
+
+    if ( s >= block + 64 )
+      load(block + (s - block) / 64 * 64);
+
+    pending = block_mask & (~static_cast<std::uint64_t>(0) << (s - block));
+  }
+};
+
+static inline bool is_digit(const char c)
+{
+  return static_cast<unsigned char>(c - '0') < 10;
+}
+
+static bool parse_chromo_field(const char* s, const std::size_t length,
+    Chromosome& out)
+{
+  if ( length == 1 ) {
+    if ( is_digit(s[0]) )
+      out = static_cast<Chromosome>(s[0] - '0');
+    else if ( s[0] == 'X' )
+      out = CHR_X;
+    else if ( s[0] == 'Y' )
+      out = CHR_Y;
     else
-      rsid = -parse_int32(s += 1);
+      return false;
+  } else if ( length == 2 ) {
+    if ( is_digit(s[0]) && is_digit(s[1]) ) {
+      const int n = 10*(s[0] - '0') + s[1] - '0';
+      out = n <= CHR_MT ? static_cast<Chromosome>(n) : CHR_NO;
+    }
+    else if ( s[0] == 'M' && s[1] == 'T' )
+      out = CHR_MT;
+    else
+      return false;
+  } else
+    return false;
+
+  return true;
+}
+
+static inline bool is_genotype_char(const char c)
+{
+  return c == '-' || CharToNucleotide.table[static_cast<unsigned char>(c)] !=
+    NONE;
+}
 
-    snp.chromosome = parse_chromo(skipwhite(s));
-    snp.position = parse_uint32(skipwhite(s));
-    snp.genotype = parse_genotype(skipwhite(s));
+/**
+ * Parses a line of the usual form "rs123<TAB>1<TAB>456<TAB>AG", with an
+ * optional CR before the newline, taking its fields from the separator index.
+ * Returns false without moving s for anything else, which is left to
+ * parse_line. Otherwise s is left at the terminating newline, or at end.
+ *
+ * When strict, it also returns false for anything validate_line would not
+ * accept, so that only valid lines take the fast path.
+ */
+template <bool strict>
+static bool parse_line_bulk(const char*& s, const char* end,
+    SeparatorIndex& index, RsidSNP& out)
+{
+  bool internal;
+  const char* id;
 
-    genome.y_chromosome |= (snp.chromosome == CHR_Y && snp.genotype.first !=
+  if ( s[0] == 'r' && end - s > 1 && s[1] == 's' ) {
+    internal = false;
+    id = s + 2;
+  } else if ( s[0] == 'i' ) {
+    internal = true;
+    id = s + 1;
+  } else
+    return false;
+
+  const char* tab1 = index.pop();
+  if ( tab1 == end || *tab1 != '\t' )
+    return false;
+
+  const char* tab2 = index.pop();
+  if ( tab2 == end || *tab2 != '\t' )
+    return false;
+
+  const char* tab3 = index.pop();
+  if ( tab3 == end || *tab3 != '\t' )
+    return false;
+
+  const char* eol = index.pop();
+  if ( eol != end && *eol != '\n' )
+    return false;
+
+  std::uint32_t rsid, position;
+  Chromosome chromosome;
+
+  if ( !parse_digits(id, tab1 - id, end, rsid) ||
+       !parse_chromo_field(tab1 + 1, tab2 - tab1 - 1, chromosome) ||
+       !parse_digits(tab2 + 1, tab3 - tab2 - 1, end, position) )
+    return false;
+
+  // Ten digit numbers may have wrapped around, but compare like strings
+  if ( strict && ((tab1 - id == 10 && memcmp(id, "2147483647", 10) > 0) ||
+                  (tab3 - tab2 == 11 && memcmp(tab2 + 1, "4294967295", 10) >
+                   0) ||
+                  rsid == 0 || chromosome == CHR_NO) )
+    return false;
+
+  const char* genotype = tab3 + 1;
+  const char* stop = eol;
+  if ( stop > genotype && stop[-1] == '\r' )
+    --stop;
+
+  const std::size_t length = stop - genotype;
+  if ( length < 1 || length > 2 || genotype[0] == '\r' ||
+       genotype[length - 1] == '\r' )
+    return false;
+
+  if ( strict && (!is_genotype_char(genotype[0]) ||
+                  !is_genotype_char(genotype[length - 1])) )
+    return false;
+
+  out.first = internal ? -static_cast<RSID>(rsid) : static_cast<RSID>(rsid);
+  out.second.chromosome = chromosome;
+  out.second.position = position;
+  out.second.genotype = Genotype(
+      CharToNucleotide.table[static_cast<unsigned char>(genotype[0])],
+      length == 2 ?
+        CharToNucleotide.table[static_cast<unsigned char>(genotype[1])] :
         NONE);
 
+  s = eol;
+  return true;
+}
+
+/**
+ * Calls emit with each SNP in [s, end), finding the fields with the current
+ * scanner. Stops after limit SNPs, returning the start of the next line, or
+ * end if it got there.
+ */
+template <typename Function>
+static const char* parse_lines(const char* s, const char* end, Function emit,
+    std::size_t limit = SIZE_MAX)
+{
+  const SeparatorMask mask = separator_mask(get_scanner());
+  RsidSNP record;
+
+  if ( mask == NULL ) {
+    for ( ; s < end; ++s )
+      if ( parse_line(s, end, record) ) {
+        emit(record);
+        if ( unlikely(--limit == 0) )
+          return s < end ? s + 1 : end;
+      }
+    return end;
+  }
+
+  SeparatorIndex index(mask, s, end);
+
+  for ( ; s < end; ++s ) {
+    if ( likely(parse_line_bulk<false>(s, end, index, record)) )
+      emit(record);
+    else {
+      const bool found = parse_line(s, end, record);
+      if ( found )
+        emit(record);
+      index.seek(s + 1);
+      if ( !found )
+        continue;
+    }
+
+    if ( unlikely(--limit == 0) )
+      return s < end ? s + 1 : end;
+  }
+
+  return end;
+}
+
+enum LineKind {
+  LINE_SNP,
+  LINE_COMMENT,
+  LINE_BLANK,
+  LINE_ERROR
+};
+
+/**
+ * Parses the decimal number in [s, end) into value, failing with the error
+ * if it is empty, has anything but digits or is larger than max.
+ */
+static bool parse_number(const char* s, const char* end,
+    const std::uint64_t max, std::uint64_t& value, ParseError& error)
+{
+  if ( s == end ) {
+    error = ERROR_MALFORMED;
+    return false;
+  }
+
+  std::uint64_t n = 0;
+  bool overflow = false;
+
+  for ( ; s < end; ++s ) {
+    if ( !is_digit(*s) ) {
+      error = ERROR_MALFORMED;
+      return false;
+    }
+
+    n = n*10 + (*s - '0');
+    if ( n > max ) {
+      overflow = true;
+      n = max; // keep going, non-digits take precedence
+    }
+  }
+
+  if ( overflow ) {
+    error = ERROR_OVERFLOW;
+    return false;
+  }
+
+  value = n;
+  return true;
+}
+
+/**
+ * Strictly checks and parses the line [s, eol), which excludes the newline.
+ * Returns LINE_ERROR and sets error for anything but a comment, a blank line
+ * or a SNP line of exactly four well-formed fields.
+ */
+static LineKind validate_line(const char* s, const char* eol, RsidSNP& out,
+    ParseError& error)
+{
+  const char* stop = eol;
+  if ( stop > s && stop[-1] == '\r' )
+    --stop;
+
+  if ( s == stop )
+    return LINE_BLANK;
+
+  if ( *s == '#' )
+    return LINE_COMMENT;
+
+  const char* field[4];
+  const char* field_end[4];
+  std::size_t fields = 0;
+
+  for ( const char* p = s; ; ) {
+    const void* tab = memchr(p, '\t', stop - p);
+    const char* next = tab != NULL ? static_cast<const char*>(tab) : stop;
+
+    if ( fields == 4 ) {
+      error = ERROR_MALFORMED;
+      return LINE_ERROR;
+    }
+
+    field[fields] = p;
+    field_end[fields] = next;
+    ++fields;
+
+    if ( next == stop )
+      break;
+    p = next + 1;
+  }
+
+  if ( fields != 4 ) {
+    error = ERROR_MALFORMED;
+    return LINE_ERROR;
+  }
+
+  // RSID, given as rs<digits> or i<digits> for internal IDs
+  const char* id = field[0];
+  const std::size_t id_length = field_end[0] - id;
+  bool internal;
+
+  if ( id_length >= 2 && id[0] == 'r' && id[1] == 's' ) {
+    internal = false;
+    id += 2;
+  } else if ( id_length >= 1 && id[0] == 'i' ) {
+    internal = true;
+    id += 1;
+  } else {
+    error = ERROR_MALFORMED;
+    return LINE_ERROR;
+  }
+
+  std::uint64_t rsid;
+  if ( !parse_number(id, field_end[0], INT32_MAX, rsid, error) )
+    return LINE_ERROR;
+
+  if ( rsid == 0 ) {
+    error = ERROR_MALFORMED;
+    return LINE_ERROR;
+  }
+
+  // Chromosome
+  const char* chromo = field[1];
+  const std::size_t chromo_length = field_end[1] - chromo;
+  Chromosome chromosome;
+
+  if ( chromo_length == 0 ) {
+    error = ERROR_MALFORMED;
+    return LINE_ERROR;
+  }
+
+  if ( is_digit(chromo[0]) ) {
+    std::uint64_t n;
+    if ( !parse_number(chromo, field_end[1], CHR_MT, n, error) || n == 0 ) {
+      error = ERROR_UNKNOWN_CHROMOSOME;
+      return LINE_ERROR;
+    }
+    chromosome = static_cast<Chromosome>(n);
+  } else if ( !parse_chromo_field(chromo, chromo_length, chromosome) ) {
+    error = ERROR_UNKNOWN_CHROMOSOME;
+    return LINE_ERROR;
+  }
+
+  // Position
+  std::uint64_t position;
+  if ( !parse_number(field[2], field_end[2], UINT32_MAX, position, error) )
+    return LINE_ERROR;
+
+  // Genotype, one or two nucleotides
+  const char* genotype = field[3];
+  const std::size_t length = field_end[3] - genotype;
+
+  if ( length < 1 || length > 2 || !is_genotype_char(genotype[0]) ||
+       !is_genotype_char(genotype[length - 1]) ) {
+    error = ERROR_INVALID_GENOTYPE;
+    return LINE_ERROR;
+  }
+
+  out.first = internal ? -static_cast<RSID>(rsid) : static_cast<RSID>(rsid);
+  out.second.chromosome = chromosome;
+  out.second.position = static_cast<std::uint32_t>(position);
+  out.second.genotype = Genotype(
+      CharToNucleotide.table[static_cast<unsigned char>(genotype[0])],
+      length == 2 ?
+        CharToNucleotide.table[static_cast<unsigned char>(genotype[1])] :
+        NONE);
+
+  return LINE_SNP;
+}
+
+/**
+ * Like parse_lines, but validates each line and tallies them in the report.
+ * Valid lines take the strict bulk path, while the rest are classified by
+ * validate_line. A valid SNP on a last line without a newline is counted
+ * like any other, as parse_lines accepts it too, while other lines without
+ * a newline are reported as truncated.
+ */
+template <typename Function>
+static void validate_lines(const char* s, const char* end,
+    ParseReport& report, Function emit)
+{
+  const SeparatorMask mask = separator_mask(get_scanner());
+  const bool bulk = mask != NULL;
+
+  // The index is not used with the scalar scanner
+  SeparatorIndex index(bulk ? mask : separator_mask(SCANNER_SWAR), s,
+      bulk ? end : s);
+  RsidSNP record;
+
+  // Count in locals, as emit may touch any memory
+  std::size_t line = report.lines;
+  std::size_t snps = 0;
+
+  for ( ; s < end; ++s ) {
+    ++line;
+
+    if ( bulk && likely(parse_line_bulk<true>(s, end, index, record)) ) {
+      ++snps;
+      emit(record);
+      continue;
+    }
+
+    const void* newline = memchr(s, '\n', end - s);
+    const char* eol = newline != NULL ? static_cast<const char*>(newline) :
+      end;
+    ParseError error = ERROR_MALFORMED;
+
+    switch ( validate_line(s, eol, record, error) ) {
+      case LINE_SNP:
+        ++snps;
+        emit(record);
+        break;
+      case LINE_COMMENT:
+        ++report.comments;
+        break;
+      case LINE_BLANK:
+        ++report.blanks;
+        break;
+      case LINE_ERROR:
+        report.add(eol != end ? error : ERROR_TRUNCATED, line, s, eol);
+        break;
+    }
+
+    s = eol;
+    if ( bulk )
+      index.seek(s + 1);
+  }
+
+  report.lines = line;
+  report.snps += snps;
+}
+
+static bool is_y_chromosome(const SNP& snp)
+{
+  return snp.chromosome == CHR_Y && snp.genotype.first != NONE;
+}
+
+/**
+ * Parses all lines in [s, end) directly into the genome, validating them if
+ * given a report.
+ */
+static void parse_range(const char* s, const char* end, Genome& genome,
+    ParseReport* report = NULL)
+{
+  // Local cache of SNPs and RSIDs, for more locality and hence more speed. Its
+  // size is somewhat arbitrary, but shouldn't be too big.
+  const std::size_t BUFFER_SIZE = 200;
+  RsidSNP buffer[BUFFER_SIZE];
+  size_t buffer_pos = 0;
+
+  auto emit = [&](const RsidSNP& record) {
+    genome.y_chromosome |= is_y_chromosome(record.second);
+
     // Ordinarly, we would just call `genome.insert(rsid, snp)` here, but it's
     // a tad faster to stage them in an array first, and then flush it to the
     // hash map when it's full.
 
+    buffer[buffer_pos] = record;
+
     if ( ++buffer_pos == BUFFER_SIZE ) {
       buffer_pos = 0;
       for ( size_t n = 0; n < BUFFER_SIZE; ++n )
         genome.insert(buffer[n]);
     }
-  }
+  };
+
+  if ( report != NULL )
+    validate_lines(s, end, *report, emit);
+  else
+    parse_lines(s, end, emit);
 
   // Store the rest of the buffer
   for ( size_t n = 0; n < buffer_pos; ++n )
     genome.insert(buffer[n]);
 }
 
+/**
+ * The result of parsing one chunk of a file on a separate thread.
+ */
+struct Chunk {
+  const char* begin;
+  const char* end;
+  std::vector<RsidSNP> snps;
+  bool y_chromosome;
+  bool validate;
+  ParseReport report;
+  std::exception_ptr error;
+
+  Chunk(const char* b, const char* e, const ParseReport* r) :
+    begin(b),
+    end(e),
+    snps(),
+    y_chromosome(false),
+    validate(r != NULL),
+    report(r != NULL ? r->max_issues : 0),
+    error()
+  {
+  }
+
+  void parse()
+  {
+    try {
+      // A typical line is a bit more than 20 bytes long
+      snps.reserve((end - begin) / 20);
+
+      auto emit = [this](const RsidSNP& record) {
+        y_chromosome |= is_y_chromosome(record.second);
+        snps.push_back(record);
+      };
+
+      if ( validate )
+        validate_lines(begin, end, report, emit);
+      else
+        parse_lines(begin, end, emit);
+    } catch ( ... ) {
+      error = std::current_exception();
+    }
+  }
+};
+
+/**
+ * Splits [s, end) into at most `count` chunks that all end on a line
+ * boundary.
+ */
+static std::vector<Chunk> split_lines(const char* s, const char* end,
+    const std::size_t count, const ParseReport* report)
+{
+  std::vector<Chunk> chunks;
+  const std::size_t length = end - s;
+
+  for ( std::size_t n = 1; n <= count && s < end; ++n ) {
+    const char* stop = end;
+
+    if ( n < count ) {
+      stop = s + length/count;
+      if ( stop >= end )
+        stop = end;
+      else {
+        const void* eol = memchr(stop, '\n', end - stop);
+        stop = eol != NULL ? static_cast<const char*>(eol) + 1 : end;
+      }
+    }
+
+    chunks.push_back(Chunk(s, stop, report));
+    s = stop;
+  }
+
+  return chunks;
+}
+
+/**
+ * Parses [s, end) on several threads and merges the results into the genome,
+ * and the reports of the chunks into the given one.
+ */
+static void parse_range_parallel(const char* s, const char* end,
+    Genome& genome, const std::size_t threads, ParseReport* report)
+{
+  std::vector<Chunk> chunks(split_lines(s, end, threads, report));
+  std::vector<std::thread> workers;
+  workers.reserve(chunks.size());
+
+  for ( std::size_t n = 1; n < chunks.size(); ++n )
+    workers.push_back(std::thread(&Chunk::parse, &chunks[n]));
+
+  // Put the calling thread to work as well
+  chunks[0].parse();
+
+  for ( std::size_t n = 0; n < workers.size(); ++n )
+    workers[n].join();
+
+  std::size_t total = genome.size();
+  for ( std::size_t n = 0; n < chunks.size(); ++n ) {
+    if ( chunks[n].error )
+      std::rethrow_exception(chunks[n].error);
+    total += chunks[n].snps.size();
+  }
+
+  // The hash map can only be filled from one thread, but we can at least
+  // make sure it doesn't have to grow while we do it.
+  genome.reserve(total);
+
+  for ( std::size_t n = 0; n < chunks.size(); ++n ) {
+    Chunk& chunk = chunks[n];
+    genome.y_chromosome |= chunk.y_chromosome;
+
+    if ( report != NULL )
+      report->append(chunk.report);
+
+    for ( std::size_t i = 0; i < chunk.snps.size(); ++i )
+      genome.insert(chunk.snps[i]);
+
+    std::vector<RsidSNP>().swap(chunk.snps);
+  }
+}
+
+ParseReport::ParseReport(const std::size_t max) :
+  lines(0),
+  snps(0),
+  comments(0),
+  blanks(0),
+  errors(),
+  issues(),
+  max_issues(max)
+{
+}
+
+std::size_t ParseReport::error_count() const
+{
+  std::size_t count = 0;
+  for ( std::size_t n = 0; n < ERROR_KINDS; ++n )
+    count += errors[n];
+  return count;
+}
+
+void ParseReport::add(const ParseError error, const std::size_t line,
+    const char* s, const char* end)
+{
+  // Keep the issues short, whatever the input
+  const std::size_t MAX_TEXT_LENGTH = 80;
+
+  ++errors[error];
+
+  if ( issues.size() < max_issues ) {
+    ParseIssue issue;
+    issue.line = line;
+    issue.error = error;
+    issue.text.assign(s, std::min<std::size_t>(end - s, MAX_TEXT_LENGTH));
+    issues.push_back(issue);
+  }
+}
+
+void ParseReport::append(const ParseReport& other)
+{
+  for ( std::size_t n = 0; n < other.issues.size() &&
+        issues.size() < max_issues; ++n ) {
+    issues.push_back(other.issues[n]);
+    issues.back().line += lines;
+  }
+
+  lines += other.lines;
+  snps += other.snps;
+  comments += other.comments;
+  blanks += other.blanks;
+
+  for ( std::size_t n = 0; n < ERROR_KINDS; ++n )
+    errors[n] += other.errors[n];
+}
+
+StreamParser::StreamParser(Genome& g, ParseReport* r) :
+  genome(g),
+  report(r),
+  partial()
+{
+}
+
+void StreamParser::feed(const char* data, const std::size_t size)
+{
+  const char* s = data;
+  const char* end = data + size;
+
+  // Complete the line left over from the previous chunk
+  if ( !partial.empty() ) {
+    const void* eol = memchr(s, '\n', size);
+
+    if ( eol == NULL ) {
+      append_partial(s, end);
+      return;
+    }
+
+    s = static_cast<const char*>(eol) + 1;
+    append_partial(data, s);
+    parse_range(&partial[0], &partial[0] + partial.size(), genome, report);
+    partial.clear();
+  }
+
+  // Parse all complete lines in place, keeping the rest for the next chunk
+  const char* last = end;
+  while ( last > s && last[-1] != '\n' )
+    --last;
+
+  parse_range(s, last, genome, report);
+  append_partial(last, end);
+}
+
+void StreamParser::finish()
+{
+  if ( !partial.empty() )
+    parse_range(&partial[0], &partial[0] + partial.size(), genome, report);
+
+  partial.clear();
+}
+
+void StreamParser::append_partial(const char* s, const char* end)
+{
+  // Lines are short, so don't let bad input make us buffer it all
+  const std::size_t MAX_LINE_LENGTH = 1 << 16;
+
+  if ( partial.size() + (end - s) > MAX_LINE_LENGTH )
+    throw std::runtime_error("Line too long");
+
+  partial.insert(partial.end(), s, end);
+}
+
+/**
+ * Reads a 23andMe-formatted genome file.  It currently uses reference human
+ * assembly build 37 (annotation release 104).
+ */
+void parse_file(const std::string& name, Genome& genome, std::size_t threads,
+    ParseReport* report)
+{
+  using namespace arv;
+
+  File fd(name.c_str(), O_RDONLY);
+  const std::size_t size = filesize(fd);
+  MMap fmap(0, size, PROT_READ, MAP_PRIVATE, fd, 0);
+  parse_buffer(fmap.c_str(), size, genome, threads, report);
+}
+
+void parse_buffer(const char* data, const std::size_t size, Genome& genome,
+    std::size_t threads, ParseReport* report)
+{
+  const char* s = data;
+  const char* end = s + size;
+
+  // Compressed files are decompressed and parsed on the fly
+  if ( is_gzip(data, size) ) {
+    parse_gzip(data, size, genome, report);
+    return;
+  }
+
+  if ( is_zip(data, size) ) {
+    parse_zip(data, size, genome, report);
+    return;
+  }
+
+  // Comments are counted when validating
+  if ( report == NULL )
+    skip_comments(s, end);
+
+  if ( threads == 0 )
+    threads = std::thread::hardware_concurrency();
+
+  // Threads only pay off if they each get a decent amount of work
+  const std::size_t MIN_CHUNK_SIZE = 1 << 20;
+  const std::size_t max_threads = 1 + (end - s) / MIN_CHUNK_SIZE;
+  if ( threads > max_threads )
+    threads = max_threads;
+
+  if ( threads > 1 )
+    parse_range_parallel(s, end, genome, threads, report);
+  else
+    parse_range(s, end, genome, report);
+}
+
+/**
+ * Parses the files one by one, picking the next unparsed file from a shared
+ * counter.
+ */
+static void parse_files_worker(const std::vector<std::string>& filenames,
+    const std::vector<Genome*>& genomes, std::atomic<std::size_t>& next,
+    std::vector<std::exception_ptr>& errors)
+{
+  for ( ;; ) {
+    const std::size_t n = next++;
+    if ( n >= filenames.size() )
+      break;
+
+    try {
+      parse_file(filenames[n], *genomes[n]);
+    } catch ( ... ) {
+      errors[n] = std::current_exception();
+    }
+  }
+}
+
+void parse_files(const std::vector<std::string>& filenames,
+    const std::vector<Genome*>& genomes, std::size_t workers)
+{
+  if ( filenames.size() != genomes.size() )
+    throw std::invalid_argument("Need exactly one genome per file");
+
+  if ( workers == 0 )
+    workers = std::thread::hardware_concurrency();
+  if ( workers > filenames.size() )
+    workers = filenames.size();
+  if ( workers == 0 )
+    workers = 1;
+
+  std::atomic<std::size_t> next(0);
+  std::vector<std::exception_ptr> errors(filenames.size());
+  std::vector<std::thread> pool;
+  pool.reserve(workers);
+
+  for ( std::size_t n = 1; n < workers; ++n )
+    pool.push_back(std::thread(parse_files_worker, std::cref(filenames),
+          std::cref(genomes), std::ref(next), std::ref(errors)));
+
+  parse_files_worker(filenames, genomes, next, errors);
+
+  for ( std::size_t n = 0; n < pool.size(); ++n )
+    pool[n].join();
+
+  // Report the first failing file, in input order
+  for ( std::size_t n = 0; n < errors.size(); ++n )
+    if ( errors[n] )
+      std::rethrow_exception(errors[n]);
+}
+
+std::size_t parse_snps(const char*& s, const char* end, RsidSNP* out,
+    const std::size_t max)
+{
+  if ( max == 0 )
+    return 0;
+
+  std::size_t count = 0;
+  s = parse_lines(s, end, [&](const RsidSNP& record) {
+    out[count++] = record;
+  }, max);
+
+  return count;
+}
+
+bool parse_rsid(const char* s, const std::size_t length, RSID& rsid)
+{
+  const char* end = s + length;
+  bool internal;
+
+  if ( length >= 2 && s[0] == 'r' && s[1] == 's' ) {
+    internal = false;
+    s += 2;
+  } else if ( length >= 1 && s[0] == 'i' ) {
+    internal = true;
+    s += 1;
+  } else
+    return false;
+
+  std::uint64_t value;
+  ParseError error;
+  if ( !parse_number(s, end, INT32_MAX, value, error) )
+    return false;
+
+  rsid = internal ? -static_cast<RSID>(value) : static_cast<RSID>(value);
+  return true;
+}
+
+ShardIndex::ShardIndex() :
+  lines()
+{
+}
+
+/**
+ * The chromosome in the second field of the line [s, eol), or CHR_NO if
+ * there is none.
+ */
+static Chromosome line_chromosome(const char* s, const char* eol)
+{
+  const void* tab = memchr(s, '\t', eol - s);
+  if ( tab == NULL )
+    return CHR_NO;
+
+  const char* field = static_cast<const char*>(tab) + 1;
+  const char* stop = field;
+  while ( stop < eol && !iswhite(*stop) )
+    ++stop;
+
+  Chromosome chromosome;
+  if ( !parse_chromo_field(field, stop - field, chromosome) )
+    return CHR_NO;
+
+  return chromosome;
+}
+
+void index_shards(const char* data, const std::size_t size,
+    ShardIndex& index)
+{
+  const char* s = data;
+  const char* end = data + size;
+
+  // The run of lines with the same chromosome so far
+  const char* run = NULL;
+  Chromosome current = CHR_NO;
+
+  for ( ; s < end; ++s ) {
+    const void* newline = memchr(s, '\n', end - s);
+    const char* eol = newline != NULL ? static_cast<const char*>(newline) :
+      end;
+
+    // Comments and blank lines are left in the runs, for fewer ranges
+    if ( *s == 'r' || *s == 'i' ) {
+      const Chromosome chromosome = line_chromosome(s, eol);
+
+      if ( run == NULL || chromosome != current ) {
+        if ( run != NULL ) {
+          const ByteRange range = {
+            static_cast<std::size_t>(run - data),
+            static_cast<std::size_t>(s - data)
+          };
+          index.ranges[current].push_back(range);
+        }
+
+        run = s;
+        current = chromosome;
+      }
+
+      ++index.lines[chromosome];
+    }
+
+    s = eol;
+  }
+
+  if ( run != NULL ) {
+    const ByteRange range = {
+      static_cast<std::size_t>(run - data),
+      size
+    };
+    index.ranges[current].push_back(range);
+  }
+}
+
+void parse_shard(const char* data, const ShardIndex& index,
+    const Chromosome chromosome, Genome& genome)
+{
+  const std::vector<ByteRange>& ranges = index.ranges[chromosome];
+
+  genome.reserve(genome.size() + index.lines[chromosome]);
+
+  for ( std::size_t n = 0; n < ranges.size(); ++n )
+    parse_range(data + ranges[n].begin, data + ranges[n].end, genome);
+}
+
 } // namespace arv
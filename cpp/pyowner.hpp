@@ -0,0 +1,40 @@
+/*
+ * arv
+ * Copyright 2017 Christian Stigen Larsen
+ * Distributed under the GNU GPL v3 or later. See COPYING.
+ */
+
+#ifndef ARV_PYOWNER_HPP
+#define ARV_PYOWNER_HPP
+
+#include <Python.h>
+#include <memory>
+
+namespace arv {
+
+/*!
+ * Releases a Python object, taking the GIL since the last owner may be
+ * dropped by a thread that doesn't hold it.
+ */
+struct PyObjectRelease {
+  void operator()(const void* object) const
+  {
+    PyGILState_STATE state = PyGILState_Ensure();
+    Py_DECREF(static_cast<PyObject*>(const_cast<void*>(object)));
+    PyGILState_Release(state);
+  }
+};
+
+/*!
+ * Keeps a Python object, e.g. one holding a buffer that a genome uses in
+ * place, alive for as long as the returned pointer or any copy of it.
+ */
+inline std::shared_ptr<const void> python_owner(PyObject* object)
+{
+  Py_INCREF(object);
+  return std::shared_ptr<const void>(object, PyObjectRelease());
+}
+
+} // namespace arv
+
+#endif // guard
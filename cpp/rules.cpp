@@ -0,0 +1,34 @@
+/*
+ * arv
+ * Copyright 2017 Christian Stigen Larsen
+ * Distributed under the GNU GPL v3 or later. See COPYING.
+ */
+
+#include "rules.hpp"
+#include "storage.hpp"
+
+namespace arv {
+
+void RuleProgram::add(const RSID& rsid, const std::int16_t* table)
+{
+  rsids.push_back(rsid);
+  tables.insert(tables.end(), table, table + TABLE_SIZE);
+}
+
+std::size_t RuleProgram::size() const
+{
+  return rsids.size();
+}
+
+void RuleProgram::evaluate(const Genome& genome, std::int16_t* out) const
+{
+  const Storage& storage = genome.storage();
+
+  for ( std::size_t n = 0; n < rsids.size(); ++n ) {
+    const SNP* snp = storage.find(rsids[n]);
+    out[n] = snp != NULL ?
+      tables[n * TABLE_SIZE + snp->genotype.code()] : NO_MATCH;
+  }
+}
+
+} // namespace arv
@@ -0,0 +1,52 @@
+/*
+ * arv
+ * Copyright 2017 Christian Stigen Larsen
+ * Distributed under the GNU GPL v3 or later. See COPYING.
+ */
+
+#ifndef ARV_RULES_HPP
+#define ARV_RULES_HPP
+
+#include <cstddef>
+#include <cstdint>
+#include <vector>
+
+#include "arv.hpp"
+
+namespace arv {
+
+/*!
+ * A compiled list of rules, each mapping the genotype of one RSID to the
+ * index of a phenotype through a table indexed by genotype code (see
+ * Genotype::code).
+ */
+class RuleProgram {
+public:
+  static const std::size_t TABLE_SIZE = 64;
+  static const std::int16_t NO_MATCH = -1;
+
+  /*!
+   * Adds a rule. The table has TABLE_SIZE phenotype indices, NO_MATCH for
+   * genotypes that don't match.
+   */
+  void add(const RSID& rsid, const std::int16_t* table);
+
+  /*!
+   * Number of rules.
+   */
+  std::size_t size() const;
+
+  /*!
+   * Evaluates all rules for the genome, storing a phenotype index for each
+   * rule in out. Rules for RSIDs not in the genome give NO_MATCH.
+   */
+  void evaluate(const Genome&, std::int16_t* out) const;
+
+private:
+  std::vector<RSID> rsids;
+  std::vector<std::int16_t> tables;
+};
+
+} // namespace arv
+
+#endif // guard
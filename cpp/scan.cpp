@@ -0,0 +1,148 @@
+/*
+ * arv
+ * Copyright 2017 Christian Stigen Larsen
+ * Distributed under the GNU GPL v3 or later. See COPYING.
+ */
+
+#include "scan.hpp"
+
+#include <atomic>
+#include <cstring>
+#include <stdexcept>
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#define ARV_X86
+#include <immintrin.h>
+#endif
+
+namespace arv {
+
+static const std::uint64_t ONES = 0x0101010101010101ULL;
+static const std::uint64_t LOW7 = 0x7f7f7f7f7f7f7f7fULL;
+
+/*!
+ * Sets the high bit of each byte of the word that equals c, and clears all
+ * other bits.
+ */
+static inline std::uint64_t bytes_equal(const std::uint64_t word,
+    const char c)
+{
+  const std::uint64_t x = word ^ (ONES * static_cast<unsigned char>(c));
+  return ~(((x & LOW7) + LOW7) | x | LOW7);
+}
+
+static std::uint64_t separators_swar(const char* p)
+{
+  std::uint64_t mask = 0;
+
+  for ( unsigned n = 0; n < 8; ++n ) {
+    const std::uint64_t word = load64(p + 8*n);
+    const std::uint64_t found = bytes_equal(word, '\t') |
+      bytes_equal(word, '\n');
+
+    // Gather the high bit of byte i into bit i
+    mask |= (((found >> 7) * 0x0102040810204080ULL) >> 56) << (8*n);
+  }
+
+  return mask;
+}
+
+#ifdef ARV_X86
+static std::uint64_t separators_sse2(const char* p)
+{
+  const __m128i tab = _mm_set1_epi8('\t');
+  const __m128i newline = _mm_set1_epi8('\n');
+  std::uint64_t mask = 0;
+
+  for ( unsigned n = 0; n < 4; ++n ) {
+    const __m128i bytes = _mm_loadu_si128(reinterpret_cast<const __m128i*>(p
+          + 16*n));
+    const __m128i found = _mm_or_si128(_mm_cmpeq_epi8(bytes, tab),
+        _mm_cmpeq_epi8(bytes, newline));
+    mask |= static_cast<std::uint64_t>(static_cast<std::uint16_t>(
+          _mm_movemask_epi8(found))) << (16*n);
+  }
+
+  return mask;
+}
+
+__attribute__((target("avx2")))
+static std::uint64_t separators_avx2(const char* p)
+{
+  const __m256i tab = _mm256_set1_epi8('\t');
+  const __m256i newline = _mm256_set1_epi8('\n');
+
+  const __m256i low = _mm256_loadu_si256(reinterpret_cast<const __m256i*>(p));
+  const __m256i high = _mm256_loadu_si256(reinterpret_cast<const __m256i*>(p
+        + 32));
+
+  const std::uint32_t low_mask = _mm256_movemask_epi8(_mm256_or_si256(
+        _mm256_cmpeq_epi8(low, tab), _mm256_cmpeq_epi8(low, newline)));
+  const std::uint32_t high_mask = _mm256_movemask_epi8(_mm256_or_si256(
+        _mm256_cmpeq_epi8(high, tab), _mm256_cmpeq_epi8(high, newline)));
+
+  return static_cast<std::uint64_t>(high_mask) << 32 | low_mask;
+}
+#endif
+
+bool scanner_supported(const Scanner scanner)
+{
+  switch ( scanner ) {
+    case SCANNER_SCALAR:
+    case SCANNER_SWAR:
+      return true;
+#ifdef ARV_X86
+    case SCANNER_SSE2:
+      __builtin_cpu_init();
+      return __builtin_cpu_supports("sse2");
+    case SCANNER_AVX2:
+      __builtin_cpu_init();
+      return __builtin_cpu_supports("avx2");
+#endif
+    default:
+      return false;
+  }
+}
+
+Scanner best_scanner()
+{
+  static const Scanner best =
+    scanner_supported(SCANNER_AVX2) ? SCANNER_AVX2 :
+    scanner_supported(SCANNER_SSE2) ? SCANNER_SSE2 :
+    SCANNER_SWAR;
+  return best;
+}
+
+SeparatorMask separator_mask(const Scanner scanner)
+{
+  switch ( scanner ) {
+    case SCANNER_SWAR:
+      return separators_swar;
+#ifdef ARV_X86
+    case SCANNER_SSE2:
+      return separators_sse2;
+    case SCANNER_AVX2:
+      return separators_avx2;
+#endif
+    default:
+      return NULL;
+  }
+}
+
+// Negative until set, meaning the best one
+static std::atomic<int> current_scanner(-1);
+
+Scanner get_scanner()
+{
+  const int scanner = current_scanner.load(std::memory_order_relaxed);
+  return scanner < 0 ? best_scanner() : static_cast<Scanner>(scanner);
+}
+
+void set_scanner(const Scanner scanner)
+{
+  if ( !scanner_supported(scanner) )
+    throw std::runtime_error("Scanner not supported on this CPU");
+  current_scanner.store(scanner, std::memory_order_relaxed);
+}
+
+} // namespace arv
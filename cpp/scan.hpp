@@ -0,0 +1,138 @@
+/*
+ * arv
+ * Copyright 2017 Christian Stigen Larsen
+ * Distributed under the GNU GPL v3 or later. See COPYING.
+ */
+
+#ifndef ARV_SCAN_HPP
+#define ARV_SCAN_HPP
+
+#include <cstddef>
+#include <cstdint>
+#include <cstring>
+
+#if defined(__BYTE_ORDER__) && __BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__
+#define ARV_LITTLE_ENDIAN
+#endif
+
+namespace arv {
+
+/*!
+ * Ways of finding the fields of a line. The scalar scanner is the original
+ * byte by byte parser. The others find all tabs and newlines 64 bytes at a
+ * time, with plain 64-bit integer operations (SWAR) or with SSE2 or AVX2
+ * instructions, and parse numbers eight digits at a time.
+ */
+enum Scanner {
+  SCANNER_SCALAR,
+  SCANNER_SWAR,
+  SCANNER_SSE2,
+  SCANNER_AVX2
+};
+
+/*!
+ * Returns a bit mask of the tabs and newlines in the 64 bytes at p, with bit
+ * n set if p[n] is one.
+ */
+typedef std::uint64_t (*SeparatorMask)(const char* p);
+
+/*!
+ * True if the CPU supports the scanner.
+ */
+bool scanner_supported(const Scanner);
+
+/*!
+ * The fastest scanner supported by the CPU.
+ */
+Scanner best_scanner();
+
+/*!
+ * The separator mask function of a bulk scanner, or NULL for the scalar one.
+ */
+SeparatorMask separator_mask(const Scanner);
+
+/*!
+ * The scanner used by the parser. Defaults to best_scanner().
+ */
+Scanner get_scanner();
+
+/*!
+ * Changes the scanner used by the parser. Throws if not supported.
+ */
+void set_scanner(const Scanner);
+
+inline std::uint64_t load64(const char* p)
+{
+  std::uint64_t word;
+  memcpy(&word, p, sizeof(word));
+  return word;
+}
+
+/*!
+ * Parses the given number of digits, one to eight, at the start of the word.
+ * Returns false if any of them is not a digit.
+ */
+inline bool parse_eight(std::uint64_t word, const std::size_t length,
+    std::uint64_t& value)
+{
+  // Move the digits to the top, leaving zero bytes as leading zeros
+  const unsigned shift = 8 * (8 - length);
+  word <<= shift;
+
+  const std::uint64_t digits = (0x3030303030303030ULL >> shift) << shift;
+  if ( (word & 0xf0f0f0f0f0f0f0f0ULL) != digits ||
+       ((word + 0x0606060606060606ULL) & 0xf0f0f0f0f0f0f0f0ULL) != digits )
+    return false;
+
+  // Combine pairs of digits, then pairs of those, and so on
+  word = (word & 0x0f0f0f0f0f0f0f0fULL) * 2561 >> 8;
+  word = (word & 0x00ff00ff00ff00ffULL) * 6553601 >> 16;
+  value = (word & 0x0000ffff0000ffffULL) * 42949672960001ULL >> 32;
+  return true;
+}
+
+/*!
+ * Parses a field of 1 to 10 decimal digits, returning false if it holds
+ * anything else. Reads eight bytes at a time, but never at or past end.
+ * Values that don't fit 32 bits wrap around like in the scalar parser.
+ */
+inline bool parse_digits(const char* s, const std::size_t length,
+    const char* end, std::uint32_t& value)
+{
+  if ( length == 0 || length > 10 )
+    return false;
+
+#ifdef ARV_LITTLE_ENDIAN
+  if ( length > 8 ) {
+    std::uint64_t high, low;
+    if ( !parse_eight(load64(s), length - 8, high) ||
+         !parse_eight(load64(s + length - 8), 8, low) )
+      return false;
+    value = static_cast<std::uint32_t>(high * 100000000 + low);
+    return true;
+  }
+
+  if ( end - s >= 8 ) {
+    std::uint64_t n;
+    if ( !parse_eight(load64(s), length, n) )
+      return false;
+    value = static_cast<std::uint32_t>(n);
+    return true;
+  }
+#endif
+
+  // Too close to the end to read a whole word
+  std::uint32_t n = 0;
+  for ( std::size_t i = 0; i < length; ++i ) {
+    if ( s[i] < '0' || s[i] > '9' )
+      return false;
+    n = n*10 + (s[i] - '0');
+  }
+
+  value = n;
+  return true;
+}
+
+} // namespace arv
+
+#endif // guard
@@ -0,0 +1,639 @@
+/*
+ * arv
+ * Copyright 2017 Christian Stigen Larsen
+ * Distributed under the GNU GPL v3 or later. See COPYING.
+ */
+
+#include "storage.hpp"
+
+#include <algorithm>
+#include <cstdint>
+#include <stdexcept>
+
+namespace arv {
+
+Storage::~Storage()
+{
+}
+
+void Storage::insert(const RsidSNP&)
+{
+  throw std::runtime_error("Genome is read-only");
+}
+
+void Storage::reserve(const std::size_t)
+{
+}
+
+double Storage::load_factor() const
+{
+  return 1.0;
+}
+
+bool Storage::read_only() const
+{
+  return true;
+}
+
+HashStorage::HashStorage(const std::size_t size) :
+  snps(size)
+{
+  snps.set_empty_key(0);
+}
+
+HashStorage::HashStorage(const HashStorage& o) :
+  Storage(),
+  snps(o.snps) // keeps the empty key
+{
+}
+
+Storage* HashStorage::clone() const
+{
+  return new HashStorage(*this);
+}
+
+const SNP* HashStorage::find(const RSID& rsid) const
+{
+  const SNPMap::const_iterator it = snps.find(rsid);
+  return it != snps.end() ? &it->second : NULL;
+}
+
+std::size_t HashStorage::size() const
+{
+  return snps.size();
+}
+
+void HashStorage::insert(const RsidSNP& obj)
+{
+  // Zero is the hash map's empty key, and not a valid RSID anyway. The
+  // lenient parser gives it for lines like "rs0" or "rs".
+  if ( obj.first == 0 )
+    return;
+
+  snps.insert(obj);
+}
+
+void HashStorage::reserve(const std::size_t size)
+{
+  snps.resize(size);
+}
+
+double HashStorage::load_factor() const
+{
+  return snps.load_factor();
+}
+
+bool HashStorage::read_only() const
+{
+  return false;
+}
+
+const char* HashStorage::name() const
+{
+  return "hash";
+}
+
+std::size_t HashStorage::memory_usage() const
+{
+  return snps.bucket_count() * sizeof(SNPMap::value_type);
+}
+
+Cursor HashStorage::begin() const
+{
+  Cursor c;
+  c.it = snps.begin();
+  return c;
+}
+
+Cursor HashStorage::end() const
+{
+  Cursor c;
+  c.it = snps.end();
+  return c;
+}
+
+void HashStorage::next(Cursor& c) const
+{
+  ++c.it;
+}
+
+RsidSNP HashStorage::value(const Cursor& c) const
+{
+  return *c.it;
+}
+
+bool HashStorage::equal(const Cursor& a, const Cursor& b) const
+{
+  return a.it == b.it;
+}
+
+std::size_t HashStorage::read(Cursor& c, RsidSNP* out,
+    const std::size_t max) const
+{
+  const SNPMap::const_iterator end = snps.end();
+  std::size_t n = 0;
+
+  for ( ; n < max && c.it != end; ++n, ++c.it )
+    out[n] = *c.it;
+
+  return n;
+}
+
+SortedStorage::SortedStorage(const std::shared_ptr<const void>& owner_,
+    const RSID* rsids_, const SNP* snps_, const std::size_t count_) :
+  owner(owner_),
+  rsids(rsids_),
+  snps(snps_),
+  count(count_)
+{
+}
+
+/*!
+ * Owns the arrays of a SortedStorage that was not loaded from a file.
+ */
+struct SortedArrays {
+  std::vector<RSID> rsids;
+  std::vector<SNP> snps;
+
+  SortedArrays(const Storage& storage) :
+    rsids(),
+    snps()
+  {
+    // Allocating the arrays before the temporary ones lets the allocator
+    // give the latter back to the system afterwards
+    rsids.reserve(storage.size());
+    snps.reserve(storage.size());
+
+    const std::vector<RsidSNP> items(sorted_items(storage));
+
+    for ( std::size_t n = 0; n < items.size(); ++n ) {
+      rsids.push_back(items[n].first);
+      snps.push_back(items[n].second);
+    }
+  }
+};
+
+SortedStorage::SortedStorage(const Storage& other) :
+  owner(),
+  rsids(NULL),
+  snps(NULL),
+  count(0)
+{
+  std::shared_ptr<SortedArrays> arrays(new SortedArrays(other));
+  rsids = arrays->rsids.data();
+  snps = arrays->snps.data();
+  count = arrays->rsids.size();
+  owner = arrays;
+}
+
+Storage* SortedStorage::clone() const
+{
+  // The arrays are read-only, so the copy can share them
+  return new SortedStorage(*this);
+}
+
+const SNP* SortedStorage::find(const RSID& rsid) const
+{
+  const RSID* end = rsids + count;
+  const RSID* it = std::lower_bound(rsids, end, rsid);
+  return (it != end && *it == rsid) ? &snps[it - rsids] : NULL;
+}
+
+std::size_t SortedStorage::size() const
+{
+  return count;
+}
+
+const char* SortedStorage::name() const
+{
+  return "sorted";
+}
+
+std::size_t SortedStorage::memory_usage() const
+{
+  return count * (sizeof(RSID) + sizeof(SNP));
+}
+
+Cursor SortedStorage::begin() const
+{
+  return Cursor();
+}
+
+Cursor SortedStorage::end() const
+{
+  Cursor c;
+  c.index = count;
+  return c;
+}
+
+void SortedStorage::next(Cursor& c) const
+{
+  ++c.index;
+}
+
+RsidSNP SortedStorage::value(const Cursor& c) const
+{
+  return RsidSNP(rsids[c.index], snps[c.index]);
+}
+
+bool SortedStorage::equal(const Cursor& a, const Cursor& b) const
+{
+  return a.index == b.index;
+}
+
+std::size_t SortedStorage::read(Cursor& c, RsidSNP* out,
+    const std::size_t max) const
+{
+  const std::size_t n = std::min(max, count - c.index);
+
+  for ( std::size_t i = 0; i < n; ++i )
+    out[i] = RsidSNP(rsids[c.index + i], snps[c.index + i]);
+
+  c.index += n;
+  return n;
+}
+
+// RSIDs per cache line
+static const std::size_t LINE_RSIDS = 64 / sizeof(RSID);
+
+/*!
+ * Fills the one-based Eytzinger arrays by an in-order walk of the implicit
+ * tree, so that the sorted items end up in search tree order. Returns the
+ * index of the next item to place.
+ */
+static std::size_t eytzinger_fill(const std::vector<RsidSNP>& items,
+    std::size_t next, const std::size_t node, RSID* rsids, SNP* snps)
+{
+  if ( node <= items.size() ) {
+    next = eytzinger_fill(items, next, 2*node, rsids, snps);
+    rsids[node] = items[next].first;
+    snps[node] = items[next].second;
+    next = eytzinger_fill(items, next + 1, 2*node + 1, rsids, snps);
+  }
+
+  return next;
+}
+
+EytzingerStorage::EytzingerStorage(const Storage& other) :
+  rsid_buffer(),
+  snp_buffer(),
+  rsids(NULL),
+  snps(NULL),
+  count(0)
+{
+  // Allocated before the temporary sorted items, like for SortedArrays
+  std::shared_ptr<std::vector<RSID> > r(new std::vector<RSID>(other.size() +
+        1 + LINE_RSIDS));
+  std::shared_ptr<std::vector<SNP> > s(new std::vector<SNP>(other.size() +
+        1));
+  const std::vector<RsidSNP> items(sorted_items(other));
+
+  // Vectors are not necessarily cache line aligned
+  RSID* aligned = r->data();
+  while ( reinterpret_cast<std::uintptr_t>(aligned) % 64 != 0 )
+    ++aligned;
+
+  eytzinger_fill(items, 0, 1, aligned, s->data());
+
+  rsid_buffer = r;
+  snp_buffer = s;
+  rsids = aligned;
+  snps = s->data();
+  count = items.size();
+}
+
+Storage* EytzingerStorage::clone() const
+{
+  // The arrays are read-only, so the copy can share them
+  return new EytzingerStorage(*this);
+}
+
+/*!
+ * Number of trailing one bits.
+ */
+static inline unsigned trailing_ones(const std::size_t n)
+{
+#ifdef __GNUC__
+  return __builtin_ctzll(~static_cast<unsigned long long>(n));
+#else
+  unsigned count = 0;
+  for ( std::size_t m = n; m & 1; m >>= 1 )
+    ++count;
+  return count;
+#endif
+}
+
+const SNP* EytzingerStorage::find(const RSID& rsid) const
+{
+  const RSID key = rsid;
+  std::size_t k = 1;
+
+  // Branchless descent. Each step goes left or right, and in the end k has
+  // gone right once past the match, followed only by left turns.
+  while ( k <= count ) {
+#ifdef __GNUC__
+    // The 16 descendants four levels down share a cache line
+    __builtin_prefetch(rsids + LINE_RSIDS*k);
+#endif
+    k = 2*k + (rsids[k] < key);
+  }
+
+  k >>= trailing_ones(k) + 1;
+  return (k != 0 && rsids[k] == key) ? &snps[k] : NULL;
+}
+
+std::size_t EytzingerStorage::size() const
+{
+  return count;
+}
+
+const char* EytzingerStorage::name() const
+{
+  return "eytzinger";
+}
+
+std::size_t EytzingerStorage::memory_usage() const
+{
+  return rsid_buffer->size() * sizeof(RSID) +
+    snp_buffer->size() * sizeof(SNP);
+}
+
+Cursor EytzingerStorage::begin() const
+{
+  Cursor c;
+  c.index = 1;
+  return c;
+}
+
+Cursor EytzingerStorage::end() const
+{
+  Cursor c;
+  c.index = count + 1;
+  return c;
+}
+
+void EytzingerStorage::next(Cursor& c) const
+{
+  ++c.index;
+}
+
+RsidSNP EytzingerStorage::value(const Cursor& c) const
+{
+  return RsidSNP(rsids[c.index], snps[c.index]);
+}
+
+bool EytzingerStorage::equal(const Cursor& a, const Cursor& b) const
+{
+  return a.index == b.index;
+}
+
+std::size_t EytzingerStorage::read(Cursor& c, RsidSNP* out,
+    const std::size_t max) const
+{
+  // The arrays start at one
+  const std::size_t n = std::min(max, count + 1 - c.index);
+
+  for ( std::size_t i = 0; i < n; ++i )
+    out[i] = RsidSNP(rsids[c.index + i], snps[c.index + i]);
+
+  c.index += n;
+  return n;
+}
+
+static bool by_rsid(const RsidSNP& a, const RsidSNP& b)
+{
+  return a.first < b.first;
+}
+
+const std::size_t CompressedStorage::BLOCK_SIZE;
+
+/*!
+ * Number of bits needed to hold the value.
+ */
+static unsigned bit_width(std::uint32_t n)
+{
+  unsigned width = 0;
+  for ( ; n != 0; n >>= 1 )
+    ++width;
+  return width;
+}
+
+CompressedStorage::CompressedStorage(const Storage& other) :
+  tables(),
+  rs_count(0)
+{
+  std::shared_ptr<Tables> t(new Tables());
+  const std::vector<RsidSNP> items(sorted_items(other));
+
+  // The i-IDs are negative, so they come first
+  const std::size_t internal = std::lower_bound(items.begin(), items.end(),
+      RsidSNP(0, SNP()), by_rsid) - items.begin();
+  rs_count = items.size() - internal;
+
+  t->snps.reserve(items.size());
+  for ( std::size_t n = internal; n < items.size(); ++n )
+    t->snps.push_back(items[n].second);
+
+  t->internal_rsids.reserve(internal);
+  for ( std::size_t n = 0; n < internal; ++n ) {
+    t->internal_rsids.push_back(items[n].first);
+    t->snps.push_back(items[n].second);
+  }
+
+  // Choose the width of each block, storing deltas minus one, so runs of
+  // consecutive RSIDs take no bits at all
+  std::uint64_t bits = 0;
+  t->blocks.reserve((rs_count + BLOCK_SIZE - 1) / BLOCK_SIZE);
+
+  for ( std::size_t start = internal; start < items.size();
+        start += BLOCK_SIZE ) {
+    const std::size_t stop = std::min(items.size(), start + BLOCK_SIZE);
+    std::uint32_t largest = 0;
+
+    for ( std::size_t n = start + 1; n < stop; ++n )
+      largest = std::max(largest, static_cast<std::uint32_t>(items[n].first -
+            items[n - 1].first - 1));
+
+    Block block;
+    block.first = items[start].first;
+    block.offset = static_cast<std::uint32_t>(bits);
+    block.width = static_cast<std::uint8_t>(bit_width(largest));
+    t->blocks.push_back(block);
+
+    bits += block.width * (stop - start - 1);
+    if ( bits > UINT32_MAX )
+      throw std::runtime_error("Too many SNPs to compress");
+  }
+
+  // With a word of padding, a delta can always be read as two words
+  t->deltas.assign(bits / 64 + 2, 0);
+
+  for ( std::size_t b = 0; b < t->blocks.size(); ++b ) {
+    const Block& block = t->blocks[b];
+    const std::size_t start = internal + b * BLOCK_SIZE;
+    const std::size_t stop = std::min(items.size(), start + BLOCK_SIZE);
+    std::uint64_t pos = block.offset;
+
+    for ( std::size_t n = start + 1; n < stop; ++n, pos += block.width ) {
+      const std::uint64_t value = static_cast<std::uint32_t>(items[n].first -
+          items[n - 1].first - 1);
+      const unsigned shift = pos % 64;
+
+      t->deltas[pos / 64] |= value << shift;
+      if ( shift + block.width > 64 )
+        t->deltas[pos / 64 + 1] |= value >> (64 - shift);
+    }
+  }
+
+  tables = t;
+}
+
+Storage* CompressedStorage::clone() const
+{
+  return new CompressedStorage(*this);
+}
+
+/*!
+ * Returns the difference between RSID n-1 and n within the block.
+ */
+inline RSID CompressedStorage::delta(const Block& block,
+    const std::size_t n) const
+{
+  const std::uint64_t pos = block.offset + (n - 1) * block.width;
+  const unsigned shift = pos % 64;
+  const std::uint64_t* words = &tables->deltas[pos / 64];
+
+  std::uint64_t value = words[0] >> shift;
+  if ( shift + block.width > 64 )
+    value |= words[1] << (64 - shift);
+
+  const std::uint64_t mask = (static_cast<std::uint64_t>(1) << block.width) -
+    1;
+  return static_cast<RSID>(value & mask) + 1;
+}
+
+const SNP* CompressedStorage::find(const RSID& rsid) const
+{
+  const Tables& t = *tables;
+
+  if ( rsid < 0 ) {
+    const std::vector<RSID>& ids = t.internal_rsids;
+    const std::vector<RSID>::const_iterator it = std::lower_bound(ids.begin(),
+        ids.end(), rsid);
+    return (it != ids.end() && *it == rsid) ?
+      &t.snps[rs_count + (it - ids.begin())] : NULL;
+  }
+
+  // Skip to the last block starting at or before the RSID
+  const std::vector<Block>::const_iterator it = std::upper_bound(
+      t.blocks.begin(), t.blocks.end(), rsid,
+      [](const RSID& r, const Block& b) { return r < b.first; });
+
+  if ( it == t.blocks.begin() )
+    return NULL;
+
+  const Block& block = *(it - 1);
+  const std::size_t start = (it - 1 - t.blocks.begin()) * BLOCK_SIZE;
+  const std::size_t stop = std::min(BLOCK_SIZE, rs_count - start);
+  RSID current = block.first;
+  std::size_t n = 0;
+
+  while ( current < rsid && ++n < stop )
+    current += delta(block, n);
+
+  return current == rsid ? &t.snps[start + n] : NULL;
+}
+
+std::size_t CompressedStorage::size() const
+{
+  return tables->snps.size();
+}
+
+const char* CompressedStorage::name() const
+{
+  return "compressed";
+}
+
+std::size_t CompressedStorage::memory_usage() const
+{
+  const Tables& t = *tables;
+  return t.blocks.size() * sizeof(Block) +
+    t.deltas.size() * sizeof(std::uint64_t) +
+    t.internal_rsids.size() * sizeof(RSID) +
+    t.snps.size() * sizeof(SNP);
+}
+
+Cursor CompressedStorage::begin() const
+{
+  Cursor c;
+  if ( rs_count > 0 )
+    c.rsid = tables->blocks[0].first;
+  return c;
+}
+
+Cursor CompressedStorage::end() const
+{
+  Cursor c;
+  c.index = size();
+  return c;
+}
+
+void CompressedStorage::next(Cursor& c) const
+{
+  ++c.index;
+
+  if ( c.index < rs_count ) {
+    const Block& block = tables->blocks[c.index / BLOCK_SIZE];
+    const std::size_t n = c.index % BLOCK_SIZE;
+    c.rsid = n == 0 ? block.first : c.rsid + delta(block, n);
+  }
+}
+
+RsidSNP CompressedStorage::value(const Cursor& c) const
+{
+  const RSID rsid = c.index < rs_count ? c.rsid :
+    tables->internal_rsids[c.index - rs_count];
+  return RsidSNP(rsid, tables->snps[c.index]);
+}
+
+bool CompressedStorage::equal(const Cursor& a, const Cursor& b) const
+{
+  return a.index == b.index;
+}
+
+std::size_t CompressedStorage::read(Cursor& c, RsidSNP* out,
+    const std::size_t max) const
+{
+  const Tables& t = *tables;
+  const std::size_t n = std::min(max, size() - c.index);
+
+  for ( std::size_t i = 0; i < n; ++i ) {
+    if ( c.index < rs_count ) {
+      out[i] = RsidSNP(c.rsid, t.snps[c.index]);
+
+      // Decode the next RSID of the block, like next() does
+      if ( ++c.index < rs_count ) {
+        const Block& block = t.blocks[c.index / BLOCK_SIZE];
+        const std::size_t k = c.index % BLOCK_SIZE;
+        c.rsid = k == 0 ? block.first : c.rsid + delta(block, k);
+      }
+    } else {
+      out[i] = RsidSNP(t.internal_rsids[c.index - rs_count], t.snps[c.index]);
+      ++c.index;
+    }
+  }
+
+  return n;
+}
+
+std::vector<RsidSNP> sorted_items(const Storage& storage)
+{
+  std::vector<RsidSNP> items(storage.size());
+  Cursor c = storage.begin();
+  items.resize(storage.read(c, items.data(), items.size()));
+
+  std::sort(items.begin(), items.end(), by_rsid);
+  return items;
+}
+
+} // namespace arv
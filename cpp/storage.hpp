@@ -0,0 +1,230 @@
+/*
+ * arv
+ * Copyright 2017 Christian Stigen Larsen
+ * Distributed under the GNU GPL v3 or later. See COPYING.
+ */
+
+#ifndef ARV_STORAGE_HPP
+#define ARV_STORAGE_HPP
+
+#include <cstdint>
+#include <memory>
+#include <vector>
+
+#include "arv.hpp"
+
+namespace arv {
+
+/*!
+ * Holds the SNPs of a Genome, keyed by RSID.
+ */
+class Storage {
+public:
+  virtual ~Storage();
+
+  virtual Storage* clone() const = 0;
+
+  /*!
+   * Returns the SNP with the given RSID, or NULL if not found.
+   */
+  virtual const SNP* find(const RSID& rsid) const = 0;
+
+  virtual std::size_t size() const = 0;
+
+  /*!
+   * Adds a SNP. Throws for read-only storages.
+   */
+  virtual void insert(const RsidSNP&);
+
+  virtual void reserve(const std::size_t size);
+
+  virtual double load_factor() const;
+
+  virtual bool read_only() const;
+
+  /*!
+   * Name of the storage type, as in storage_type().
+   */
+  virtual const char* name() const = 0;
+
+  /*!
+   * Approximate number of bytes used by the storage's tables.
+   */
+  virtual std::size_t memory_usage() const = 0;
+
+  virtual Cursor begin() const = 0;
+  virtual Cursor end() const = 0;
+  virtual void next(Cursor&) const = 0;
+  virtual RsidSNP value(const Cursor&) const = 0;
+  virtual bool equal(const Cursor&, const Cursor&) const = 0;
+
+  /*!
+   * Copies up to max items from the cursor into out and moves past them.
+   * Returns how many were copied, zero at the end.
+   */
+  virtual std::size_t read(Cursor&, RsidSNP* out, std::size_t max) const = 0;
+};
+
+/*!
+ * The default, mutable storage, using Google's dense hash map.
+ */
+class HashStorage : public Storage {
+  SNPMap snps;
+
+public:
+  HashStorage(const std::size_t size);
+  HashStorage(const HashStorage&);
+
+  Storage* clone() const;
+  const SNP* find(const RSID& rsid) const;
+  std::size_t size() const;
+  void insert(const RsidSNP&);
+  void reserve(const std::size_t size);
+  double load_factor() const;
+  bool read_only() const;
+  const char* name() const;
+  std::size_t memory_usage() const;
+
+  Cursor begin() const;
+  Cursor end() const;
+  void next(Cursor&) const;
+  RsidSNP value(const Cursor&) const;
+  bool equal(const Cursor&, const Cursor&) const;
+  std::size_t read(Cursor&, RsidSNP*, std::size_t) const;
+};
+
+/*!
+ * A read-only storage of parallel arrays of RSIDs, sorted in ascending order,
+ * and their SNPs. The arrays are not copied, but point into memory kept alive
+ * by the owner, for example a memory mapped file.
+ */
+class SortedStorage : public Storage {
+  std::shared_ptr<const void> owner;
+  const RSID* rsids;
+  const SNP* snps;
+  std::size_t count;
+
+public:
+  SortedStorage(const std::shared_ptr<const void>& owner,
+      const RSID* rsids, const SNP* snps, const std::size_t count);
+
+  /*!
+   * Copies the SNPs of another storage into arrays owned by the new one.
+   */
+  SortedStorage(const Storage&);
+
+  Storage* clone() const;
+  const SNP* find(const RSID& rsid) const;
+  std::size_t size() const;
+  const char* name() const;
+  std::size_t memory_usage() const;
+
+  Cursor begin() const;
+  Cursor end() const;
+  void next(Cursor&) const;
+  RsidSNP value(const Cursor&) const;
+  bool equal(const Cursor&, const Cursor&) const;
+  std::size_t read(Cursor&, RsidSNP*, std::size_t) const;
+};
+
+/*!
+ * A read-only storage of RSIDs and SNPs in Eytzinger order, i.e. laid out
+ * like a complete binary search tree stored breadth first. Searching it
+ * touches the same few cache lines near the top of the tree every time, and
+ * the next levels can be prefetched, so random lookups are faster than a
+ * binary search over a sorted array while using just as little memory.
+ */
+class EytzingerStorage : public Storage {
+  std::shared_ptr<const std::vector<RSID> > rsid_buffer;
+  std::shared_ptr<const std::vector<SNP> > snp_buffer;
+
+  // One-based, with a dummy element at index zero. The RSIDs are cache line
+  // aligned, so that prefetches of a node's descendants hit a single line.
+  const RSID* rsids;
+  const SNP* snps;
+  std::size_t count;
+
+public:
+  /*!
+   * Copies the SNPs of another storage.
+   */
+  EytzingerStorage(const Storage&);
+
+  Storage* clone() const;
+  const SNP* find(const RSID& rsid) const;
+  std::size_t size() const;
+  const char* name() const;
+  std::size_t memory_usage() const;
+
+  Cursor begin() const;
+  Cursor end() const;
+  void next(Cursor&) const;
+  RsidSNP value(const Cursor&) const;
+  bool equal(const Cursor&, const Cursor&) const;
+  std::size_t read(Cursor&, RsidSNP*, std::size_t) const;
+};
+
+/*!
+ * A read-only storage with compressed RSIDs, for keeping many genomes in
+ * memory.
+ *
+ * The rs-IDs are sorted and split into blocks of BLOCK_SIZE. Each block
+ * records its first RSID, used as a skip pointer to find the block with
+ * binary search, followed by the differences between consecutive RSIDs,
+ * bit packed with the smallest width that fits the block. A lookup decodes at
+ * most one block. The few internal i-IDs, which are negative, are kept in a
+ * separate sorted array.
+ *
+ * The SNPs themselves are stored as usual, with the rs-IDs' first.
+ */
+class CompressedStorage : public Storage {
+public:
+  static const std::size_t BLOCK_SIZE = 64;
+
+  /*!
+   * Copies the SNPs of another storage.
+   */
+  CompressedStorage(const Storage&);
+
+  Storage* clone() const;
+  const SNP* find(const RSID& rsid) const;
+  std::size_t size() const;
+  const char* name() const;
+  std::size_t memory_usage() const;
+
+  Cursor begin() const;
+  Cursor end() const;
+  void next(Cursor&) const;
+  RsidSNP value(const Cursor&) const;
+  bool equal(const Cursor&, const Cursor&) const;
+  std::size_t read(Cursor&, RsidSNP*, std::size_t) const;
+
+private:
+  struct Block {
+    RSID first;
+    std::uint32_t offset; // in bits
+    std::uint8_t width;
+  };
+
+  struct Tables {
+    std::vector<Block> blocks;
+    std::vector<std::uint64_t> deltas;
+    std::vector<RSID> internal_rsids;
+    std::vector<SNP> snps;
+  };
+
+  // Shared by copies, since it is never modified
+  std::shared_ptr<const Tables> tables;
+  std::size_t rs_count;
+
+  RSID delta(const Block&, const std::size_t n) const;
+};
+
+/*!
+ * Returns all SNPs of the storage, sorted by RSID.
+ */
+std::vector<RsidSNP> sorted_items(const Storage&);
+
+} // namespace arv
+
+#endif // guard
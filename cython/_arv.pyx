@@ -4,12 +4,26 @@
 # Copyright 2017 Christian Stigen Larsen
 # Distributed under the GNU GPL v3 or later; see COPYING.
 
-from libc.stdint cimport uint32_t, int32_t
+cimport cython
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE
+from cpython.bytes cimport PyBytes_FromStringAndSize
+from cpython.ref cimport PyObject, Py_INCREF, Py_XDECREF
+from libc.stdint cimport (INT32_MAX, INT32_MIN, int16_t, int32_t, uint8_t,
+        uint32_t, uint64_t)
 from libcpp cimport bool
+from libcpp.memory cimport shared_ptr
 from libcpp.string cimport string
 from libcpp.utility cimport pair
 from libcpp.vector cimport vector
 
+import mmap
+import os
+import zlib
+
+cdef extern from "storage.hpp" namespace "arv":
+    cdef cppclass CStorage "arv::Storage":
+        const char* name() const
+
 cdef extern from "arv.hpp" namespace "arv":
     ctypedef uint32_t Position
     ctypedef int32_t RSID
@@ -40,7 +54,9 @@ cdef extern from "arv.hpp" namespace "arv":
         CGenotype(const Nucleotide&, const Nucleotide&)
         bool operator==(const CGenotype&) const
         bool operator<(const CGenotype&) const
+        bool unphased_equal(const CGenotype&) const
         string to_string() const
+        uint8_t code() const
 
     cdef cppclass CSNP "arv::SNP":
         Chromosome chromosome
@@ -70,9 +86,15 @@ cdef extern from "arv.hpp" namespace "arv":
         bool operator!=(const CGenomeIterator&) const
         void next()
         RsidSNP value() const
+        size_t read(RsidSNP*, const size_t)
 
     cdef const CSNP NONE_SNP
 
+    cdef cppclass CGenomeInfo "arv::GenomeInfo":
+        string name
+        string ethnicity
+        int orientation
+
     cdef cppclass CGenome "arv::Genome":
         CGenome() except +
         CGenome(const size_t) except +
@@ -82,34 +104,212 @@ cdef extern from "arv.hpp" namespace "arv":
         bool y_chromosome
 
         double load_factor() const
+        size_t memory_usage() const
         size_t size() const
+        const CStorage& storage() const
 
         string genotype(const RSID& id) const
         const CSNP& operator[](const RSID&) const
         bool has(const RSID&) const
         void insert(const RSID&, const CSNP&)
+        void reserve(const size_t)
+        bool read_only() const
 
         bool operator==(const CGenome&) const
         bool operator!=(const CGenome&) const
 
+        vector[RsidSNP] region(const Chromosome&, const Position&,
+                const Position&) nogil except +
+
         CGenomeIterator begin() const
         CGenomeIterator end() const
 
-    cdef void parse_file(const string&, CGenome&) except +
+    cdef void c_convert_storage "arv::convert_storage"(CGenome&,
+            const string&) except +
+    cdef enum ParseError:
+        ERROR_MALFORMED
+        ERROR_OVERFLOW
+        ERROR_UNKNOWN_CHROMOSOME
+        ERROR_INVALID_GENOTYPE
+        ERROR_TRUNCATED
+        ERROR_KINDS
+
+    cdef cppclass ParseIssue "arv::ParseIssue":
+        size_t line
+        ParseError error
+        string text
+
+    cdef cppclass ParseReport "arv::ParseReport":
+        size_t lines
+        size_t snps
+        size_t comments
+        size_t blanks
+        size_t errors[5] # ERROR_KINDS
+        vector[ParseIssue] issues
+
+        ParseReport(size_t)
+        size_t error_count() const
+        void add(ParseError, size_t, const char*, const char*)
+
+    cdef void parse_file(const string&, CGenome&, size_t,
+            ParseReport*) nogil except +
+    cdef void parse_buffer(const char*, size_t, CGenome&, size_t,
+            ParseReport*) nogil except +
+    cdef void parse_files(const vector[string]&, const vector[CGenome*]&,
+            size_t) nogil except +
+    cdef size_t parse_snps(const char*&, const char*, RsidSNP*, size_t) nogil
+    cdef bool parse_rsid(const char*, const size_t, RSID&)
     cdef CGenotype complement(const CGenotype&)
+    cdef size_t lookup_many(const CGenome&, const RSID*, size_t, uint8_t*,
+            Position*, uint8_t*, bool*) nogil
+    cdef void export_columns(const CGenome&, RSID*, uint8_t*, Position*,
+            uint8_t*) nogil
+
+    cdef cppclass ShardIndex "arv::ShardIndex":
+        size_t lines[26] # CHR_MT + 1
+
+    cdef void index_shards(const char*, size_t, ShardIndex&) nogil
+    cdef void parse_shard(const char*, const ShardIndex&, Chromosome,
+            CGenome&) nogil except +
+
+    cdef cppclass StreamParser "arv::StreamParser":
+        StreamParser(CGenome&, ParseReport*) except +
+        void feed(const char*, size_t) nogil except +
+        void finish() nogil except +
+    cdef void save_binary(const string&, const CGenome&,
+            const CGenomeInfo&) nogil except +
+    cdef void c_load_binary "arv::load_binary"(const string&, CGenome&,
+            CGenomeInfo&, bool) nogil except +
+    cdef void save_shared(const string&, const CGenome&,
+            const CGenomeInfo&) nogil except +
+    cdef void c_load_shared "arv::load_shared"(const string&, CGenome&,
+            CGenomeInfo&, bool) nogil except +
+    cdef void c_unlink_shared "arv::unlink_shared"(const string&) nogil \
+            except +
+
+cdef extern from "cohort.hpp" namespace "arv":
+    cdef cppclass CCohort "arv::Cohort":
+        CCohort(size_t) except +
+        size_t genomes() const
+        size_t size() const
+        size_t find(const RSID&) const
+        RSID rsid(size_t) const
+        CGenotype genotype(size_t, size_t) const
+        void genotypes(size_t, uint8_t*) nogil const
+        size_t memory_usage() const
+
+    cdef size_t COHORT_NPOS "arv::Cohort::npos"
+    cdef void c_load_cohort "arv::load_cohort"(const vector[string]&,
+            CCohort&, size_t) nogil except +
+
+cdef extern from "rules.hpp" namespace "arv":
+    cdef cppclass CRuleProgram "arv::RuleProgram":
+        void add(const RSID&, const int16_t*) except +
+        size_t size() const
+        void evaluate(const CGenome&, int16_t*) nogil const
+
+    cdef size_t RULE_TABLE_SIZE "arv::RuleProgram::TABLE_SIZE"
+
+cdef extern from "binary.hpp" namespace "arv":
+    cdef uint64_t checksum_file(const string&) nogil except +
+    cdef size_t binary_size(const CGenome&, const CGenomeInfo&) nogil
+    cdef void write_binary(char*, const CGenome&, const CGenomeInfo&) nogil
+    cdef void read_binary(const char*, size_t, const shared_ptr[const void]&,
+            CGenome&, CGenomeInfo&, bool) nogil except +
+
+cdef extern from "scan.hpp" namespace "arv":
+    cdef enum Scanner:
+        SCANNER_SCALAR
+        SCANNER_SWAR
+        SCANNER_SSE2
+        SCANNER_AVX2
+
+    cdef bool scanner_supported(Scanner)
+    cdef Scanner get_scanner()
+    cdef void set_scanner(Scanner) except +
+
+cdef extern from "pyowner.hpp" namespace "arv":
+    cdef shared_ptr[const void] python_owner(PyObject*)
+
+cdef struct RsidString:
+    RSID rsid
+    PyObject* string
+
+# Recently converted RSID strings, shared by all genomes. It is set
+# associative like a CPU cache, with the most recently used string of a set
+# first and the least recently used one evicted. Looking up a string is much
+# faster than creating it, and keys seen in many genomes are not duplicated.
+DEF RSID_CACHE_WAYS = 4
+DEF RSID_CACHE_BITS = 14
+cdef RsidString __rsid_cache[RSID_CACHE_WAYS << RSID_CACHE_BITS]
+
+@cython.cdivision(True)
+cdef __format_rsid(const RSID rsid):
+    """Creates the string of an RSID."""
+    # Writing the digits directly is much faster than "rs%d" % rsid
+    cdef char buf[16]
+    cdef char* p = buf + 16
+    cdef uint32_t n = <uint32_t>rsid if rsid >= 0 else 0 - <uint32_t>rsid
+
+    while True:
+        p -= 1
+        p[0] = c'0' + n % 10
+        n //= 10
+        if n == 0:
+            break
 
-cdef basestring __rsid2str(const RSID& rsid):
-    """Converts RSID to integer."""
     if rsid >= 0:
-        return "rs%d" % rsid
+        p -= 2
+        p[0] = c'r'
+        p[1] = c's'
     else:
-        return "i%d" % -rsid
+        p -= 1
+        p[0] = c'i'
 
-cdef RSID __rsid2int(key) except? 0:
+    return p[:buf + 16 - p]
+
+cdef basestring __rsid2str(const RSID& rsid):
     """Converts RSID to string."""
+    cdef uint32_t hash = <uint32_t>rsid * <uint32_t>2654435761
+    cdef RsidString* ways = &__rsid_cache[(hash >> (32 - RSID_CACHE_BITS)) *
+            RSID_CACHE_WAYS]
+    cdef RsidString found
+    cdef int n = 0
+
+    while n < RSID_CACHE_WAYS and ways[n].string != NULL:
+        if ways[n].rsid == rsid:
+            break
+        n += 1
+
+    if n == RSID_CACHE_WAYS or ways[n].string == NULL:
+        # Not cached, so evict the least recently used
+        n = min(n, RSID_CACHE_WAYS - 1)
+        Py_XDECREF(ways[n].string)
+        string = __format_rsid(rsid)
+        Py_INCREF(string)
+        ways[n].rsid = rsid
+        ways[n].string = <PyObject*>string
+
+    # Move to the front
+    found = ways[n]
+    while n > 0:
+        ways[n] = ways[n - 1]
+        n -= 1
+    ways[0] = found
+
+    return <basestring>found.string
+
+cdef RSID __rsid2int(key) except? 0:
+    """Converts string to RSID."""
+    cdef RSID rsid = 0
+
     if isinstance(key, int):
         return key
     elif isinstance(key, str):
+        # A C-level parse for the usual rs<digits> and i<digits>, leaving
+        # anything unusual to int(), which also gives the errors
+        if parse_rsid(key, len(key), rsid):
+            return rsid
         if key.startswith("rs"):
             return int(key[2:])
         elif key.startswith("i"):
@@ -117,6 +317,60 @@ cdef RSID __rsid2int(key) except? 0:
     else:
         return 0
 
+def _rsid_array(rsids):
+    """Converts RSIDs to a contiguous NumPy array of 32-bit integers.
+
+    Takes an integer NumPy array or a sequence of RSIDs as accepted by
+    ``Genome.__getitem__``. Keys that are not RSIDs become zero, which is
+    never found.
+    """
+    import numpy
+
+    if isinstance(rsids, numpy.ndarray) and rsids.dtype.kind in "iu":
+        if rsids.ndim != 1:
+            raise ValueError("RSID array must be one-dimensional")
+        if rsids.size > 0 and (rsids.min() < INT32_MIN or
+                               rsids.max() > INT32_MAX):
+            raise OverflowError("RSID out of range")
+        return numpy.ascontiguousarray(rsids, dtype=numpy.int32)
+
+    if not isinstance(rsids, (list, tuple)):
+        rsids = list(rsids)
+
+    result = numpy.empty(len(rsids), dtype=numpy.int32)
+    cdef int32_t[::1] out = result
+    cdef Py_ssize_t n
+
+    for n in range(len(rsids)):
+        out[n] = __rsid2int(rsids[n])
+
+    return result
+
+cdef Chromosome __chromosome(value) except? CHR_NO:
+    """Converts a chromosome like 6, "6", "chr6", "X" or "MT" to its enum."""
+    if isinstance(value, basestring):
+        name = value.upper()
+        if name.startswith("CHR"):
+            name = name[3:]
+        if name in ("X", "Y", "MT"):
+            return {"X": CHR_X, "Y": CHR_Y, "MT": CHR_MT}[name]
+        try:
+            value = int(name)
+        except ValueError:
+            raise ValueError("Unknown chromosome: %r" % value)
+
+    if not 1 <= value <= 22:
+        raise ValueError("Unknown chromosome: %r" % value)
+
+    return <Chromosome>value
+
+cdef object __chromosome_name(Chromosome c):
+    """Converts a chromosome enum to 1 through 22, "X", "Y", "MT" or None."""
+    if CHR_01 <= c <= CHR_22:
+        return c
+    else:
+        return {CHR_NO: None, CHR_MT: "MT", CHR_X: "X", CHR_Y: "Y"}[c]
+
 cdef class Genotype(object):
     """Contains a pair of nucleotides.
 
@@ -138,6 +392,9 @@ cdef class Genotype(object):
         True
         >>> gt == "AA"
         False
+
+    Genotypes are immutable, and there are only 49 of them, so the same
+    objects and strings are shared by all SNPs.
     """
     cdef CGenotype _genotype
 
@@ -146,15 +403,14 @@ cdef class Genotype(object):
 
     @staticmethod
     cdef _init(CGenotype genotype):
-        r = Genotype()
-        r._genotype = genotype
-        return r
+        # Genotypes are immutable, so they are all shared
+        return __genotypes[genotype.code()]
 
     def __repr__(self):
         return "<Genotype %r>" % str(self)
 
     def __str__(self):
-        return str(self._genotype.to_string())
+        return __genotype_strings[self._genotype.code()]
 
     cpdef _rich_cmp(self, Genotype obj, int op):
         cdef CGenotype this = self._genotype
@@ -174,37 +430,94 @@ cdef class Genotype(object):
             return (this == that) or (that < this)
         raise NotImplementedError()
 
-    def __richcmp__(self, obj, int op):
+    def __richcmp__(Genotype self, obj, int op):
         if isinstance(obj, str):
             # String comparison
-            this = str(self)
-            that = str(obj)
+            return __compare_string(self._genotype, obj, op)
         elif isinstance(obj, Genotype):
             # Genotype comparison
             return self._rich_cmp(obj, op)
         else:
             raise NotImplementedError()
 
-        if op == 0:
-            return this < that
-        elif op == 1:
-            return this <= that
-        elif op == 2:
-            return this == that
-        elif op == 3:
-            return this != that
-        elif op == 4:
-            return this > that
-        elif op == 5:
-            return this >= that
+    def unphased_equals(Genotype self, other):
+        """True if equal to another ``Genotype``, ``SNP`` or genotype string
+        when disregarding phasing, i.e. ``AG`` equals both ``AG`` and ``GA``.
+        """
+        return __unphased_equal(self._genotype, other)
 
-        raise NotImplementedError()
+    @property
+    def code(self):
+        """The genotype packed into an integer, as used by
+        ``Genome.lookup_many``.
 
-    def __invert__(self):
-        gt = Genotype()
-        gt._genotype = complement(self._genotype)
-        return gt
+        Nucleotides are numbered ``-`` 0, ``A`` 1, ``G`` 2, ``C`` 3, ``T`` 4,
+        ``D`` 5 and ``I`` 6, and the code is ``first << 3 | second``. Zero
+        means no call.
+        """
+        return self._genotype.code()
 
+    def __invert__(self):
+        return Genotype._init(complement(self._genotype))
+
+# Every Genotype and its string, indexed by code, and the code of each
+# genotype string, so that strings are compared without creating any
+cdef list __genotypes = []
+cdef list __genotype_strings = []
+cdef dict __genotype_codes = {}
+
+cdef __init_genotypes():
+    cdef Genotype genotype
+    cdef int code
+    for code in range(64):
+        genotype = Genotype()
+        genotype._genotype = CGenotype(<Nucleotide>(code >> 3),
+                <Nucleotide>(code & 7))
+        __genotypes.append(genotype)
+        __genotype_strings.append(intern(genotype._genotype.to_string()))
+
+        # Only valid nucleotides, as invalid ones are shown as no calls
+        if code >> 3 <= I and code & 7 <= I:
+            __genotype_codes[__genotype_strings[code]] = code
+
+__init_genotypes()
+
+cdef __compare_string(const CGenotype& genotype, obj, int op):
+    """Compares a genotype with a string, as if it were a string."""
+    if op == 2 or op == 3:
+        # A string is equal only if it is the string of the same genotype
+        code = __genotype_codes.get(obj, -1)
+        return (code == genotype.code()) == (op == 2)
+
+    this = __genotype_strings[genotype.code()]
+    if op == 0:
+        return this < obj
+    elif op == 1:
+        return this <= obj
+    elif op == 4:
+        return this > obj
+    elif op == 5:
+        return this >= obj
+
+    raise NotImplementedError()
+
+cdef int __genotype_code(obj) except -2:
+    """Code of a Genotype, SNP or genotype string, or -1 for other strings."""
+    if isinstance(obj, Genotype):
+        return (<Genotype>obj)._genotype.code()
+    elif isinstance(obj, SNP):
+        return (<SNP>obj)._snp.genotype.code()
+    elif isinstance(obj, str):
+        return __genotype_codes.get(obj, -1)
+    raise TypeError(type(obj))
+
+cdef bint __unphased_equal(const CGenotype& genotype, obj) except -1:
+    cdef int code = __genotype_code(obj)
+    if code < 0:
+        return False
+    return genotype.unphased_equal((<Genotype>__genotypes[code])._genotype)
+
+@cython.freelist(64)
 cdef class SNP(object):
     """A single nucleotide polymorphism.
 
@@ -232,7 +545,7 @@ cdef class SNP(object):
 
     @staticmethod
     cdef _init(CSNP snp):
-        r = SNP()
+        cdef SNP r = SNP.__new__(SNP)
         r._snp = snp
         return r
 
@@ -248,12 +561,7 @@ cdef class SNP(object):
         Possible values are the integers 1 through 22 and the strings "MT"
         (mitochondrial DNA) "X" and "Y".
         """
-        cdef Chromosome c = self._snp.chromosome
-
-        if CHR_01 <= c <= CHR_22:
-            return c
-        else:
-            return {CHR_NO: None, CHR_MT: "MT", CHR_X: "X", CHR_Y: "Y"}[c]
+        return __chromosome_name(self._snp.chromosome)
 
     @property
     def genotype(self):
@@ -265,7 +573,7 @@ cdef class SNP(object):
                 self.chromosome, self.position, self.genotype)
 
     def __str__(self):
-        return str(self.genotype)
+        return __genotype_strings[self._snp.genotype.code()]
 
     cpdef _rich_cmp(self, SNP obj, int op):
         cdef CSNP this = self._snp
@@ -285,46 +593,59 @@ cdef class SNP(object):
             return this >= that
         raise NotImplementedError()
 
-    def __richcmp__(self, obj, int op):
+    def __richcmp__(SNP self, obj, int op):
         if isinstance(obj, str):
             # String comparison
-            this = str(self.genotype)
-            that = str(obj)
-            if op == 0:
-                return this < that
-            elif op == 1:
-                return this <= that
-            elif op == 2:
-                return this == that
-            elif op == 3:
-                return this != that
-            elif op == 4:
-                return this > that
-            elif op == 5:
-                return this >= that
+            return __compare_string(self._snp.genotype, obj, op)
         elif isinstance(obj, SNP):
             # Genotype comparison
             return self._rich_cmp(obj, op)
         raise NotImplementedError()
 
+    def unphased_equals(SNP self, other):
+        """True if the genotype equals another ``Genotype``, ``SNP`` or
+        genotype string when disregarding phasing, like
+        ``Genotype.unphased_equals``."""
+        return __unphased_equal(self._snp.genotype, other)
+
+
+cdef size_t ITERATE_BATCH = 1024
 
+@cython.final
 cdef class GenomeIterator(object):
-    """Iterates through the ``SNP`` objects of a ``Genome``."""
+    """Iterates through the RSIDs, ``SNP`` objects or items of a ``Genome``.
+
+    SNPs are copied out of the genome a batch at a time, and the iterator
+    keeps the genome alive while it is in use. RSID strings come from the
+    RSID cache only if the whole genome fits in it, since a scan through a
+    larger one would just evict everything.
+    """
+    cdef object _owner
     cdef CGenomeIterator _cur
-    cdef CGenomeIterator _end
+    cdef vector[RsidSNP] _batch
+    cdef size_t _index
+    cdef size_t _count
     cdef int _type
+    cdef bint _cached
 
     def __cinit__(GenomeIterator self, int iterator_type):
         self._type = iterator_type
+        self._index = 0
+        self._count = 0
 
     @staticmethod
-    cdef GenomeIterator _iterate(const CGenome& genome, const int
+    cdef GenomeIterator _iterate(object owner, const CGenome& genome, const int
             iterator_type):
         it = GenomeIterator(iterator_type)
+        it._owner = owner
         it._cur = genome.begin()
-        it._end = genome.end()
+        it._batch.resize(ITERATE_BATCH)
+        it._cached = genome.size() <= RSID_CACHE_WAYS << RSID_CACHE_BITS
         return it
 
+    cdef _key(GenomeIterator self, const RSID rsid):
+        return __rsid2str(rsid) if self._cached else __format_rsid(rsid)
+
     def __iter__(self):
         return self
 
@@ -332,41 +653,23 @@ cdef class GenomeIterator(object):
         # Python 2 compatibility
         return self.__next__()
 
-    def __next__(self):
-        return self._dispatch()
+    def __next__(GenomeIterator self):
+        if self._index == self._count:
+            self._count = self._cur.read(self._batch.data(),
+                    self._batch.size())
+            self._index = 0
+            if self._count == 0:
+                raise StopIteration()
+
+        cdef const RsidSNP* item = &self._batch[self._index]
+        self._index += 1
 
-    cdef _dispatch(GenomeIterator self):
         if self._type == 0:
-            return self._next_key()
+            return self._key(item.first)
         elif self._type == 1:
-            return self._next_value()
+            return SNP._init(item.second)
         else:
-            return self._next_item()
-
-    cdef SNP _next_value(GenomeIterator self):
-        if self._cur == self._end:
-            raise StopIteration()
-
-        snp = SNP._init(self._cur.value().second)
-        self._cur.next()
-        return snp
-
-    cdef basestring _next_key(GenomeIterator self):
-        if self._cur == self._end:
-            raise StopIteration()
-
-        cdef RSID rsid = self._cur.value().first
-        self._cur.next()
-        return __rsid2str(rsid)
-
-    cdef _next_item(GenomeIterator self):
-        if self._cur == self._end:
-            raise StopIteration()
-
-        cdef basestring rsid = __rsid2str(self._cur.value().first)
-        cdef SNP snp = SNP._init(self._cur.value().second)
-        self._cur.next()
-        return (rsid, snp)
+            return (self._key(item.first), SNP._init(item.second))
 
 
 cdef class Genome(object):
@@ -378,17 +681,64 @@ cdef class Genome(object):
     cdef int _orientation
     cdef basestring _name
     cdef basestring _ethnicity
+    cdef dict _parse_report
 
     def __cinit__(Genome self, size_t size=1000003):
         self._genome = CGenome(size)
         self._orientation = 0
         self._name = ""
         self._ethnicity = ""
+        self._parse_report = None
 
     cpdef double load_factor(Genome self):
         """The underlying hash table's load factor."""
         return self._genome.load_factor()
 
+    def memory_usage(Genome self):
+        """Approximate number of bytes used by the genome's SNP storage and
+        indices."""
+        return self._genome.memory_usage()
+
+    @property
+    def storage(Genome self):
+        """The type of storage holding the SNPs: "hash", "sorted",
+        "eytzinger" or "compressed". See ``convert_storage``."""
+        return self._genome.storage().name()
+
+    def convert_storage(Genome self, storage):
+        """Moves the SNPs to another type of storage.
+
+        Arguments:
+            storage: One of
+
+                     "hash" - A mutable hash table. The default for parsed
+                     genomes.
+
+                     "sorted" - Read-only arrays sorted by RSID, searched with
+                     binary search. Used for genomes loaded with
+                     ``load_binary``.
+
+                     "eytzinger" - Read-only arrays in the order of a binary
+                     search tree stored breadth first, which gives the
+                     fastest random lookups.
+
+                     "compressed" - Read-only, with the RSIDs delta coded in
+                     blocks. The smallest, for keeping many genomes in
+                     memory, but lookups decode part of a block.
+
+                     The read-only storages take about a third of the memory
+                     of the hash table or less.
+
+        Raises:
+            ValueError - Unknown storage type.
+        """
+        if storage not in ("hash", "sorted", "eytzinger", "compressed"):
+            raise ValueError("Unknown storage type: %r" % (storage,))
+
+        # Keep the GIL, so no other thread reads the genome during the swap.
+        # Iterators keep using the old storage until they are done.
+        c_convert_storage(self._genome, storage.encode("ascii"))
+
     @property
     def orientation(self):
         """The orientation of the genotype call, represented as an integer
@@ -438,14 +788,120 @@ cdef class Genome(object):
         genome."""
         return self._genome.y_chromosome
 
+    @property
+    def parse_report(Genome self):
+        """The report from loading the genome with ``validate=True``, or None.
+
+        A dict with the number of "lines", "snps", "comments" and "blanks", a
+        dict of "errors" counting the invalid lines by kind, the first
+        "issues" as dicts with the "line" number, the "error" kind and the
+        "text" of the line, and "valid", which is True if there were no
+        errors. The error kinds are:
+
+            "malformed" - Wrong number of fields, non-digits in numbers, etc.
+            "overflow" - RSID or position too large.
+            "unknown_chromosome" - Not 1-25, X, Y or MT.
+            "invalid_genotype" - Not one or two of A, C, G, T, D, I and -.
+            "truncated" - An invalid last line without a newline, or
+                          compressed data cut short. A valid SNP on the last
+                          line is loaded and counted without a newline.
+        """
+        return self._parse_report
+
+    @property
+    def read_only(Genome self):
+        """True if the genome is backed by read-only storage, e.g. when loaded
+        with ``load_binary``."""
+        return self._genome.read_only()
+
+    cdef CGenomeInfo _info(Genome self):
+        cdef CGenomeInfo info
+        info.name = self._name.encode("utf-8")
+        info.ethnicity = self._ethnicity.encode("utf-8")
+        info.orientation = self._orientation
+        return info
+
+    cdef _set_info(Genome self, const CGenomeInfo& info):
+        self._name = info.name
+        self._ethnicity = info.ethnicity
+        self._orientation = info.orientation
+
+    def save(Genome self, filename):
+        """Saves the genome in arv's binary format.
+
+        The file holds the SNPs sorted by RSID along with the genome's name,
+        ethnicity and orientation, and can be loaded with ``load_binary``
+        much faster than parsing the original text file. It is written to a
+        temporary file that replaces the target when complete, so genomes
+        loaded from the target are not affected.
+
+        Arguments:
+            filename: Name of file to write.
+
+        Raises:
+            RuntimeError - File could not be written.
+        """
+        cdef string c_filename = filename.encode("utf-8")
+        cdef CGenomeInfo info = self._info()
+        with nogil:
+            save_binary(c_filename, self._genome, info)
+
+    def save_shared(Genome self, shm_name):
+        """Saves the genome in arv's binary format to a new POSIX shared
+        memory object.
+
+        Other processes can then attach to it by name with ``load_shared``,
+        all sharing the same physical pages. The object lives until it is
+        removed with ``unlink_shared``, even after this process exits.
+
+        Arguments:
+            shm_name: Name of the shared memory object, like "genome". A
+                      leading slash is added if missing.
+
+        Raises:
+            RuntimeError - Name already in use, out of memory, etc.
+        """
+        cdef string c_name = shm_name.encode("utf-8")
+        cdef CGenomeInfo info = self._info()
+        with nogil:
+            save_shared(c_name, self._genome, info)
+
+    @cython.boundscheck(False)
+    def __reduce_ex__(Genome self, protocol):
+        """Pickles the genome in arv's binary format (see ``save``).
+
+        With pickle protocol 5, the data is passed as an out-of-band buffer,
+        so it can be sent to other processes without extra copies. Unpickled
+        genomes use the pickled data in place and are read-only.
+        """
+        cdef CGenomeInfo info = self._info()
+        cdef size_t size = binary_size(self._genome, info)
+        data = bytearray(size)
+        cdef unsigned char[::1] out = data
+
+        with nogil:
+            write_binary(<char*>&out[0], self._genome, info)
+
+        if protocol >= 5:
+            from pickle import PickleBuffer
+            data = PickleBuffer(data)
+
+        return (_unpickle_genome, (data,))
+
+    def __reduce__(Genome self):
+        return self.__reduce_ex__(0)
+
     def keys(self):
-        return GenomeIterator._iterate(self._genome, 0)
+        return GenomeIterator._iterate(self, self._genome, 0)
 
     def values(self):
-        return GenomeIterator._iterate(self._genome, 1)
+        return GenomeIterator._iterate(self, self._genome, 1)
 
     def items(self):
-        return GenomeIterator._iterate(self._genome, 2)
+        return GenomeIterator._iterate(self, self._genome, 2)
+
+    def __iter__(self):
+        return self.keys()
 
     def __len__(self):
         return self._genome.size()
@@ -457,6 +913,145 @@ cdef class Genome(object):
     def __contains__(self, key):
         return self._genome.has(__rsid2int(key))
 
+    @cython.boundscheck(False)
+    def lookup_many(Genome self, rsids):
+        """Looks up many RSIDs at once, returning NumPy arrays.
+
+        This is much faster than looking up each RSID with ``genome[rsid]``,
+        since the lookups are done in one native loop with the GIL released,
+        and no ``SNP`` objects are created. Requires NumPy.
+
+        Arguments:
+            rsids: A one-dimensional integer NumPy array of RSIDs, or a
+                   sequence of RSIDs as accepted by ``__getitem__``.
+
+        Returns:
+            A dict of arrays with one element per RSID:
+
+                chromosome: uint8 with 1-22 for autosomes, 23 for X, 24 for Y,
+                            25 for MT and 0 if not found.
+                position:   uint32 position, 0 if not found.
+                genotype:   uint8 genotype code, see ``Genotype.code``.
+                found:      bool, True if the RSID is in the genome.
+
+        Usage:
+            >>> result = genome.lookup_many(["rs123", "rs1426654"])
+            >>> result["found"]
+            array([False,  True])
+        """
+        import numpy
+
+        cdef int32_t[::1] c_rsids = _rsid_array(rsids)
+        cdef size_t count = c_rsids.shape[0]
+
+        chromosomes = numpy.empty(count, dtype=numpy.uint8)
+        positions = numpy.empty(count, dtype=numpy.uint32)
+        genotypes = numpy.empty(count, dtype=numpy.uint8)
+        found = numpy.empty(count, dtype=numpy.uint8)
+
+        cdef uint8_t[::1] c_chromosomes = chromosomes
+        cdef uint32_t[::1] c_positions = positions
+        cdef uint8_t[::1] c_genotypes = genotypes
+        cdef uint8_t[::1] c_found = found
+
+        if count > 0:
+            with nogil:
+                lookup_many(self._genome, &c_rsids[0], count,
+                        &c_chromosomes[0], &c_positions[0], &c_genotypes[0],
+                        <bool*>&c_found[0])
+
+        return {
+            "chromosome": chromosomes,
+            "position": positions,
+            "genotype": genotypes,
+            "found": found.view(numpy.bool_),
+        }
+
+    @cython.boundscheck(False)
+    def to_numpy(Genome self):
+        """Exports all SNPs as NumPy arrays.
+
+        The arrays are filled in one native pass over the genome with the GIL
+        released, which is much faster than going through ``items()``.
+        Requires NumPy.
+
+        Returns:
+            A dict of arrays with one element per SNP, in the same order as
+            ``items()``:
+
+                rsid:       int32 RSID, negative for internal IDs (e.g. -123
+                            for "i123").
+                chromosome: uint8, see ``lookup_many``.
+                position:   uint32 position.
+                genotype:   uint8 genotype code, see ``Genotype.code``.
+        """
+        import numpy
+
+        cdef size_t count = self._genome.size()
+
+        rsids = numpy.empty(count, dtype=numpy.int32)
+        chromosomes = numpy.empty(count, dtype=numpy.uint8)
+        positions = numpy.empty(count, dtype=numpy.uint32)
+        genotypes = numpy.empty(count, dtype=numpy.uint8)
+
+        cdef int32_t[::1] c_rsids = rsids
+        cdef uint8_t[::1] c_chromosomes = chromosomes
+        cdef uint32_t[::1] c_positions = positions
+        cdef uint8_t[::1] c_genotypes = genotypes
+
+        if count > 0:
+            with nogil:
+                export_columns(self._genome, &c_rsids[0], &c_chromosomes[0],
+                        &c_positions[0], &c_genotypes[0])
+
+        return {
+            "rsid": rsids,
+            "chromosome": chromosomes,
+            "position": positions,
+            "genotype": genotypes,
+        }
+
+    def to_pandas(Genome self):
+        """Exports all SNPs as a pandas DataFrame with the columns of
+        ``to_numpy``. Requires pandas."""
+        import pandas
+        columns = self.to_numpy()
+        return pandas.DataFrame(columns,
+                columns=["rsid", "chromosome", "position", "genotype"])
+
+    def region(Genome self, chromosome, Position start, Position end):
+        """Returns all SNPs on a chromosome between two positions.
+
+        The first call builds an index of the SNPs sorted by chromosome and
+        position, which is kept until the genome is modified. Lookups are
+        then binary searches in the index, with the GIL released.
+
+        Arguments:
+            chromosome: 1 through 22, "X", "Y" or "MT". Strings like "6" and
+                        "chr6" are also accepted.
+
+            start: First position, inclusive.
+
+            end: Last position, inclusive.
+
+        Raises:
+            ValueError - Unknown chromosome.
+
+        Returns:
+            A list of (rsid, SNP) tuples sorted by position.
+
+        Usage:
+            >>> hla = genome.region(6, 29600000, 33400000)
+        """
+        cdef Chromosome c_chromosome = __chromosome(chromosome)
+        cdef vector[RsidSNP] snps
+
+        with nogil:
+            snps = self._genome.region(c_chromosome, start, end)
+
+        return [(__rsid2str(item.first), SNP._init(item.second)) for item in
+                snps]
+
     def __getitem__(self, key):
         """Retrieves SNP from its RSID.
 
@@ -490,9 +1085,409 @@ cdef class Genome(object):
 
         return SNP._init(snp)
 
+    def get_by_id(Genome self, RSID rsid):
+        """Retrieves SNP from its RSID as an integer.
+
+        Like ``__getitem__``, but faster when the RSIDs are already integers,
+        since no strings are involved. Internal IDs are negative, e.g. -123
+        for "i123".
+
+        Raises:
+            KeyError - RSID not found in genome.
+            OverflowError - RSID does not fit in 32 bits.
+
+        Returns:
+            An ``SNP``.
+
+        Usage:
+            >>> genome.get_by_id(2534636) == genome["rs2534636"]
+            True
+        """
+        cdef CSNP snp = self._genome[rsid]
+
+        if snp == NONE_SNP:
+            raise KeyError(rsid)
+
+        return SNP._init(snp)
+
+
+cdef class ShardedGenome(object):
+    """A genome file that is parsed one chromosome at a time, as needed.
+
+    Loading only finds out where the lines of each chromosome are, and each
+    chromosome is parsed into its own ``Genome`` the first time it is used.
+    Queries that touch one chromosome, like ``y_chromosome``, are then much
+    faster than parsing the whole file. Create with ``load_sharded``.
+
+    Implements the dictionary protocol. Looking up an RSID searches the
+    chromosomes parsed so far first, and then parses the others one by one
+    until it is found, so looking up a missing RSID parses everything. Use
+    ``chromosome`` when the chromosome is known.
+    """
+    cdef object _data
+    cdef Py_buffer _view
+    cdef bool _has_view
+    cdef ShardIndex _index
+    cdef list _shards
+    cdef object _storage
+
+    cdef public basestring name
+    cdef public basestring ethnicity
+    cdef public int orientation
+
+    def __cinit__(ShardedGenome self):
+        self._has_view = False
+        self._shards = [None] * (CHR_MT + 1)
+        self._storage = None
+        self.name = ""
+        self.ethnicity = ""
+        self.orientation = 1
+
+    def __dealloc__(ShardedGenome self):
+        if self._has_view:
+            PyBuffer_Release(&self._view)
+
+    cdef _open(ShardedGenome self, data, storage):
+        PyObject_GetBuffer(data, &self._view, PyBUF_SIMPLE)
+        self._has_view = True
+        self._data = data
+        self._storage = storage
+
+        with nogil:
+            index_shards(<const char*>self._view.buf, self._view.len,
+                    self._index)
+
+    cdef Genome _shard(ShardedGenome self, Chromosome c):
+        """Returns the genome of a chromosome, parsing it if necessary."""
+        cdef Genome genome = self._shards[c]
+        if genome is not None:
+            return genome
+
+        genome = Genome(0)
+        with nogil:
+            parse_shard(<const char*>self._view.buf, self._index, c,
+                    genome._genome)
+
+        genome.name = self.name
+        genome.ethnicity = self.ethnicity
+        genome.orientation = self.orientation
+        _with_storage(genome, self._storage)
+
+        self._shards[c] = genome
+        return genome
+
+    cdef list _order(ShardedGenome self):
+        """The chromosomes in the file, parsed ones first, with unreadable
+        lines last."""
+        present = [c for c in range(CHR_01, CHR_MT + 1) if
+                self._index.lines[c] > 0]
+        order = ([c for c in present if self._shards[c] is not None] +
+                 [c for c in present if self._shards[c] is None])
+        if self._index.lines[<int>CHR_NO] > 0:
+            order.append(CHR_NO)
+        return order
+
+    @property
+    def chromosomes(ShardedGenome self):
+        """The chromosomes in the file, like ``SNP.chromosome``. Known without
+        parsing them."""
+        return [__chromosome_name(<Chromosome>c) for c in range(CHR_01,
+            CHR_MT + 1) if self._index.lines[c] > 0]
+
+    @property
+    def loaded(ShardedGenome self):
+        """The chromosomes in the file that have been parsed so far."""
+        return [__chromosome_name(<Chromosome>c) for c in range(CHR_01,
+            CHR_MT + 1) if self._index.lines[c] > 0 and self._shards[c] is
+            not None]
+
+    def chromosome(ShardedGenome self, chromosome):
+        """Returns the SNPs of a chromosome as a ``Genome``, parsing them the
+        first time.
+
+        Arguments:
+            chromosome: 1 through 22, "X", "Y" or "MT". Strings like "6" and
+                        "chr6" are also accepted.
+
+        Raises:
+            ValueError - Unknown chromosome.
+        """
+        return self._shard(__chromosome(chromosome))
+
+    @property
+    def y_chromosome(ShardedGenome self):
+        """A boolean indicating the presence of a Y-chromosome within this
+        genome. Only parses the Y-chromosome."""
+        return self._shard(CHR_Y).y_chromosome
+
+    def load_all(ShardedGenome self):
+        """Parses all chromosomes that have not been parsed yet."""
+        for c in self._order():
+            self._shard(c)
+
+    def memory_usage(ShardedGenome self):
+        """Approximate number of bytes used by the parsed chromosomes."""
+        return sum(shard.memory_usage() for shard in self._shards if shard is
+                not None)
+
+    def _find(ShardedGenome self, key):
+        """Returns the genome holding the RSID, or None."""
+        __rsid2int(key) # validates the key before parsing anything
+
+        for c in self._order():
+            genome = self._shard(c)
+            if key in genome:
+                return genome
+
+        return None
+
+    def __getitem__(ShardedGenome self, key):
+        """Retrieves SNP from its RSID, like ``Genome.__getitem__``.
+
+        Raises:
+            KeyError - RSID not found in genome.
+        """
+        genome = self._find(key)
+        if genome is None:
+            raise KeyError(key)
+        return genome[key]
+
+    def __contains__(ShardedGenome self, key):
+        return self._find(key) is not None
+
+    def __len__(ShardedGenome self):
+        self.load_all()
+        return sum(len(shard) for shard in self._shards if shard is not None)
+
+    def __repr__(ShardedGenome self):
+        return "<ShardedGenome: chromosomes=%d, loaded=%d, name=%r>" % (
+                len(self.chromosomes), len(self.loaded), self.name)
+
+    def _genomes(ShardedGenome self):
+        for c in range(CHR_NO, CHR_MT + 1):
+            if self._index.lines[c] > 0:
+                yield self._shard(<Chromosome>c)
+
+    def keys(ShardedGenome self):
+        """Iterates over the RSIDs, chromosome by chromosome."""
+        for genome in self._genomes():
+            for key in genome.keys():
+                yield key
+
+    def values(ShardedGenome self):
+        """Iterates over the SNPs, chromosome by chromosome."""
+        for genome in self._genomes():
+            for value in genome.values():
+                yield value
+
+    def items(ShardedGenome self):
+        """Iterates over (RSID, SNP) tuples, chromosome by chromosome."""
+        for genome in self._genomes():
+            for item in genome.items():
+                yield item
+
+    def __iter__(ShardedGenome self):
+        return self.keys()
+
+
+cdef class Cohort(object):
+    """Genotypes of many genomes, stored together in a compact matrix.
+
+    All genomes share one RSID index, and each genotype takes up half a byte,
+    so a cohort takes a fraction of the memory of separate ``Genome``
+    objects. Looking up an RSID gives the genotypes of all genomes at once.
+
+    Create cohorts with ``load_cohort``.
+    """
+    cdef CCohort* _cohort
+    cdef list _names
+
+    def __cinit__(Cohort self):
+        self._cohort = new CCohort(0)
+        self._names = []
+
+    def __dealloc__(Cohort self):
+        del self._cohort
+
+    @property
+    def names(Cohort self):
+        """Names of the genomes, in column order."""
+        return list(self._names)
+
+    @property
+    def snp_count(Cohort self):
+        """Number of distinct RSIDs in all the genomes."""
+        return self._cohort.size()
+
+    def memory_usage(Cohort self):
+        """Approximate number of bytes used by the cohort."""
+        return self._cohort.memory_usage()
+
+    cdef size_t _row(Cohort self, key) except? -1:
+        cdef size_t row = self._cohort.find(__rsid2int(key))
+        if row == COHORT_NPOS:
+            raise KeyError(key)
+        return row
+
+    def __len__(Cohort self):
+        return self._cohort.genomes()
+
+    def __repr__(Cohort self):
+        return "<Cohort: genomes=%d, SNPs=%d>" % (len(self), self.snp_count)
+
+    def __contains__(Cohort self, key):
+        return self._cohort.find(__rsid2int(key)) != COHORT_NPOS
+
+    def rsids(Cohort self):
+        """Returns all RSIDs in the cohort, as strings."""
+        return [__rsid2str(self._cohort.rsid(row)) for row in
+                range(self._cohort.size())]
+
+    def genotype(Cohort self, Py_ssize_t index, key):
+        """Returns the ``Genotype`` of one genome. Missing genotypes are
+        no-calls. Negative indices count from the end, as for sequences.
+
+        Raises:
+            IndexError - No genome with the index.
+            KeyError - RSID not in any genome.
+        """
+        cdef Py_ssize_t count = self._cohort.genomes()
+        if index < -count or index >= count:
+            raise IndexError(index)
+        if index < 0:
+            index += count
+        return Genotype._init(self._cohort.genotype(self._row(key), index))
+
+    @cython.boundscheck(False)
+    def genotypes(Cohort self, key):
+        """Returns the genotypes of all genomes for an RSID as a NumPy array of
+        genotype codes (see ``Genotype.code``), in column order. Missing
+        genotypes and no-calls are zero. Requires NumPy.
+
+        Raises:
+            KeyError - RSID not in any genome.
+
+        Usage:
+            >>> codes = cohort.genotypes("rs4988235")
+            >>> counts = numpy.bincount(codes, minlength=64)
+        """
+        import numpy
+
+        cdef size_t row = self._row(key)
+        result = numpy.empty(self._cohort.genomes(), dtype=numpy.uint8)
+        cdef uint8_t[::1] out = result
+
+        if out.shape[0] > 0:
+            with nogil:
+                self._cohort.genotypes(row, &out[0])
+
+        return result
+
+
+cdef class RuleProgram(object):
+    """Rules mapping the genotype of an RSID to a phenotype index, evaluated
+    for a genome in one native pass. See ``arv.rules`` for how rules are
+    compiled into a program."""
+    cdef CRuleProgram _program
+
+    def add(RuleProgram self, rsid, table):
+        """Adds a rule for an RSID. The table is a sequence of 64 phenotype
+        indices, indexed by genotype code (see ``Genotype.code``), with -1 for
+        genotypes that don't match."""
+        if len(table) != RULE_TABLE_SIZE:
+            raise ValueError("Rule table must have %d entries" %
+                    RULE_TABLE_SIZE)
+
+        cdef vector[int16_t] c_table = table
+        self._program.add(__rsid2int(rsid), c_table.data())
+
+    def __len__(RuleProgram self):
+        return self._program.size()
+
+    def evaluate(RuleProgram self, Genome genome):
+        """Returns a list with a phenotype index for each rule, -1 for rules
+        that don't match or whose RSID is not in the genome."""
+        cdef vector[int16_t] out = vector[int16_t](self._program.size())
+
+        with nogil:
+            self._program.evaluate(genome._genome, out.data())
+
+        return out
+
+
+@cython.boundscheck(False)
+def _unpickle_genome(data):
+    """Recreates a pickled genome from a buffer in arv's binary format. The
+    genome refers to the buffer in place and keeps it alive."""
+    view = memoryview(data)
+    if not view.c_contiguous or view.format != "B":
+        view = memoryview(view.tobytes())
+
+    cdef const unsigned char[::1] c_view = view
+    cdef const char* c_data = <const char*>&c_view[0]
+
+    # The SNP arrays are 8-byte aligned relative to the start of the data
+    if <size_t>c_data % 8 != 0:
+        view = memoryview(view.tobytes())
+        c_view = view
+        c_data = <const char*>&c_view[0]
+
+    cdef shared_ptr[const void] owner = python_owner(<PyObject*>view)
+    cdef size_t size = c_view.shape[0]
+    cdef Genome genome = Genome(0)
+    cdef CGenomeInfo info
+
+    with nogil:
+        read_binary(c_data, size, owner, genome._genome, info, False)
+
+    genome._set_info(info)
+    return genome
+
+PARSE_ERRORS = ("malformed", "overflow", "unknown_chromosome",
+        "invalid_genotype", "truncated")
+
+cdef ParseReport* _new_report(bool validate, size_t max_issues):
+    """Returns a report for validating parsers, or NULL."""
+    return new ParseReport(max_issues) if validate else NULL
+
+cdef dict _report_dict(const ParseReport& report):
+    """Converts a parse report to the dict of ``Genome.parse_report``."""
+    cdef const ParseIssue* issue
+    cdef size_t n
+
+    errors = {}
+    for n in range(ERROR_KINDS):
+        errors[PARSE_ERRORS[n]] = report.errors[n]
+
+    issues = []
+    for n in range(report.issues.size()):
+        issue = &report.issues[n]
+        issues.append({
+            "line": issue.line,
+            "error": PARSE_ERRORS[<int>issue.error],
+            "text": PyBytes_FromStringAndSize(issue.text.data(),
+                issue.text.size()).decode("utf-8", "replace"),
+        })
+
+    return {
+        "lines": report.lines,
+        "snps": report.snps,
+        "comments": report.comments,
+        "blanks": report.blanks,
+        "errors": errors,
+        "issues": issues,
+        "valid": report.error_count() == 0,
+    }
+
+cdef Genome _with_storage(Genome genome, storage):
+    """Converts the genome to the requested storage, if any."""
+    if storage is not None and storage != genome.storage:
+        genome.convert_storage(storage)
+    return genome
 
 def load(filename, name=None, ethnicity=None, size_t initial_size=1000003,
-        orientation=1):
+        orientation=1, size_t threads=1, cache_dir=None, storage=None,
+        bool validate=False, size_t max_issues=100):
     """Loads given 23andMe raw genome file.
 
     Arguments:
@@ -511,19 +1506,662 @@ def load(filename, name=None, ethnicity=None, size_t initial_size=1000003,
                                 strand. 23andMe files have always plus
                                 orientation.
 
+        threads (optional): Number of threads to parse the file with. The file
+                            is split into chunks at line boundaries that are
+                            parsed concurrently and then merged into the
+                            genome. Zero means one thread per CPU core.
+                            Default is 1.
+
+        cache_dir (optional): Directory for caching parsed genomes, see
+                              ``arv.cache``. Defaults to the ARV_CACHE_DIR
+                              environment variable, if set. An empty string
+                              disables caching.
+
+        storage (optional): Type of storage for the SNPs: "hash", "sorted",
+                            "eytzinger" or "compressed", see
+                            ``Genome.convert_storage``. The read-only
+                            storages take less memory, "compressed" the
+                            least, and "eytzinger" gives the fastest
+                            lookups of them. Parsed genomes use "hash" and
+                            cached ones "sorted" by default.
+
+        validate (optional): Check every line strictly, skipping invalid ones
+                             instead of parsing them as well as possible, and
+                             put a report of them in ``Genome.parse_report``.
+                             Truncated compressed files are reported instead
+                             of raising. Always parses the file, bypassing
+                             the cache. Default is False.
+
+        max_issues (optional): Number of invalid lines to keep in the report
+                               when validating. Default is 100.
+
+    The GIL is released while parsing, so several Python threads can load
+    genomes concurrently.
+
     Raises:
         RuntimeError - File not found, parser errors, etc.
 
     Returns:
         A ``Genome``.
     """
+    if cache_dir is None:
+        cache_dir = os.getenv("ARV_CACHE_DIR")
+
+    if cache_dir and not validate:
+        import arv.cache
+        return _with_storage(arv.cache.load(filename, cache_dir, name=name,
+                ethnicity=ethnicity, orientation=orientation, threads=threads),
+                storage)
+
     cdef Genome genome = Genome(0)
-    parse_file(filename.encode("utf-8"), genome._genome)
+    cdef string c_filename = filename.encode("utf-8")
+    cdef ParseReport* report = _new_report(validate, max_issues)
+
+    try:
+        with nogil:
+            parse_file(c_filename, genome._genome, threads, report)
+        if report != NULL:
+            genome._parse_report = _report_dict(report[0])
+    finally:
+        del report
+
     genome.name = name if name is not None else filename
     genome.ethnicity = ethnicity if ethnicity is not None else ""
     genome.orientation = orientation
+    return _with_storage(genome, storage)
+
+def loads(data, name=None, ethnicity=None, orientation=1, size_t threads=1,
+        storage=None, bool validate=False, size_t max_issues=100):
+    """Loads a 23andMe raw genome from memory.
+
+    The data is parsed in place, without copying it, so this is the way to
+    load genomes that were never written to disk, like uploads.
+
+    Arguments:
+        data: Contents of a genome file, as an object supporting the buffer
+              protocol, like bytes, bytearray, memoryview or mmap. May be gzip
+              or zip compressed.
+
+        name (optional): Name to give the genome. Empty by default.
+
+        ethnicity, orientation, threads, storage, validate, max_issues
+        (optional): See ``load``.
+
+    Raises:
+        TypeError - The data does not support the buffer protocol.
+        RuntimeError - Parser errors, etc.
+
+    Returns:
+        A ``Genome``.
+    """
+    cdef Genome genome = Genome(0)
+    cdef Py_buffer view
+    cdef ParseReport* report = _new_report(validate, max_issues)
+
+    PyObject_GetBuffer(data, &view, PyBUF_SIMPLE)
+    try:
+        with nogil:
+            parse_buffer(<const char*>view.buf, view.len, genome._genome,
+                    threads, report)
+        if report != NULL:
+            genome._parse_report = _report_dict(report[0])
+    finally:
+        PyBuffer_Release(&view)
+        del report
+
+    genome.name = name if name is not None else ""
+    genome.ethnicity = ethnicity if ethnicity is not None else ""
+    genome.orientation = orientation
+    return _with_storage(genome, storage)
+
+cdef _feed(StreamParser* parser, data):
+    """Parses a chunk of data with the GIL released."""
+    cdef Py_buffer view
+
+    PyObject_GetBuffer(data, &view, PyBUF_SIMPLE)
+    try:
+        with nogil:
+            parser.feed(<const char*>view.buf, view.len)
+    finally:
+        PyBuffer_Release(&view)
+
+cdef _feed_gzip(StreamParser* parser, decompressor, data):
+    """Decompresses and parses a chunk of a gzip stream. Returns the
+    decompressor to use for the next chunk, or None if the rest of the stream
+    should be ignored."""
+    _feed(parser, decompressor.decompress(data))
+
+    # Concatenated members. Like gzip, ignore anything else at the end.
+    while decompressor.eof:
+        data = decompressor.unused_data
+        if not data:
+            break
+        if data[:2] != b"\x1f\x8b":
+            return None
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        _feed(parser, decompressor.decompress(data))
+
+    return decompressor
+
+def load_stream(fileobj, name=None, ethnicity=None, orientation=1,
+        size_t chunk_size=1<<20, storage=None, bool validate=False,
+        size_t max_issues=100):
+    """Loads a 23andMe raw genome from a binary file object, like a pipe or a
+    socket.
+
+    The stream is read and parsed in chunks, with the GIL released while
+    parsing, so only one chunk is held in memory at a time. Gzip compressed
+    streams are decompressed on the fly.
+
+    Arguments:
+        fileobj: Object with a ``read`` method returning bytes. Its
+                 ``readinto`` method is used if it has one.
+
+        name (optional): Name to give the genome. Uses the file object's name
+                         by default, if it has one.
+
+        ethnicity, orientation, storage, validate, max_issues (optional): See
+        ``load``.
+
+        chunk_size (optional): Number of bytes to read at a time. Default is
+                               1 MiB.
+
+    Raises:
+        RuntimeError - Parser errors, truncated gzip streams, etc.
+
+    Returns:
+        A ``Genome``.
+    """
+    if chunk_size == 0:
+        raise ValueError("chunk_size must be positive")
+
+    cdef Genome genome = Genome(0)
+    cdef ParseReport* report = _new_report(validate, max_issues)
+    cdef StreamParser* parser = new StreamParser(genome._genome, report)
+
+    readinto = getattr(fileobj, "readinto", None)
+    if readinto is not None:
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+
+    head = b""
+    decompressor = None
+
+    try:
+        while True:
+            if readinto is not None:
+                count = readinto(buf)
+                chunk = view[:count] if count else None
+            else:
+                chunk = fileobj.read(chunk_size)
+
+            if not chunk:
+                if head:
+                    _feed(parser, head)
+                break
+
+            # Look at the first two bytes to see if the stream is compressed,
+            # which may take several short reads
+            if head is not None:
+                head += bytes(chunk)
+                if len(head) < 2:
+                    continue
+                chunk, head = head, None
+                if chunk[:2] == b"\x1f\x8b":
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+            if decompressor is not None:
+                decompressor = _feed_gzip(parser, decompressor, chunk)
+                if decompressor is None:
+                    break
+            else:
+                _feed(parser, chunk)
+
+        truncated = decompressor is not None and not decompressor.eof
+        if truncated and report == NULL:
+            raise RuntimeError("Truncated gzip stream")
+
+        if report != NULL:
+            reported = report.errors[<int>ERROR_TRUNCATED]
+
+        with nogil:
+            parser.finish()
+
+        if report != NULL:
+            # Like parse_gzip, unless the last line was reported already
+            if truncated and report.errors[<int>ERROR_TRUNCATED] == reported:
+                report.add(ERROR_TRUNCATED, report.lines + 1, "", "")
+            genome._parse_report = _report_dict(report[0])
+    except zlib.error as e:
+        raise RuntimeError("Could not decompress stream: %s" % e)
+    finally:
+        del parser
+        del report
+
+    if name is None:
+        name = getattr(fileobj, "name", "")
+        if not isinstance(name, basestring):
+            name = ""
+
+    genome.name = name
+    genome.ethnicity = ethnicity if ethnicity is not None else ""
+    genome.orientation = orientation
+    return _with_storage(genome, storage)
+
+def _map_text_file(filename, purpose):
+    """Memory maps an uncompressed genome file read-only. Empty files give an
+    empty bytes object, since they can't be mapped."""
+    try:
+        f = open(filename, "rb")
+    except (IOError, OSError) as e:
+        raise RuntimeError("Could not open %s: %s" % (filename, e))
+
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size > 0:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = b""
+
+    if data[:2] == b"\x1f\x8b" or data[:4] == b"PK\x03\x04":
+        raise RuntimeError("Compressed files can't be %s: %s" % (purpose,
+            filename))
+
+    return data
+
+def load_sharded(filename, name=None, ethnicity=None, orientation=1,
+        storage=None):
+    """Loads a 23andMe raw genome file one chromosome at a time, as needed.
+
+    The file is memory mapped and quickly scanned to find the lines of each
+    chromosome, which are only parsed when the chromosome is used. This is
+    the fastest way to answer questions about a single chromosome, like the
+    Y-chromosome or mitochondrial DNA.
+
+    Arguments:
+        filename: Name of an uncompressed file to load.
+
+        name, ethnicity, orientation, storage (optional): See ``load``. The
+        storage is used for each chromosome.
+
+    Raises:
+        RuntimeError - File not found or compressed.
+
+    Returns:
+        A ``ShardedGenome``.
+
+    Usage:
+        >>> genome = arv.load_sharded("genome.txt")
+        >>> genome.y_chromosome
+        True
+        >>> genome.chromosome("MT")["i3001754"]
+        <SNP: chromosome='MT' position=16256 genotype=<Genotype 'A'>>
+    """
+    data = _map_text_file(filename, "loaded sharded")
+    cdef ShardedGenome genome = ShardedGenome()
+    genome.name = name if name is not None else filename
+    genome.ethnicity = ethnicity if ethnicity is not None else ""
+    genome.orientation = orientation
+    genome._open(data, storage)
+    return genome
+
+# Pages of a file already parsed are dropped from memory in steps of this size
+cdef size_t DROP_SIZE = 1 << 22
+
+cdef class _FileReader(object):
+    """Parses the SNPs of a memory mapped genome file in batches, without
+    storing them in a genome."""
+    cdef object _data
+    cdef Py_buffer _view
+    cdef bool _has_view
+    cdef size_t _pos
+    cdef size_t _dropped
+    cdef vector[RsidSNP] _batch
+
+    def __cinit__(_FileReader self, filename):
+        self._has_view = False
+        self._pos = 0
+        self._dropped = 0
+        self._data = _map_text_file(filename, "iterated")
+
+        if hasattr(self._data, "madvise") and hasattr(mmap,
+                "MADV_SEQUENTIAL"):
+            self._data.madvise(mmap.MADV_SEQUENTIAL)
+
+        PyObject_GetBuffer(self._data, &self._view, PyBUF_SIMPLE)
+        self._has_view = True
+
+    def __dealloc__(_FileReader self):
+        if self._has_view:
+            PyBuffer_Release(&self._view)
+
+    cdef size_t read(_FileReader self, size_t size) except? 0:
+        """Parses the next batch of at most size SNPs into _batch."""
+        cdef const char* data = <const char*>self._view.buf
+        cdef const char* s = data + self._pos
+        cdef size_t count
+
+        self._batch.resize(size)
+        with nogil:
+            count = parse_snps(s, data + self._view.len,
+                    self._batch.data(), size)
+        self._batch.resize(count)
+        self._pos = s - data
+
+        # Keep memory use constant for big files, by letting the kernel drop
+        # the pages we're done with
+        if (self._pos - self._dropped >= DROP_SIZE and
+                hasattr(mmap, "MADV_DONTNEED")):
+            length = (self._pos - self._dropped) // mmap.PAGESIZE * \
+                    mmap.PAGESIZE
+            self._data.madvise(mmap.MADV_DONTNEED, self._dropped, length)
+            self._dropped += length
+
+        return count
+
+    cdef list items(_FileReader self):
+        return [(__rsid2str(item.first), SNP._init(item.second)) for item in
+                self._batch]
+
+    @cython.boundscheck(False)
+    cdef dict columns(_FileReader self):
+        import numpy
+
+        cdef size_t count = self._batch.size()
+        cdef size_t n
+
+        rsids = numpy.empty(count, dtype=numpy.int32)
+        chromosomes = numpy.empty(count, dtype=numpy.uint8)
+        positions = numpy.empty(count, dtype=numpy.uint32)
+        genotypes = numpy.empty(count, dtype=numpy.uint8)
+
+        cdef int32_t[::1] c_rsids = rsids
+        cdef uint8_t[::1] c_chromosomes = chromosomes
+        cdef uint32_t[::1] c_positions = positions
+        cdef uint8_t[::1] c_genotypes = genotypes
+
+        for n in range(count):
+            c_rsids[n] = self._batch[n].first
+            c_chromosomes[n] = <uint8_t>self._batch[n].second.chromosome
+            c_positions[n] = self._batch[n].second.position
+            c_genotypes[n] = self._batch[n].second.genotype.code()
+
+        return {
+            "rsid": rsids,
+            "chromosome": chromosomes,
+            "position": positions,
+            "genotype": genotypes,
+        }
+
+def _iter_items(_FileReader reader):
+    while reader.read(4096) > 0:
+        for item in reader.items():
+            yield item
+
+def _iter_batches(_FileReader reader, size_t batch_size):
+    while reader.read(batch_size) > 0:
+        yield reader.columns()
+
+def iter_file(filename):
+    """Iterates over the SNPs of a 23andMe raw genome file, without loading
+    it into a genome.
+
+    The file is memory mapped and parsed a batch of lines at a time, so
+    memory use stays constant whatever the size of the file. This is faster
+    and leaner than ``load`` for jobs that only need one pass, like filtering
+    or converting. Every SNP line is yielded in file order, including any
+    duplicate RSIDs.
+
+    Arguments:
+        filename: Name of an uncompressed file.
+
+    Raises:
+        RuntimeError - File not found or compressed.
+
+    Returns:
+        An iterator of (rsid, SNP) tuples, like ``Genome.items``.
+
+    Usage:
+        >>> for rsid, snp in arv.iter_file("genome.txt"):
+        ...     if snp.chromosome == "MT":
+        ...         print(rsid, snp.genotype)
+    """
+    return _iter_items(_FileReader(filename))
+
+def iter_file_batches(filename, size_t batch_size=65536):
+    """Iterates over the SNPs of a 23andMe raw genome file in batches of
+    NumPy arrays, without loading it into a genome. See ``iter_file``.
+    Requires NumPy.
+
+    Arguments:
+        filename: Name of an uncompressed file.
+
+        batch_size (optional): Largest number of SNPs per batch. Only the
+                               last batch is smaller. Default is 65536.
+
+    Raises:
+        RuntimeError - File not found or compressed.
+        ValueError - batch_size is zero.
+
+    Returns:
+        An iterator of dicts of arrays, with the columns of
+        ``Genome.to_numpy``.
+
+    Usage:
+        >>> for batch in arv.iter_file_batches("genome.txt"):
+        ...     counts += numpy.bincount(batch["chromosome"], minlength=26)
+    """
+    if batch_size == 0:
+        raise ValueError("batch_size must be positive")
+    return _iter_batches(_FileReader(filename), batch_size)
+
+def load_binary(filename, name=None, ethnicity=None, bool verify=True):
+    """Loads a genome saved with ``Genome.save``.
+
+    The file is memory mapped read-only and SNPs are looked up directly in the
+    mapping, so loading is nearly instant and processes loading the same file
+    share its pages. The returned genome is read-only.
+
+    Arguments:
+        filename: Name of file to load.
+
+        name (optional): Name to give the genome. Uses the saved name by
+                         default.
+
+        ethnicity (optional): Ethnicity to give the genome. Uses the saved
+                              ethnicity by default.
+
+        verify (optional): Verify the file's checksum. This reads the entire
+                           file up front. Default is True.
+
+    Raises:
+        RuntimeError - File not found, not an arv genome, corrupt, etc.
+
+    Returns:
+        A ``Genome``.
+    """
+    cdef Genome genome = Genome(0)
+    cdef string c_filename = filename.encode("utf-8")
+    cdef CGenomeInfo info
+
+    with nogil:
+        c_load_binary(c_filename, genome._genome, info, verify)
+
+    genome._set_info(info)
+    if name is not None:
+        genome.name = name
+    if ethnicity is not None:
+        genome.ethnicity = ethnicity
+    return genome
+
+def load_shared(shm_name, name=None, ethnicity=None, bool verify=False):
+    """Attaches to a genome saved with ``Genome.save_shared``.
+
+    The shared memory is mapped read-only, and SNPs are looked up directly in
+    it, so no process holds a copy of its own. The returned genome is
+    read-only, and stays usable after the object has been unlinked.
+
+    Arguments:
+        shm_name: Name of the shared memory object.
+
+        name (optional): Name to give the genome. Uses the saved name by
+                         default.
+
+        ethnicity (optional): Ethnicity to give the genome. Uses the saved
+                              ethnicity by default.
+
+        verify (optional): Verify the checksum. This reads all of the shared
+                           memory up front. Default is False.
+
+    Raises:
+        RuntimeError - No such object, not an arv genome, corrupt, etc.
+
+    Returns:
+        A ``Genome``.
+    """
+    cdef Genome genome = Genome(0)
+    cdef string c_name = shm_name.encode("utf-8")
+    cdef CGenomeInfo info
+
+    with nogil:
+        c_load_shared(c_name, genome._genome, info, verify)
+
+    genome._set_info(info)
+    if name is not None:
+        genome.name = name
+    if ethnicity is not None:
+        genome.ethnicity = ethnicity
     return genome
 
+def unlink_shared(shm_name):
+    """Removes a shared memory object created by ``Genome.save_shared``.
+
+    Genomes already attached to it remain valid, and the memory is freed when
+    the last of them is gone.
+
+    Raises:
+        RuntimeError - No such object.
+    """
+    cdef string c_name = shm_name.encode("utf-8")
+    with nogil:
+        c_unlink_shared(c_name)
+
+def load_many(filenames, ethnicity=None, orientation=1, size_t workers=0):
+    """Loads several 23andMe raw genome files in parallel.
+
+    The files are parsed by a pool of native threads with the GIL released,
+    each file into its own genome.
+
+    Arguments:
+        filenames: Names of files to load.
+
+        ethnicity (optional): Ethnicity to give all the genomes. See ``load``.
+
+        orientation (optional): +1 or -1, see ``load``.
+
+        workers (optional): Number of worker threads. Zero means one thread per
+                            CPU core. Default is 0.
+
+    Raises:
+        RuntimeError - File not found, parser errors, etc.
+
+    Returns:
+        A list of ``Genome``\ s, in the same order as ``filenames``. Each
+        genome is named after its file.
+    """
+    filenames = list(filenames)
+
+    cdef vector[string] c_filenames
+    cdef vector[CGenome*] c_genomes
+    cdef Genome genome
+    genomes = []
+
+    for filename in filenames:
+        genome = Genome(0)
+        genome.name = filename
+        genome.ethnicity = ethnicity if ethnicity is not None else ""
+        genome.orientation = orientation
+        genomes.append(genome)
+        c_filenames.push_back(filename.encode("utf-8"))
+        c_genomes.push_back(&genome._genome)
+
+    with nogil:
+        parse_files(c_filenames, c_genomes, workers)
+
+    return genomes
+
+def load_cohort(filenames, size_t workers=0):
+    """Loads several 23andMe raw genome files into a ``Cohort``.
+
+    The files are parsed by a pool of native threads with the GIL released,
+    one batch of ``workers`` files at a time, and each batch is merged into
+    the cohort's genotype matrix before the next is parsed.
+
+    Arguments:
+        filenames: Names of files to load. They become the cohort's names.
+
+        workers (optional): Number of worker threads. Zero means one thread per
+                            CPU core. Default is 0.
+
+    Raises:
+        RuntimeError - File not found, parser errors, or an RSID with more than
+                       15 distinct genotypes in the cohort.
+
+    Returns:
+        A ``Cohort``.
+    """
+    filenames = list(filenames)
+
+    cdef vector[string] c_filenames
+    for filename in filenames:
+        c_filenames.push_back(filename.encode("utf-8"))
+
+    cdef Cohort cohort = Cohort()
+    del cohort._cohort
+    cohort._cohort = new CCohort(len(filenames))
+    cohort._names = filenames
+
+    with nogil:
+        c_load_cohort(c_filenames, cohort._cohort[0], workers)
+
+    return cohort
+
+def _checksum_file(filename):
+    """Returns a fast 64-bit checksum of the file's contents."""
+    cdef string c_filename = filename.encode("utf-8")
+    cdef uint64_t result
+    with nogil:
+        result = checksum_file(c_filename)
+    return result
+
+_SCANNERS = {
+    "scalar": SCANNER_SCALAR,
+    "swar": SCANNER_SWAR,
+    "sse2": SCANNER_SSE2,
+    "avx2": SCANNER_AVX2,
+}
+
+def _scanner(name=None):
+    """Returns the name of the scanner the parser uses to find fields, first
+    switching to the given one if any: "scalar" for the byte by byte parser,
+    or "swar", "sse2" or "avx2" for bulk scanning. For benchmarks and
+    tests."""
+    if name is not None:
+        if name not in _SCANNERS:
+            raise ValueError("Unknown scanner: %r" % (name,))
+        set_scanner(_SCANNERS[name])
+
+    current = get_scanner()
+    for key, value in _SCANNERS.items():
+        if value == current:
+            return key
+
+def _scanners():
+    """Returns the names of the scanners supported by the CPU, slowest
+    first."""
+    return [key for key, value in sorted(_SCANNERS.items(),
+        key=lambda item: item[1]) if scanner_supported(value)]
+
 def _sizes():
     """Returns C++ sizeof() for internal structures."""
     return {
@@ -2,6 +2,7 @@ from setuptools import setup, Extension
 from setuptools.command.build_ext import build_ext
 import os
 import shutil
+import sys
 import unittest
 
 class ArvOptions:
@@ -22,7 +23,8 @@ class ArvOptions:
             return flags
 
         flags += ["--std=c++11", # REQUIRED
-                  "-DBUILDING_DLL"] # REQUIRED
+                  "-DBUILDING_DLL", # REQUIRED
+                  "-pthread"] # REQUIRED
 
         if ArvOptions.warnings:
             flags += ["-W", "-Wall"]
@@ -53,6 +55,8 @@ class ArvOptions:
         if not ArvOptions.is_gcc:
             return flags
 
+        flags += ["-pthread"] # REQUIRED
+
         if ArvOptions.strip:
             flags += ["-Wl,-s"]
 
@@ -93,14 +97,23 @@ def extensions():
     exts = [
         Extension("_arv", [
                 "cpp/arv.cpp",
+                "cpp/binary.cpp",
+                "cpp/cohort.cpp",
+                "cpp/compressed.cpp",
                 "cpp/file.cpp",
                 "cpp/filesize.cpp",
                 "cpp/mmap.cpp",
                 "cpp/parse.cpp",
+                "cpp/rules.cpp",
+                "cpp/scan.cpp",
+                "cpp/storage.cpp",
                 "cython/_arv.pyx",
             ],
             language="c++",
             include_dirs=["cpp"],
+            # shm_open lives in librt on older glibc
+            libraries=["z"] + (["rt"] if sys.platform.startswith("linux")
+                else []),
             extra_compile_args=ArvOptions.compile_flags(),
             extra_link_args=ArvOptions.link_flags(),
         ),
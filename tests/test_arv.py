@@ -8,8 +8,30 @@ Distributed under the GNU GPL v3 or later; see COPYING.
 
 import arv
 import arv.match
+import gzip
+import io
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import subprocess
 import sys
+import tempfile
 import unittest
+import zipfile
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def gzip_compress(data):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode="wb") as f:
+        f.write(data)
+    return out.getvalue()
 
 class ArvModuleTests(unittest.TestCase):
     @classmethod
@@ -58,6 +80,956 @@ class ArvModuleTests(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             arv.load("non-existing-file")
 
+    def test_line_endings(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "genome.txt")
+            with open(self.filename, "rb") as src:
+                with open(filename, "wb") as dst:
+                    dst.write(src.read().replace(b"\r\n", b"\n"))
+            genome = arv.load(filename)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual(len(genome), len(self.genome))
+        for rsid, snp in self.genome.items():
+            self.assertEqual(genome[rsid], snp)
+
+    def _assert_same_genome(self, genome):
+        self.assertEqual(len(genome), len(self.genome))
+        self.assertEqual(genome.y_chromosome, self.genome.y_chromosome)
+        for rsid, snp in self.genome.items():
+            self.assertEqual(genome[rsid], snp)
+
+    def test_load_compressed(self):
+        with open(self.filename, "rb") as f:
+            data = f.read()
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "genome.txt.gz")
+            with gzip.open(filename, "wb") as f:
+                f.write(data)
+            self._assert_same_genome(arv.load(filename))
+
+            # Concatenated gzip members, split in the middle of a line
+            half = len(data) // 2
+            with open(filename, "wb") as f:
+                for part in (data[:half], data[half:]):
+                    with gzip.GzipFile(fileobj=f, mode="wb") as g:
+                        g.write(part)
+            self._assert_same_genome(arv.load(filename))
+
+            for method in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+                filename = os.path.join(tmpdir, "genome.zip")
+                with zipfile.ZipFile(filename, "w", method) as z:
+                    z.writestr("genome/", b"")
+                    z.writestr("genome/genome.txt", data)
+                self._assert_same_genome(arv.load(filename))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_load_compressed_errors(self):
+        with open(self.filename, "rb") as f:
+            compressed = zlib.compress(f.read())
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "genome.txt.gz")
+            with gzip.open(filename, "wb") as f:
+                f.write(b"rs123\t1\t123\tAA\n" * 1000)
+            with open(filename, "rb") as f:
+                data = f.read()
+
+            # Truncated
+            with open(filename, "wb") as f:
+                f.write(data[:len(data)//2])
+            with self.assertRaises(RuntimeError):
+                arv.load(filename)
+
+            # Corrupt deflate stream
+            with open(filename, "wb") as f:
+                f.write(data[:10] + compressed)
+            with self.assertRaises(RuntimeError):
+                arv.load(filename)
+
+            filename = os.path.join(tmpdir, "genome.zip")
+            with zipfile.ZipFile(filename, "w") as z:
+                z.writestr("genome/", b"")
+            with self.assertRaises(RuntimeError):
+                arv.load(filename)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_loads(self):
+        with open(self.filename, "rb") as f:
+            data = f.read()
+
+        self._assert_same_genome(arv.loads(data))
+        self._assert_same_genome(arv.loads(bytearray(data), threads=4))
+        self._assert_same_genome(arv.loads(memoryview(data)))
+        self._assert_same_genome(arv.loads(gzip_compress(data)))
+
+        with open(self.filename, "rb") as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self._assert_same_genome(arv.loads(m))
+            finally:
+                m.close()
+
+        genome = arv.loads(data, name="upload", ethnicity="european")
+        self.assertEqual(genome.name, "upload")
+        self.assertEqual(genome.ethnicity, "european")
+        self.assertEqual(len(arv.loads(b"")), 0)
+
+        with self.assertRaises(TypeError):
+            arv.loads(None)
+
+    def test_load_stream(self):
+        with open(self.filename, "rb") as f:
+            data = f.read()
+
+        class Reader(object):
+            """File object without readinto, returning short reads."""
+            def __init__(self, data):
+                self.stream = io.BytesIO(data)
+
+            def read(self, size):
+                return self.stream.read(min(size, 7))
+
+        for chunk_size in (1, 10, 1 << 20):
+            self._assert_same_genome(arv.load_stream(io.BytesIO(data),
+                chunk_size=chunk_size))
+            self._assert_same_genome(arv.load_stream(Reader(data),
+                chunk_size=chunk_size))
+            self._assert_same_genome(arv.load_stream(
+                io.BytesIO(gzip_compress(data) + gzip_compress(b"")),
+                chunk_size=chunk_size))
+
+        with open(self.filename, "rb") as f:
+            genome = arv.load_stream(f)
+        self._assert_same_genome(genome)
+        self.assertEqual(genome.name, self.filename)
+
+        with self.assertRaises(RuntimeError):
+            arv.load_stream(io.BytesIO(gzip_compress(data)[:-20]))
+
+        with self.assertRaises(ValueError):
+            arv.load_stream(io.BytesIO(data), chunk_size=0)
+
+    def test_load_threads(self):
+        # Needs to be big enough to be split into several chunks
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "genome.txt")
+            with open(filename, "wt") as f:
+                f.write("# rsid\tchromosome\tposition\tgenotype\n")
+                for n in range(1, 200001):
+                    f.write("rs%d\t%d\t%d\t%s\n" % (n, 1 + n % 22, n*7,
+                        ["AA", "CT", "--", "G"][n % 4]))
+                    if n % 1000 == 0:
+                        f.write("i%d\tY\t%d\tA\n" % (n, n))
+
+            single = arv.load(filename)
+            for threads in [0, 2, 3, 4]:
+                genome = arv.load(filename, threads=threads)
+                self.assertEqual(len(genome), len(single))
+                self.assertEqual(genome.y_chromosome, single.y_chromosome)
+                for rsid, snp in single.items():
+                    self.assertEqual(genome[rsid], snp)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual(len(single), 200200)
+        self.assertTrue(single.y_chromosome)
+        self.assertEqual(single["rs2"].genotype, "--")
+        self.assertEqual(single["rs3"].genotype, "G")
+        self.assertEqual(single["i5000"].chromosome, "Y")
+
+    def test_load_many(self):
+        filenames = [self.filename, "tests/fake_genome_female.txt",
+                self.filename]
+        for workers in [0, 1, 2, 8]:
+            genomes = arv.load_many(filenames, ethnicity="european",
+                    workers=workers)
+            self.assertEqual([g.name for g in genomes], filenames)
+            self.assertEqual([len(g) for g in genomes], [25, 24, 25])
+            self.assertEqual([g.y_chromosome for g in genomes],
+                    [True, False, True])
+            self.assertEqual(genomes[1].ethnicity, "european")
+            self.assertEqual(genomes[2]["rs671"], "GG")
+
+        self.assertEqual(arv.load_many([]), [])
+
+        with self.assertRaises(RuntimeError):
+            arv.load_many([self.filename, "non-existing-file"], workers=2)
+
+    def test_load_from_threads(self):
+        import threading
+        genomes = [None]*8
+
+        def load(n):
+            genomes[n] = arv.load(self.filename)
+
+        threads = [threading.Thread(target=load, args=(n,)) for n in
+                range(len(genomes))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for genome in genomes:
+            self.assertEqual(len(genome), len(self.genome))
+            self.assertEqual(genome["rs4477212"], "AT")
+
+    def test_load_cohort(self):
+        filenames = [self.filename, "tests/fake_genome_female.txt",
+                self.filename]
+        genomes = arv.load_many(filenames)
+        cohort = arv.load_cohort(filenames, workers=2)
+
+        self.assertEqual(len(cohort), 3)
+        self.assertEqual(cohort.names, filenames)
+        rsids = set(genomes[0].keys()) | set(genomes[1].keys())
+        self.assertEqual(cohort.snp_count, len(rsids))
+        self.assertEqual(sorted(cohort.rsids()), sorted(rsids))
+        self.assertIn("rs742927", cohort)
+        self.assertNotIn("rs123", cohort)
+
+        for rsid in rsids:
+            for index, genome in enumerate(genomes):
+                expected = genome[rsid].genotype if rsid in genome else "--"
+                self.assertEqual(cohort.genotype(index, rsid), expected)
+                self.assertEqual(cohort.genotype(index - len(genomes), rsid),
+                        expected)
+
+        with self.assertRaises(KeyError):
+            cohort.genotype(0, "rs123")
+        for index in (3, -4, 1 << 40, -(1 << 40)):
+            with self.assertRaises(IndexError):
+                cohort.genotype(index, "rs742927")
+        with self.assertRaises(RuntimeError):
+            arv.load_cohort([self.filename, "non-existing-file"])
+
+        self.assertEqual(len(arv.load_cohort([])), 0)
+        self.assertEqual(len(arv.Cohort()), 0)
+
+    @unittest.skipIf(numpy is None, "Requires NumPy")
+    def test_cohort_genotypes(self):
+        filenames = [self.filename, "tests/fake_genome_female.txt"] * 3
+        genomes = arv.load_many(filenames[:2])
+        cohort = arv.load_cohort(filenames)
+
+        for rsid in cohort.rsids():
+            codes = cohort.genotypes(rsid)
+            self.assertEqual(codes.dtype, numpy.uint8)
+            self.assertEqual(list(codes), [genome[rsid].genotype.code if
+                rsid in genome else 0 for genome in genomes] * 3)
+
+        with self.assertRaises(KeyError):
+            cohort.genotypes("rs123")
+
+    def test_save_load_binary(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "genome.arv")
+            female = arv.load("tests/fake_genome_female.txt",
+                    ethnicity="european", name="female")
+            female.orientation = -1
+            female.save(filename)
+
+            genome = arv.load_binary(filename)
+            self.assertTrue(genome.read_only)
+            self.assertFalse(female.read_only)
+            self.assertEqual(genome.name, "female")
+            self.assertEqual(genome.ethnicity, "european")
+            self.assertEqual(genome.orientation, -1)
+            self.assertFalse(genome.y_chromosome)
+            self.assertEqual(len(genome), len(female))
+
+            for rsid, snp in female.items():
+                self.assertIn(rsid, genome)
+                self.assertEqual(genome[rsid], snp)
+                self.assertEqual(genome[rsid].chromosome, snp.chromosome)
+
+            # Stored sorted by RSID, with internal IDs first
+            ints = [self._int(key) for key in genome.keys()]
+            self.assertEqual(ints, sorted(ints))
+            self.assertEqual(sorted(genome.keys()), sorted(female.keys()))
+
+            with self.assertRaises(KeyError):
+                genome["rs123"]
+            self.assertNotIn("rs123", genome)
+
+            genome = arv.load_binary(filename, name="foo", ethnicity="")
+            self.assertEqual(genome.name, "foo")
+            self.assertEqual(genome.ethnicity, "")
+
+            self.genome.save(filename)
+            genome = arv.load_binary(filename, verify=False)
+            self.assertTrue(genome.y_chromosome)
+            self.assertEqual(len(genome), len(self.genome))
+
+            # Saving over the file a genome is mapped from
+            genome = arv.load_binary(filename)
+            expected = list(genome.items())
+            genome.save(filename)
+            self.assertEqual(list(genome.items()), expected)
+            self.assertEqual(list(arv.load_binary(filename).items()),
+                    expected)
+            self.assertEqual(os.listdir(tmpdir), ["genome.arv"])
+
+            with self.assertRaises(RuntimeError):
+                genome.save(os.path.join(tmpdir, "missing", "genome.arv"))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_load_binary_errors(self):
+        with self.assertRaises(RuntimeError):
+            arv.load_binary("non-existing-file")
+
+        with self.assertRaises(RuntimeError):
+            arv.load_binary(self.filename)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "genome.arv")
+            self.genome.save(filename)
+
+            with open(filename, "rb") as f:
+                data = bytearray(f.read())
+
+            # Flip a bit in the SNP data
+            data[-20] ^= 1
+            with open(filename, "wb") as f:
+                f.write(data)
+
+            with self.assertRaises(RuntimeError):
+                arv.load_binary(filename)
+
+            # Truncated
+            with open(filename, "wb") as f:
+                f.write(data[:-8])
+
+            with self.assertRaises(RuntimeError):
+                arv.load_binary(filename, verify=False)
+
+            # Corrupt header fields, which the checksum does not cover. Adding
+            # 1 << 63 to the count wraps the offsets back to the right size.
+            self.genome.save(filename)
+            with open(filename, "rb") as f:
+                valid = f.read()
+
+            count, = struct.unpack_from("=Q", valid, 32)
+            for offset, fmt, value in [
+                    (32, "=Q", count + (1 << 63)),
+                    (32, "=Q", count + 1),
+                    (48, "=I", 0xffffffff),
+                    (52, "=I", len(valid))]:
+                data = bytearray(valid)
+                struct.pack_into(fmt, data, offset, value)
+                with open(filename, "wb") as f:
+                    f.write(data)
+
+                for verify in (True, False):
+                    with self.assertRaises(RuntimeError):
+                        arv.load_binary(filename, verify=verify)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipIf(numpy is None, "Requires NumPy")
+    def test_lookup_many(self):
+        keys = list(self.keys) + ["rs123", "i123", "foo"]
+        result = self.genome.lookup_many(keys)
+
+        self.assertEqual(sorted(result.keys()),
+                ["chromosome", "found", "genotype", "position"])
+        self.assertEqual(result["chromosome"].dtype, numpy.uint8)
+        self.assertEqual(result["position"].dtype, numpy.uint32)
+        self.assertEqual(result["genotype"].dtype, numpy.uint8)
+        self.assertEqual(result["found"].dtype, numpy.bool_)
+        self.assertEqual(list(result["found"]),
+                [True]*len(self.keys) + [False]*3)
+
+        chromosomes = {"X": 23, "Y": 24, "MT": 25}
+        for n, key in enumerate(self.keys):
+            snp = self.genome[key]
+            self.assertEqual(result["chromosome"][n],
+                    chromosomes.get(snp.chromosome, snp.chromosome))
+            self.assertEqual(result["position"][n], snp.position)
+            self.assertEqual(result["genotype"][n], snp.genotype.code)
+
+        for n in range(len(self.keys), len(keys)):
+            self.assertEqual(result["chromosome"][n], 0)
+            self.assertEqual(result["position"][n], 0)
+            self.assertEqual(result["genotype"][n], 0)
+
+        ints = numpy.array([self._int(key) for key in self.keys] + [123],
+                dtype=numpy.int64)
+        result = self.genome.lookup_many(ints)
+        self.assertEqual(list(result["found"]), [True]*len(self.keys) + [False])
+        self.assertEqual(list(self.genome.lookup_many(ints[::2])["position"]),
+                list(result["position"][::2]))
+
+        self.assertEqual(len(self.genome.lookup_many([])["found"]), 0)
+        self.assertEqual(self.genome["rs4477212"].genotype.code, 1 << 3 | 4)
+        self.assertEqual(self.genome["i3001754"].genotype.code, 1 << 3)
+
+        with self.assertRaises(OverflowError):
+            self.genome.lookup_many(numpy.array([1 << 40]))
+
+        with self.assertRaises(ValueError):
+            self.genome.lookup_many(numpy.zeros((2, 2), dtype=numpy.int32))
+
+    @unittest.skipIf(numpy is None, "Requires NumPy")
+    def test_to_numpy(self):
+        columns = self.genome.to_numpy()
+        self.assertEqual(sorted(columns.keys()),
+                ["chromosome", "genotype", "position", "rsid"])
+        self.assertEqual(columns["rsid"].dtype, numpy.int32)
+        self.assertEqual([len(c) for c in columns.values()], [25]*4)
+
+        # Same order as iteration
+        self.assertEqual(list(columns["rsid"]),
+                [self._int(key) for key in self.genome.keys()])
+
+        result = self.genome.lookup_many(columns["rsid"])
+        self.assertTrue(result["found"].all())
+        for name in ("chromosome", "position", "genotype"):
+            self.assertEqual(list(columns[name]), list(result[name]))
+
+        columns = arv.Genome().to_numpy()
+        self.assertEqual([len(c) for c in columns.values()], [0]*4)
+
+    def test_iter_file(self):
+        items = list(arv.iter_file(self.filename))
+        self.assertEqual(sorted(items), sorted(self.genome.items()))
+
+        # In file order
+        with open(self.filename) as f:
+            rsids = [line.split("\t")[0] for line in f if not
+                    line.startswith("#")]
+        self.assertEqual([rsid for rsid, snp in items], rsids)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "genome.txt")
+            with open(filename, "wb") as f:
+                f.write(b"rs1\t1\t10\tAA\nrs1\t1\t10\tAA\n# comment\n"
+                        b"rs2\tY\t20\tC")
+            self.assertEqual([rsid for rsid, snp in arv.iter_file(filename)],
+                    ["rs1", "rs1", "rs2"])
+
+            filename = os.path.join(tmpdir, "empty.txt")
+            open(filename, "wb").close()
+            self.assertEqual(list(arv.iter_file(filename)), [])
+
+            filename = os.path.join(tmpdir, "genome.txt.gz")
+            with gzip.open(filename, "wb") as f:
+                f.write(b"rs1\t1\t10\tAA\n")
+            with self.assertRaises(RuntimeError):
+                arv.iter_file(filename)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        with self.assertRaises(RuntimeError):
+            arv.iter_file("non-existing-file")
+
+    @unittest.skipIf(numpy is None, "Requires NumPy")
+    def test_iter_file_batches(self):
+        items = list(arv.iter_file(self.filename))
+
+        for batch_size in (1, 7, 25, 1000):
+            batches = list(arv.iter_file_batches(self.filename, batch_size))
+            self.assertEqual([len(batch["rsid"]) for batch in batches[:-1]],
+                    [batch_size] * (len(batches) - 1))
+            self.assertTrue(0 < len(batches[-1]["rsid"]) <= batch_size)
+
+            columns = dict((name, numpy.concatenate([batch[name] for batch in
+                batches])) for name in batches[0])
+            self.assertEqual(sorted(columns.keys()),
+                    ["chromosome", "genotype", "position", "rsid"])
+            self.assertEqual(columns["rsid"].dtype, numpy.int32)
+            self.assertEqual(list(columns["rsid"]),
+                    [self._int(rsid) for rsid, snp in items])
+            self.assertEqual(list(columns["position"]),
+                    [snp.position for rsid, snp in items])
+            self.assertEqual(list(columns["genotype"]),
+                    [snp.genotype.code for rsid, snp in items])
+
+        with self.assertRaises(ValueError):
+            arv.iter_file_batches(self.filename, 0)
+
+    def test_region(self):
+        region = self.genome.region(20, 57048415, 57183914)
+        self.assertEqual([rsid for rsid, _ in region],
+                ["rs6015286", "rs6026400"])
+        for rsid, snp in region:
+            self.assertEqual(snp, self.genome[rsid])
+
+        self.assertEqual(self.genome.region("chr20", 57048415, 57048415),
+                region[:1])
+        self.assertEqual(self.genome.region(20, 57048416, 57183523), [])
+        self.assertEqual(self.genome.region(20, 57183524, 57048415), [])
+        self.assertEqual(self.genome.region(21, 0, 1 << 31), [])
+
+        mt = self.genome.region("MT", 0, 1 << 31)
+        self.assertEqual(len(mt), 9)
+        positions = [snp.position for _, snp in mt]
+        self.assertEqual(positions, sorted(positions))
+        self.assertEqual([rsid for rsid, _ in self.genome.region("y", 0,
+            1 << 31)], ["rs742927"])
+
+        with self.assertRaises(ValueError):
+            self.genome.region(23, 0, 1)
+        with self.assertRaises(ValueError):
+            self.genome.region("chrQ", 0, 1)
+
+        # Memory mapped genomes are indexed the same way
+        binary = os.path.join(tempfile.mkdtemp(), "genome.arv")
+        try:
+            self.genome.save(binary)
+            self.assertEqual(arv.load_binary(binary).region(20, 0, 1 << 31),
+                    self.genome.region(20, 0, 1 << 31))
+        finally:
+            shutil.rmtree(os.path.dirname(binary))
+
+    def test_pickle(self):
+        self.genome.ethnicity = "european"
+        self.genome.orientation = -1
+        try:
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                genome = pickle.loads(pickle.dumps(self.genome, protocol))
+                self.assertTrue(genome.read_only)
+                self.assertEqual(genome.name, self.genome.name)
+                self.assertEqual(genome.ethnicity, "european")
+                self.assertEqual(genome.orientation, -1)
+                self._assert_same_genome(genome)
+
+                # Pickling an unpickled genome
+                self._assert_same_genome(pickle.loads(pickle.dumps(genome,
+                    protocol)))
+        finally:
+            self.genome.ethnicity = ""
+            self.genome.orientation = 1
+
+        female = arv.load("tests/fake_genome_female.txt")
+        self.assertFalse(pickle.loads(pickle.dumps(female)).y_chromosome)
+
+    @unittest.skipIf(pickle.HIGHEST_PROTOCOL < 5, "Requires pickle protocol 5")
+    def test_pickle_out_of_band(self):
+        buffers = []
+        data = pickle.dumps(self.genome, 5, buffer_callback=buffers.append)
+        self.assertEqual(len(buffers), 1)
+        self.assertLess(len(data), 200)
+
+        raw = [b.raw() for b in buffers]
+        genome = pickle.loads(data, buffers=raw)
+        del buffers, raw
+        self._assert_same_genome(genome)
+
+        # Unaligned buffer
+        unaligned = bytearray(1) + self.genome.__reduce_ex__(5)[1][0].raw()
+        genome = pickle.loads(data, buffers=[memoryview(unaligned)[1:]])
+        self._assert_same_genome(genome)
+
+    def test_shared(self):
+        shm_name = "arv-test-%d" % os.getpid()
+        self.genome.save_shared(shm_name)
+        try:
+            with self.assertRaises(RuntimeError):
+                self.genome.save_shared(shm_name)
+
+            genome = arv.load_shared(shm_name, verify=True)
+            self.assertTrue(genome.read_only)
+            self.assertEqual(genome.name, self.genome.name)
+            self._assert_same_genome(genome)
+            self._assert_same_genome(arv.load_shared("/" + shm_name))
+
+            # Attach from another process
+            script = ("import arv; g = arv.load_shared(%r); "
+                      "print(g['rs4477212'], len(g))" % shm_name)
+            output = subprocess.check_output([sys.executable, "-c", script],
+                    env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+            self.assertEqual(output.split(), [b"AT", b"25"])
+        finally:
+            arv.unlink_shared(shm_name)
+
+        # Attached genomes outlive the name
+        self._assert_same_genome(genome)
+        with self.assertRaises(RuntimeError):
+            arv.load_shared(shm_name)
+        with self.assertRaises(RuntimeError):
+            arv.unlink_shared(shm_name)
+
+    def test_load_sharded(self):
+        genome = arv.load_sharded(self.filename)
+        self.assertEqual(genome.name, self.filename)
+        self.assertEqual(genome.loaded, [])
+        self.assertEqual(genome.chromosomes, sorted(set(snp.chromosome for
+            snp in self.genome.values()), key=lambda c: (isinstance(c, str),
+                {"X": 1, "Y": 2, "MT": 3}.get(c, c))))
+
+        self.assertTrue(genome.y_chromosome)
+        self.assertEqual(genome.loaded, ["Y"])
+
+        mt = genome.chromosome("MT")
+        self.assertEqual(sorted(mt.items()), sorted((rsid, snp) for rsid, snp
+            in self.genome.items() if snp.chromosome == "MT"))
+        self.assertIs(genome.chromosome("chrMT"), mt)
+        self.assertEqual(mt.name, self.filename)
+        self.assertEqual(len(genome.chromosome(4)), 0)
+        with self.assertRaises(ValueError):
+            genome.chromosome(23)
+
+        self.assertEqual(genome["rs4477212"], self.genome["rs4477212"])
+        self.assertEqual(genome[-3001754], self.genome["i3001754"])
+        self.assertIn("rs671", genome)
+        self.assertNotIn("rs1", genome)
+        with self.assertRaises(KeyError):
+            genome["rs1"]
+        self.assertEqual(genome.loaded, genome.chromosomes)
+
+        self.assertEqual(len(genome), len(self.genome))
+        self.assertEqual(sorted(genome.items()), sorted(self.genome.items()))
+        self.assertEqual(sorted(genome), self.keys)
+        self.assertFalse(arv.load_sharded(
+            "tests/fake_genome_female.txt").y_chromosome)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # Chromosomes in any order, and lines without a chromosome
+            filename = os.path.join(tmpdir, "genome.txt")
+            with open(filename, "wb") as f:
+                f.write(b"# rsid\tchromosome\tposition\tgenotype\n"
+                        b"rs1\t1\t10\tAA\n"
+                        b"rs2\tX\t20\tC\n"
+                        b"rs3\t1\t30\tGG\n"
+                        b"rs4\t?\t40\tTT\n"
+                        b"\n"
+                        b"rs5\tX\t50\tAG")
+            genome = arv.load_sharded(filename, storage="sorted")
+            self.assertEqual(genome.chromosomes, [1, "X"])
+            self.assertEqual(sorted(genome.chromosome(1).keys()),
+                    ["rs1", "rs3"])
+            self.assertEqual(sorted(genome.chromosome("X").keys()),
+                    ["rs2", "rs5"])
+            self.assertEqual(genome.chromosome(1).storage, "sorted")
+            self.assertEqual(str(genome["rs4"].genotype), "TT")
+            expected = arv.load(filename)
+            self.assertEqual(sorted(genome.items()), sorted(expected.items()))
+
+            filename = os.path.join(tmpdir, "empty.txt")
+            open(filename, "wb").close()
+            genome = arv.load_sharded(filename)
+            self.assertEqual(genome.chromosomes, [])
+            self.assertEqual(len(genome), 0)
+            self.assertFalse(genome.y_chromosome)
+
+            filename = os.path.join(tmpdir, "genome.txt.gz")
+            with open(self.filename, "rb") as f:
+                data = f.read()
+            with gzip.open(filename, "wb") as f:
+                f.write(data)
+            with self.assertRaises(RuntimeError):
+                arv.load_sharded(filename)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        with self.assertRaises(RuntimeError):
+            arv.load_sharded("non-existing-file")
+
+    def test_storage(self):
+        self.assertEqual(self.genome.storage, "hash")
+
+        for storage in ("sorted", "eytzinger", "compressed"):
+            genome = arv.load(self.filename, storage=storage)
+            self.assertEqual(genome.storage, storage)
+            self.assertTrue(genome.read_only)
+            self.assertLess(genome.memory_usage(),
+                    self.genome.memory_usage())
+            self._assert_same_genome(genome)
+            self.assertEqual(sorted(genome.keys()),
+                    sorted(self.genome.keys()))
+            self.assertEqual(genome.region(20, 57048415, 57183914),
+                    self.genome.region(20, 57048415, 57183914))
+            self.assertNotIn("rs1", genome)
+
+            genome.convert_storage("hash")
+            self.assertFalse(genome.read_only)
+            self._assert_same_genome(genome)
+
+        with self.assertRaises(ValueError):
+            self.genome.convert_storage("tree")
+
+    def test_convert_storage_while_iterating(self):
+        # Iterators keep reading the storage they started with. The genome
+        # is big enough to take several batches.
+        data = "".join("rs%d\t1\t%d\tAG\n" % (n, n) for n in
+                range(1, 5000)).encode("ascii")
+        storages = ("hash", "sorted", "eytzinger", "compressed")
+        for source in storages:
+            for target in storages:
+                genome = arv.loads(data, storage=source)
+                expected = list(genome.items())
+                it = genome.items()
+                first = next(it)
+                genome.convert_storage(target)
+                self.assertEqual([first] + list(it), expected)
+                self.assertEqual(sorted(genome.items()), sorted(expected))
+
+    def test_storage_lookups(self):
+        # Every size up to a few full trees and compressed blocks, looking up
+        # all RSIDs around and between the ones present. Gaps grow to test
+        # different delta widths, up to a full 30 bits at the end.
+        for size in list(range(34)) + [64, 65, 129, 200]:
+            present = set(n*n + n + 2 for n in range(size))
+            present.update(-3*n - 1 for n in range(size // 10))
+            present.add(1 << 30)
+            data = "".join("%s\t1\t%d\tAA\n" % (
+                "rs%d" % rsid if rsid > 0 else "i%d" % -rsid, abs(rsid))
+                for rsid in sorted(present)).encode("ascii")
+            for storage in ("sorted", "eytzinger", "compressed"):
+                genome = arv.loads(data, storage=storage)
+                self.assertEqual(len(genome), len(present))
+                for rsid in list(range(-3*size - 3, size*size + 5)) + [
+                        (1 << 30) - 1, 1 << 30, (1 << 30) + 1]:
+                    self.assertEqual(rsid in genome, rsid in present)
+                self.assertEqual(sorted(genome.keys()), sorted(
+                    "rs%d" % rsid if rsid > 0 else "i%d" % -rsid
+                    for rsid in present))
+
+    def test_iteration(self):
+        # Iterators copy SNPs out in batches of 1024, so cross a few batches
+        present = [n*7 + 1 for n in range(2500)] + [-n - 1 for n in range(90)]
+        present += [2147483647, -2147483647]
+        data = "".join("%s\t%d\t%d\tAG\n" % (
+            "rs%d" % rsid if rsid > 0 else "i%d" % -rsid, rsid % 22 + 1,
+            abs(rsid)) for rsid in present).encode("ascii")
+        expected = sorted("rs%d" % rsid if rsid > 0 else "i%d" % -rsid
+                for rsid in present)
+
+        for storage in ("hash", "sorted", "eytzinger", "compressed"):
+            genome = arv.loads(data, storage=storage)
+            self.assertEqual(sorted(genome.keys()), expected)
+            self.assertEqual(sorted(genome), expected)
+            self.assertEqual(len(list(genome.values())), len(present))
+            for rsid, snp in genome.items():
+                self.assertEqual(snp, genome[rsid])
+                self.assertEqual(snp.position, abs(int(rsid.lstrip("rsi"))))
+
+        # The iterators keep a temporary genome alive
+        self.assertEqual(sorted(arv.loads(data).keys()), expected)
+        self.assertEqual(len(list(arv.loads(data).values())), len(present))
+        items = arv.load(self.filename).items()
+        self.assertEqual(sorted(items), sorted(self.genome.items()))
+
+    def test_rsid_keys(self):
+        for key in self.genome.keys():
+            rsid = int(key[2:]) if key.startswith("rs") else -int(key[1:])
+            self.assertEqual(self.genome.get_by_id(rsid), self.genome[key])
+            self.assertEqual(self.genome[rsid], self.genome[key])
+
+        # RSID strings of small genomes are cached and shared
+        self.assertEqual(list(self.genome.keys()), list(self.genome.keys()))
+        self.assertTrue(all(a is b for a, b in zip(self.genome.keys(),
+            self.genome.keys())))
+
+        genome = arv.loads(b"rs1\t1\t1\tAA\ni2\t1\t2\tCC\n"
+                b"rs2147483647\t1\t3\tGG\ni2147483647\t1\t4\tTT\n")
+        self.assertEqual(sorted(genome.keys()), ["i2", "i2147483647", "rs1",
+            "rs2147483647"])
+        self.assertEqual(genome.get_by_id(-2), "CC")
+        self.assertEqual(genome.get_by_id(2147483647), "GG")
+        self.assertEqual(genome.get_by_id(-2147483647), "TT")
+        self.assertEqual(genome["rs001"], "AA")
+        self.assertEqual(genome["rs 1"], "AA") # leniently parsed by int()
+        self.assertNotIn("rs0", genome)
+        self.assertNotIn("foo", genome)
+        with self.assertRaises(KeyError):
+            genome.get_by_id(3)
+        with self.assertRaises(OverflowError):
+            genome.get_by_id(1 << 31)
+        with self.assertRaises(OverflowError):
+            genome["rs2147483648"]
+        with self.assertRaises(ValueError):
+            genome["rs1x"]
+        with self.assertRaises(TypeError):
+            genome.get_by_id("rs1")
+
+    def test_scanners(self):
+        import _arv
+        with open(self.filename, "rb") as f:
+            samples = [f.read()]
+        samples.append(b"".join([
+            b"# comment\r\n",
+            b"rs1\t1\t100\tAG\r\n",
+            b"i7001\tMT\t16519\tT\n",
+            b"rs2\tX\t2147483647\tD\n",
+            b"rs3\tY\t4294967296\t--\n",
+            b"rs2147483647\t22\t1\tII\n",
+            b"rs4\t\t5\tAA\n",
+            b"rs5\t1\t6\t\n",
+            b"rs6\t1\t7\tAG\textra\n",
+            b"rs7 1 8 CC\n",
+            b"rs8\t1\t9\tAGT\n",
+            b"rx9\t1\t10\tCT\n",
+            b"\n",
+            b"rs10\t26\t12345678901\tA",
+        ]))
+
+        # Random corruptions of well-formed lines
+        random = __import__("random").Random(0)
+        for n in range(200):
+            data = bytearray(samples[0][-400:])
+            for m in range(random.randint(1, 5)):
+                data[random.randrange(len(data))] = random.choice(
+                        b"\t\n\r 0123456789rsiXYMTAG-#")
+            samples.append(bytes(data))
+
+        def parse(data):
+            genome = arv.loads(data)
+            return sorted(genome.items()), genome.y_chromosome
+
+        original = _arv._scanner()
+        try:
+            _arv._scanner("scalar")
+            expected = [parse(data) for data in samples]
+            for scanner in _arv._scanners():
+                _arv._scanner(scanner)
+                self.assertEqual(_arv._scanner(), scanner)
+                for data, result in zip(samples, expected):
+                    self.assertEqual(parse(data), result)
+        finally:
+            _arv._scanner(original)
+
+        with self.assertRaises(ValueError):
+            _arv._scanner("neon")
+
+    def test_validate(self):
+        import _arv
+        self.assertIsNone(self.genome.parse_report)
+
+        with open(self.filename, "rb") as f:
+            valid = f.read()
+        genome = arv.loads(valid, validate=True)
+        self._assert_same_genome(genome)
+        report = genome.parse_report
+        self.assertTrue(report["valid"])
+        self.assertEqual(report["snps"], len(self.genome))
+        self.assertEqual(report["lines"], valid.count(b"\n"))
+        self.assertEqual(report["issues"], [])
+
+        data = b"".join([
+            b"# comment\n",
+            b"rs1\t1\t100\tAG\n",
+            b"\r\n",
+            b"rs2147483648\t1\t5\tA\n",
+            b"rs2\t26\t5\tA\n",
+            b"rs3\t2\t5\tAZ\n",
+            b"rs4\t2\t5\n",
+            b"rs5\tY\t5\tAA\r\n",
+            b"rs6\tMT\t4294967296\tA\n",
+            b"i7\tX\t4294967295\t--\n",
+            b"rs0\t1\t1\tA\n",
+            b"rs2147483647\t22\t1\tDI\n",
+            b"rs8\t1\t1\tA",
+        ])
+        expected = {
+            "rs1": (1, 100, "AG"),
+            "rs5": ("Y", 5, "AA"),
+            "i7": ("X", 4294967295, "--"),
+            "rs2147483647": (22, 1, "DI"),
+            "rs8": (1, 1, "A"),
+        }
+        issues = [
+            (4, "overflow"),
+            (5, "unknown_chromosome"),
+            (6, "invalid_genotype"),
+            (7, "malformed"),
+            (9, "overflow"),
+            (11, "malformed"),
+        ]
+
+        original = _arv._scanner()
+        try:
+            for scanner in _arv._scanners():
+                _arv._scanner(scanner)
+                genome = arv.loads(data, validate=True)
+                self.assertEqual(dict((rsid, (snp.chromosome, snp.position,
+                    str(snp.genotype))) for rsid, snp in genome.items()),
+                    expected)
+
+                report = genome.parse_report
+                self.assertFalse(report["valid"])
+                self.assertEqual(report["lines"], 13)
+                self.assertEqual(report["snps"], 5)
+                self.assertEqual(report["comments"], 1)
+                self.assertEqual(report["blanks"], 1)
+                self.assertEqual(report["errors"], {"malformed": 2,
+                    "overflow": 2, "unknown_chromosome": 1,
+                    "invalid_genotype": 1, "truncated": 0})
+                self.assertEqual([(i["line"], i["error"]) for i in
+                    report["issues"]], issues)
+        finally:
+            _arv._scanner(original)
+
+        # A valid last line without a newline is an ordinary SNP, while an
+        # invalid one is truncated
+        unterminated = b"rs1\t1\t100\tAA\nrs2\t1\t200\tAG"
+        for validate in (False, True):
+            genome = arv.loads(unterminated, validate=validate)
+            self.assertEqual(len(genome), 2)
+            self.assertEqual(genome["rs2"], "AG")
+        report = genome.parse_report
+        self.assertTrue(report["valid"])
+        self.assertEqual(report["snps"], len(genome))
+        self.assertEqual(report["lines"], 2)
+
+        report = arv.loads(unterminated[:-6], validate=True).parse_report
+        self.assertEqual(report["snps"], 1)
+        self.assertEqual(report["errors"]["truncated"], 1)
+        self.assertEqual(report["issues"][0]["line"], 2)
+
+        report = arv.loads(data, validate=True, max_issues=2).parse_report
+        self.assertEqual([i["line"] for i in report["issues"]], [4, 5])
+        self.assertEqual(sum(report["errors"].values()), 6)
+
+        # Every line is accounted for, whatever the input
+        random = __import__("random").Random(1)
+        for n in range(200):
+            corrupt = bytearray(valid[-600:])
+            for m in range(random.randint(1, 8)):
+                corrupt[random.randrange(len(corrupt))] = random.choice(
+                        b"\t\n\r 0123456789rsiXYMTAG-#\xff")
+            report = arv.loads(bytes(corrupt), validate=True).parse_report
+            self.assertEqual(report["snps"] + report["comments"] +
+                    report["blanks"] + sum(report["errors"].values()),
+                    report["lines"])
+
+        # Line numbers continue across threads, streamed chunks and gzip. The
+        # data needs to be big enough to be split for threads.
+        lines = data[:data.rindex(b"\n") + 1]
+        big = valid + (lines + valid) * 1000
+        expected = arv.loads(big, validate=True).parse_report
+        self.assertEqual(expected["errors"]["truncated"], 0)
+        self.assertEqual(expected["issues"][6]["line"],
+                expected["issues"][0]["line"] + lines.count(b"\n") +
+                valid.count(b"\n"))
+        for genome in (arv.loads(big, validate=True, threads=4),
+                arv.load_stream(io.BytesIO(big), chunk_size=1000,
+                    validate=True),
+                arv.loads(gzip_compress(big), validate=True)):
+            self.assertEqual(genome.parse_report, expected)
+
+        # Truncated compressed data is reported rather than raised
+        compressed = gzip_compress(valid)[:-20]
+        for genome in (arv.loads(compressed, validate=True),
+                arv.load_stream(io.BytesIO(compressed), validate=True)):
+            report = genome.parse_report
+            self.assertEqual(report["errors"]["truncated"], 1)
+            self.assertEqual(report["issues"][-1]["line"], report["lines"])
+
     def test_len(self):
         self.assertEqual(len(self.genome), 25)
 
@@ -235,6 +1207,20 @@ class ArvModuleTests(unittest.TestCase):
         self.assertTrue(b > "AT")
         self.assertTrue(b >= "AT")
 
+    def test_shared_genotypes(self):
+        # There are only a few genotypes, so the objects and strings are shared
+        a = self.genome["rs10810289"]
+        b = self.genome["i3001754"]
+        self.assertIs(a.genotype, self.genome["rs1426654"].genotype)
+        self.assertIs(a.genotype, a.genotype)
+        self.assertIs(~a.genotype, self.genome["rs6123756"].genotype)
+        self.assertIs(str(a.genotype), str(a))
+        self.assertIs(str(b), str(~self.genome["i3001773"].genotype))
+        self.assertEqual(str(b), "A")
+        self.assertEqual(~b.genotype, "T")
+        self.assertEqual(a.genotype, "AA")
+        self.assertEqual(repr(arv.Genotype()), "<Genotype '--'>")
+
     def test_unphased_match(self):
         self.assertIsInstance(self.genome["rs10488822"], arv.SNP)
         self.assertEqual(self.genome["rs10488822"].genotype, "TC")
@@ -256,6 +1242,43 @@ class ArvModuleTests(unittest.TestCase):
             arv.unphased_match(self.genome["rs10488822"], {
                 "AT": "Matched AT"})
 
+        snp = self.genome["rs10488822"]
+        for other in ("TC", "CT", snp, snp.genotype, ~~snp.genotype):
+            self.assertTrue(snp.unphased_equals(other))
+            self.assertTrue(snp.genotype.unphased_equals(other))
+        for other in ("TT", "T", "C", "TCA", "tc", "", self.genome["rs671"]):
+            self.assertFalse(snp.unphased_equals(other))
+            self.assertFalse(snp.genotype.unphased_equals(other))
+        self.assertTrue(self.genome["i3001754"].unphased_equals("A"))
+        with self.assertRaises(TypeError):
+            snp.unphased_equals(None)
+
+        self.assertEqual(arv.unphased_match(snp.genotype, {
+            "CT": "Matched CT"}), "Matched CT")
+        self.assertEqual(arv.unphased_match("TC", {"CT": "Matched CT"}),
+                "Matched CT")
+        self.assertEqual(arv.unphased_match(u"TC", {u"CT": "Matched CT"}),
+                "Matched CT")
+        self.assertEqual(arv.unphased_match(self.genome["i3001754"], {"A": 1,
+            "AA": 2}), 1)
+        with self.assertRaises(KeyError):
+            arv.unphased_match(self.genome["i3001755"], {"AA": 1})
+        with self.assertRaises(TypeError):
+            arv.unphased_match(None, {})
+
+    def test_string_comparison(self):
+        # Equality with strings compares codes, ordering compares strings
+        for key in self.keys:
+            snp = self.genome[key]
+            for text in ("--", "-", "A", "AA", "AG", "GA", "T", "TT", "A-",
+                    "-A", "XY", "AAA", "", "aa"):
+                self.assertEqual(snp == text, str(snp) == text)
+                self.assertEqual(snp != text, str(snp) != text)
+                self.assertEqual(snp.genotype == text, str(snp) == text)
+                self.assertEqual(snp.genotype != text, str(snp) != text)
+                self.assertEqual(snp < text, str(snp) < text)
+                self.assertEqual(snp.genotype >= text, str(snp) >= text)
+
     def test_snp_str_comparison(self):
         get = lambda key: self.genome[key]
         self.assertEqual(get("i3001754"), "A")
@@ -0,0 +1,113 @@
+"""
+Tests for the benchmark suite of arv.
+
+arv
+Copyright 2017 Christian Stigen Larsen
+Distributed under the GNU GPL v3 or later; see COPYING.
+"""
+
+import arv
+import arv.bench
+import arv.traits
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+class ArvBenchTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "genome.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_generate(self):
+        for layout in ("v3", "v4", "v5"):
+            count = arv.bench.generate(self.filename, 5000, layout)
+            self.assertEqual(count, 5000)
+
+            genome = arv.load(self.filename, validate=True)
+            self.assertEqual(len(genome), 5000)
+            self.assertEqual(sum(genome.parse_report["errors"].values()), 0)
+            self.assertTrue(genome.y_chromosome)
+
+            chromosomes = set(snp.chromosome for snp in genome.values())
+            self.assertEqual(chromosomes, set(list(range(1, 23)) +
+                ["X", "Y", "MT"]))
+            self.assertTrue(any(key.startswith("i") for key in genome))
+            for rsid in arv.bench.TRAIT_RSIDS:
+                self.assertIn(rsid, genome)
+
+            for snp in genome.values():
+                if snp.chromosome in ("X", "Y", "MT") and snp != "--":
+                    self.assertEqual(len(str(snp)), 1)
+
+            with open(self.filename, "rb") as f:
+                data = f.read()
+            self.assertTrue(data.startswith(b"# This data file generated"))
+            self.assertEqual(b"\r\n" in data, layout == "v3")
+
+        # Reproducible
+        arv.bench.generate(self.filename, 1000, seed=3)
+        with open(self.filename, "rb") as f:
+            first = f.read()
+        arv.bench.generate(self.filename, 1000, seed=3)
+        with open(self.filename, "rb") as f:
+            self.assertEqual(f.read(), first)
+
+        arv.bench.generate(self.filename, 1000, male=False)
+        self.assertFalse(arv.load(self.filename).y_chromosome)
+
+        with self.assertRaises(ValueError):
+            arv.bench.generate(self.filename, 1000, layout="v2")
+
+    def test_report(self):
+        arv.bench.generate(self.filename, 2000)
+        genome = arv.load(self.filename, ethnicity="european")
+        report = arv.traits.traits_report(genome)
+        self.assertEqual(report["Lactose intolerance"][:6], "Likely")
+
+    def test_percentile(self):
+        values = [4, 1, 3, 2, 5]
+        self.assertEqual(arv.bench.percentile(values, 0), 1)
+        self.assertEqual(arv.bench.percentile(values, 50), 3)
+        self.assertEqual(arv.bench.percentile(values, 90), 4.6)
+        self.assertEqual(arv.bench.percentile(values, 100), 5)
+        self.assertEqual(arv.bench.percentile([7], 99), 7)
+        with self.assertRaises(ValueError):
+            arv.bench.percentile([], 50)
+
+    def test_command_line(self):
+        output = os.path.join(self.tmpdir, "results.json")
+        subprocess.check_call([sys.executable, "-m", "arv.bench", "--snps",
+            "2000", "--repeat", "2", "--lookups", "100", "--output", output],
+            stderr=open(os.devnull, "w"))
+
+        with open(output) as f:
+            results = json.load(f)
+
+        self.assertEqual(results["config"]["snps"], 2000)
+        self.assertEqual(results["environment"]["arv"], arv.__version__)
+        for name in ("parse", "random_access", "iterate_keys",
+                "iterate_values", "iterate_items", "report"):
+            stats = results["results"][name]
+            self.assertEqual(stats["runs"], 2)
+            self.assertTrue(stats["min"] <= stats["p50"] <= stats["p90"] <=
+                    stats["p99"] <= stats["max"])
+
+        subprocess.check_call([sys.executable, "-m", "arv.bench", "--generate",
+            self.filename, "--snps", "1000", "--layout", "v3"])
+        self.assertEqual(len(arv.load(self.filename)), 1000)
+
+        results = json.loads(subprocess.check_output([sys.executable, "-m",
+            "arv.bench", "--genome", self.filename, "-r", "1", "-b", "parse"],
+            stderr=open(os.devnull, "w"), universal_newlines=True))
+        self.assertEqual(list(results["results"]), ["parse"])
+        self.assertEqual(results["results"]["parse"]["operations"], 1000)
+
+if __name__ == "__main__":
+    unittest.main()
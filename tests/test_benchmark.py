@@ -9,31 +9,42 @@ Distributed under the GNU GPL v3 or later; see COPYING.
 import argparse
 import arv
 import contextlib
+import gzip
 import os
 import random
+import shutil
+import subprocess
 import sys
+import tempfile
 import time
 import unittest
 
 benchmarks = {
     "parsing": "arv.load(filename)",
 
+    "parsing (4 threads)": "arv.load(filename, threads=4)",
+
+    "parsing (validating)": "arv.load(filename, validate=True)",
+
+    "y-chromosome (sharded)": "arv.load_sharded(filename).y_chromosome",
+
+    "iterate file in batches":
+r"""
+num = 0
+for batch in arv.iter_file_batches(filename):
+    num += len(batch["rsid"])
+""",
+
     "random access":
 r"""
-for n in xrange(5000):
-    try:
-        pos = random.randint(genome.first, genome.last)
-        snp = genome[pos]
-    except KeyError:
-        # RSIDs are not contiguous
-        pass
+for rsid in random.sample(rsids, 5000):
+    snp = genome[rsid]
 """,
 
-    "iterate items in genome":
+    "iterate genome":
 r"""
-assert(False) # this is too slow at the moment
 num = 0
-for snp in genome:
+for rsid in genome:
     num += 1
 assert(num == len(genome))
 """,
@@ -41,7 +52,7 @@ assert(num == len(genome))
     "iterate rsids":
 r"""
 num = 0
-for snp in genome.rsids:
+for rsid in genome.keys():
     num += 1
 assert(num == len(genome))
 """,
@@ -49,12 +60,39 @@ assert(num == len(genome))
     "iterate snps":
 r"""
 num = 0
-for snp in genome.snps:
+for snp in genome.values():
+    num += 1
+assert(num == len(genome))
+""",
+
+    "iterate items":
+r"""
+num = 0
+for rsid, snp in genome.items():
     num += 1
 assert(num == len(genome))
 """,
 }
 
+def rss():
+    """Resident set size of this process in bytes, or None if unknown."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        return None
+
+def loaded_rss(filename, **kw):
+    """Growth of RSS in bytes from loading a genome in a fresh process, where
+    memory freed while loading is not mixed up with earlier allocations."""
+    code = ("import arv, sys; sys.path.insert(0, %r); import test_benchmark; "
+            "before = test_benchmark.rss(); genome = arv.load(%r, **%r); "
+            "print(test_benchmark.rss() - before)" % (
+                os.path.dirname(os.path.abspath(__file__)), filename, kw))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    return int(subprocess.check_output([sys.executable, "-c", code],
+        env=env))
+
 def log(msg, stream=sys.stdout):
     stream.write(msg)
     stream.flush()
@@ -103,12 +141,13 @@ def all_benchmarks(filename, times):
 
     results = {}
     genome = arv.load(filename)
+    rsids = list(genome.keys())
 
     for name, code in sorted(benchmarks.items()):
         log("Benchmarking %s x %d ... " % (repr(name), times))
         try:
             results[name] = benchmark(times, code, filename=filename,
-                    genome=genome, random=random)
+                    genome=genome, random=random, rsids=rsids)
         except Exception as e:
             log(str(e))
         finally:
@@ -119,26 +158,158 @@ def all_benchmarks(filename, times):
 
     return results
 
+def benchmark_settings():
+    """Returns the genome filename and number of runs to benchmark with, from
+    the environment."""
+    filename = os.getenv("ARV_BENCHMARK")
+    try:
+        times = int(os.getenv("ARV_BENCHMARK_COUNT", "40"))
+    except ValueError:
+        times = 40
+    return filename, times
+
+@unittest.skipUnless(os.getenv("ARV_BENCHMARK", None) is not None,
+    "Specify ARV_BENCHMARK=<genome filename> to benchmark")
 class BenchmarkTests(unittest.TestCase):
-    @unittest.skipUnless(os.getenv("ARV_BENCHMARK", None) is not None,
-        "Specify ARV_BENCHMARK=<genome filename> to benchmark")
+    def setUp(self):
+        self.filename, self.times = benchmark_settings()
+        self.assertTrue(os.path.isfile(self.filename),
+                "File not found: %s" % self.filename)
+
     def test_parser_speed(self):
-        filename = os.getenv("ARV_BENCHMARK")
-        self.assertTrue(os.path.isfile(filename),
-                "File not found: %s" % filename)
-        try:
-            times = int(os.getenv("ARV_BENCHMARK_COUNT", "40"))
-        except:
-            times = 40
         code = benchmarks["parsing"]
-        seconds = benchmark(times, code, filename=filename, stream=sys.stderr,
-                prefix="  ")
-        genome = arv.load(filename)
+        seconds = benchmark(self.times, code, filename=self.filename,
+                stream=sys.stderr, prefix="  ")
+        genome = arv.load(self.filename)
         sys.stderr.flush()
         sys.stderr.write(" %d SNPs in ~%dms or %.1g SNPs/second ... " % (
                 len(genome), int(round(seconds, 3)*1000), len(genome)/seconds))
         sys.stderr.flush()
 
+    def test_threaded_parser_speed(self):
+        single = benchmark(self.times, benchmarks["parsing"],
+                filename=self.filename, stream=sys.stderr, prefix="  ")
+        threaded = benchmark(self.times, benchmarks["parsing (4 threads)"],
+                filename=self.filename, stream=sys.stderr, prefix="  ")
+        sys.stderr.flush()
+        sys.stderr.write(" ~%dms with 4 threads versus ~%dms with one, "
+                "%.2fx speedup ... " % (int(round(threaded, 3)*1000),
+                    int(round(single, 3)*1000), single/threaded))
+        sys.stderr.flush()
+
+    def test_gzip_parser_speed(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            compressed = os.path.join(tmpdir, "genome.txt.gz")
+            with open(self.filename, "rb") as src:
+                with gzip.open(compressed, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+            seconds = benchmark(self.times, benchmarks["parsing"],
+                    filename=compressed, stream=sys.stderr, prefix="  ")
+            genome = arv.load(compressed)
+        finally:
+            shutil.rmtree(tmpdir)
+        sys.stderr.flush()
+        sys.stderr.write(" ~%dms, %.1f MB/s uncompressed or %.1g SNPs/second "
+                "... " % (int(round(seconds, 3)*1000),
+                    os.path.getsize(self.filename)/seconds/1e6,
+                    len(genome)/seconds))
+        sys.stderr.flush()
+
+    def test_scanner_speed(self):
+        import _arv
+
+        count = len(arv.load(self.filename))
+        original = _arv._scanner()
+        results = {}
+        sys.stderr.write("\n")
+        try:
+            for scanner in _arv._scanners():
+                _arv._scanner(scanner)
+                results[scanner] = benchmark(self.times, benchmarks["parsing"],
+                        filename=self.filename, stream=sys.stderr, prefix="  ")
+                sys.stderr.write(" %s: %.2g SNPs/second, %.2fx scalar\n" % (
+                    scanner, count/results[scanner],
+                    results["scalar"]/results[scanner]))
+        finally:
+            _arv._scanner(original)
+        sys.stderr.flush()
+
+    def test_validating_parser_speed(self):
+        normal = benchmark(self.times, benchmarks["parsing"],
+                filename=self.filename, stream=sys.stderr, prefix="  ")
+        validating = benchmark(self.times, benchmarks["parsing (validating)"],
+                filename=self.filename, stream=sys.stderr, prefix="  ")
+        report = arv.load(self.filename, validate=True).parse_report
+        sys.stderr.flush()
+        sys.stderr.write(" ~%dms validating versus ~%dms normally, %.1f%% "
+                "slower, %d of %d lines invalid ... " % (
+                    int(round(validating, 3)*1000), int(round(normal, 3)*1000),
+                    100*(validating/normal - 1),
+                    sum(report["errors"].values()), report["lines"]))
+        sys.stderr.flush()
+
+    def test_sharded_speed(self):
+        full = benchmark(self.times, benchmarks["parsing"],
+                filename=self.filename, stream=sys.stderr, prefix="  ")
+        sharded = benchmark(self.times, benchmarks["y-chromosome (sharded)"],
+                filename=self.filename, stream=sys.stderr, prefix="  ")
+        sys.stderr.flush()
+        sys.stderr.write(" ~%.1fms to load sharded and check the "
+                "Y-chromosome versus ~%dms to parse it all, %.1fx faster ... "
+                % (sharded*1000, int(round(full, 3)*1000), full/sharded))
+        sys.stderr.flush()
+
+    def test_iter_file_speed(self):
+        loading = benchmark(self.times, benchmarks["parsing"],
+                filename=self.filename, stream=sys.stderr, prefix="  ")
+        batches = benchmark(self.times, benchmarks["iterate file in batches"],
+                filename=self.filename, stream=sys.stderr, prefix="  ")
+        count = sum(len(batch["rsid"]) for batch in
+                arv.iter_file_batches(self.filename))
+        sys.stderr.flush()
+        sys.stderr.write(" ~%dms to iterate in batches versus ~%dms to load, "
+                "%.2g SNPs/second ... " % (int(round(batches, 3)*1000),
+                    int(round(loading, 3)*1000), count/batches))
+        sys.stderr.flush()
+
+    def test_iteration_speed(self):
+        genome = arv.load(self.filename)
+        sys.stderr.write("\n")
+        for name in ("iterate rsids", "iterate snps", "iterate items"):
+            seconds = benchmark(self.times, benchmarks[name], genome=genome,
+                    stream=sys.stderr, prefix="  ")
+            sys.stderr.write(" %s: ~%dms, %.2g per second\n" % (name,
+                int(round(seconds, 3)*1000), len(genome)/seconds))
+        sys.stderr.flush()
+
+    def test_storage_speed(self):
+
+        genome = arv.load(self.filename)
+        rsids = [int(key[2:]) if key.startswith("rs") else -int(key[1:])
+                 for key in genome.keys()]
+        random.seed(0)
+        keys = [random.choice(rsids) for n in range(100000)]
+        del genome, rsids
+
+        code = r"""
+for key in keys:
+    key in genome
+"""
+        sys.stderr.write("\n")
+        for storage in ("hash", "sorted", "eytzinger", "compressed"):
+            genome = arv.load(self.filename, storage=storage)
+            seconds = benchmark(self.times, code, keys=keys, genome=genome,
+                    stream=sys.stderr, prefix="  ")
+            sys.stderr.write(" %s: ~%dns per lookup, %.1f bytes per SNP" % (
+                storage, int(seconds/len(keys)*1e9),
+                float(genome.memory_usage())/len(genome)))
+            if rss() is not None:
+                sys.stderr.write(", RSS +%.1f MB" % (loaded_rss(self.filename,
+                    storage=storage)/1e6))
+            sys.stderr.write("\n")
+            del genome
+        sys.stderr.flush()
 
 if __name__ == "__main__":
     p = argparse.ArgumentParser()
@@ -0,0 +1,163 @@
+"""
+Cache tests for arv.
+
+arv
+Copyright 2017 Christian Stigen Larsen
+Distributed under the GNU GPL v3 or later; see COPYING.
+"""
+
+import arv
+import arv.cache
+import os
+import shutil
+import tempfile
+import unittest
+
+class ArvCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        arv.cache.reset_stats()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _entries(self):
+        return [name for name in os.listdir(self.cache_dir) if
+                name.endswith(arv.cache.SUFFIX)]
+
+    def test_miss_then_hit(self):
+        filename = "tests/fake_genome.txt"
+        first = arv.load(filename, cache_dir=self.cache_dir)
+        self.assertTrue(first.read_only)
+        self.assertEqual(first.storage, "sorted")
+        self.assertEqual(arv.cache.stats()["misses"], 1)
+        self.assertEqual(arv.cache.stats()["stores"], 1)
+        self.assertEqual(len(self._entries()), 1)
+
+        second = arv.load(filename, cache_dir=self.cache_dir,
+                ethnicity="european", orientation=-1)
+        self.assertTrue(second.read_only)
+        self.assertEqual(arv.cache.stats()["hits"], 1)
+        self.assertEqual(arv.cache.stats()["misses"], 1)
+
+        self.assertEqual(second.name, filename)
+        self.assertEqual(second.ethnicity, "european")
+        self.assertEqual(second.orientation, -1)
+        self.assertEqual(second.y_chromosome, first.y_chromosome)
+        self.assertEqual(len(second), len(first))
+        for rsid, snp in first.items():
+            self.assertEqual(second[rsid], snp)
+
+        self.assertEqual(second.storage, "sorted")
+        third = arv.load(filename, cache_dir=self.cache_dir,
+                storage="eytzinger")
+        self.assertEqual(third.storage, "eytzinger")
+        self.assertEqual(len(third), len(first))
+
+    def test_key(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "genome.txt")
+            shutil.copy("tests/fake_genome.txt", filename)
+            os.utime(filename, (1500000000, 1500000000))
+            key = arv.cache.cache_key(filename)
+            checked = arv.cache.cache_key(filename, checksum=True)
+            self.assertEqual(key, arv.cache.cache_key(filename))
+            self.assertNotEqual(key, checked)
+
+            # Same size and modification time, but another inode
+            copy = os.path.join(tmpdir, "copy.txt")
+            shutil.copy2(filename, copy)
+            self.assertNotEqual(key, arv.cache.cache_key(copy))
+
+            # Rewritten in place with the same size and modification time,
+            # which only the checksum notices
+            with open(filename, "r+b") as f:
+                f.seek(f.read().index(b"rs4477212"))
+                f.write(b"i12")
+            os.utime(filename, (1500000000, 1500000000))
+            self.assertEqual(key, arv.cache.cache_key(filename))
+            self.assertNotEqual(checked, arv.cache.cache_key(filename,
+                checksum=True))
+
+            arv.load(filename, cache_dir=self.cache_dir)
+            genome = arv.cache.load(filename, self.cache_dir, checksum=True)
+            self.assertIn("i12477212", genome)
+            self.assertEqual(arv.cache.stats()["misses"], 2)
+            genome = arv.cache.load(filename, self.cache_dir, checksum=True)
+            self.assertIn("i12477212", genome)
+            self.assertEqual(arv.cache.stats()["hits"], 1)
+
+            shutil.copy("tests/fake_genome.txt", filename)
+            arv.cache.reset_stats()
+            key = arv.cache.cache_key(filename)
+
+            with open(filename, "ab") as f:
+                f.write(b"rs123\t1\t123\tAA\r\n")
+            self.assertNotEqual(key, arv.cache.cache_key(filename))
+
+            genome = arv.load(filename, cache_dir=self.cache_dir)
+            self.assertEqual(genome["rs123"], "AA")
+            genome = arv.load(filename, cache_dir=self.cache_dir)
+            self.assertEqual(genome["rs123"], "AA")
+            self.assertEqual(arv.cache.stats()["hits"], 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_corrupt_entry(self):
+        filename = "tests/fake_genome.txt"
+        arv.load(filename, cache_dir=self.cache_dir)
+        path = arv.cache.entry_path(self.cache_dir, filename)
+        with open(path, "wb") as f:
+            f.write(b"garbage")
+
+        genome = arv.load(filename, cache_dir=self.cache_dir)
+        self.assertEqual(len(genome), 25)
+        self.assertEqual(arv.cache.stats()["misses"], 2)
+
+        arv.load(filename, cache_dir=self.cache_dir)
+        self.assertEqual(arv.cache.stats()["hits"], 1)
+
+    def test_eviction(self):
+        arv.load("tests/fake_genome.txt", cache_dir=self.cache_dir)
+        arv.load("tests/fake_genome_female.txt", cache_dir=self.cache_dir)
+        self.assertEqual(len(self._entries()), 2)
+
+        # Make the first entry the most recently used one
+        os.utime(arv.cache.entry_path(self.cache_dir,
+            "tests/fake_genome_female.txt"), (0, 0))
+        arv.load("tests/fake_genome.txt", cache_dir=self.cache_dir)
+
+        size = os.path.getsize(arv.cache.entry_path(self.cache_dir,
+            "tests/fake_genome.txt"))
+        self.assertEqual(arv.cache.evict(self.cache_dir, size), 1)
+        self.assertEqual(arv.cache.stats()["evictions"], 1)
+        self.assertTrue(os.path.isfile(arv.cache.entry_path(self.cache_dir,
+            "tests/fake_genome.txt")))
+        self.assertEqual(len(self._entries()), 1)
+
+        self.assertEqual(arv.cache.evict(self.cache_dir, 0), 1)
+        self.assertEqual(self._entries(), [])
+
+    def test_environment(self):
+        os.environ["ARV_CACHE_DIR"] = self.cache_dir
+        try:
+            arv.load("tests/fake_genome.txt")
+            arv.load("tests/fake_genome.txt")
+            self.assertEqual(arv.cache.stats()["hits"], 1)
+
+            # Explicitly disabled
+            self.assertFalse(arv.load("tests/fake_genome.txt",
+                cache_dir="").read_only)
+            self.assertEqual(arv.cache.stats()["hits"], 1)
+        finally:
+            del os.environ["ARV_CACHE_DIR"]
+
+    def test_unwritable_cache(self):
+        filename = os.path.join(self.cache_dir, "file")
+        with open(filename, "wb") as f:
+            f.write(b"not a directory")
+
+        genome = arv.load("tests/fake_genome.txt", cache_dir=filename)
+        self.assertEqual(len(genome), 25)
+        self.assertEqual(arv.cache.stats()["store_errors"], 1)
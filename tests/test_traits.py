@@ -7,7 +7,9 @@ Distributed under the GNU GPL v3 or later; see COPYING.
 """
 
 import arv
+import arv.rules
 import arv.traits
+import arv.util
 import unittest
 
 class ArvTraitsTest(unittest.TestCase):
@@ -19,3 +21,91 @@ class ArvTraitsTest(unittest.TestCase):
         self.assertEqual(self.genome["rs671"], "GG")
         self.assertEqual(arv.traits.alcohol_flush_reaction(self.genome),
                 "Little to no reaction (two copies of the ALDH2 gene)")
+
+class ArvRulesTest(unittest.TestCase):
+    def _genomes(self):
+        """Yields genomes with many genotypes for the RSIDs in traits."""
+        genotypes = ["AA", "AG", "GA", "GG", "CC", "CT", "TC", "TT", "AC", "CA",
+                "CG", "GC", "DD", "DI", "ID", "II", "A", "T", "--"]
+        rules = [f for f in arv.traits._traits_report.functions if
+                isinstance(f, arv.rules.Rule)]
+        rsids = [rule.rsid for rule in rules] + ["rs174575", "rs1535",
+                "rs1851665", "rs7193788", "rs6444175", "rs10936599",
+                "rs7903146", "rs1799884"]
+
+        for offset in range(len(genotypes)):
+            lines = []
+            for n, rsid in enumerate(rsids):
+                if (n + offset) % 7 == 0:
+                    continue # missing
+                genotype = genotypes[(n + offset) % len(genotypes)]
+                lines.append("%s\t1\t%d\t%s\n" % (rsid, n + 1, genotype))
+            for ethnicity in ("", "european", "asian"):
+                yield arv.loads("".join(lines).encode("ascii"),
+                        ethnicity=ethnicity)
+
+    def test_report_matches_functions(self):
+        report = arv.traits._traits_report
+        for genome in self._genomes():
+            for verbose in (False, True):
+                self.assertEqual(report(genome, verbose),
+                        arv.util.make_report(genome, report.functions,
+                            verbose))
+
+    def test_genotype_code(self):
+        genome = arv.load("tests/fake_genome.txt")
+        for _, snp in genome.items():
+            self.assertEqual(arv.rules.genotype_code(str(snp.genotype)),
+                    snp.genotype.code)
+        self.assertIsNone(arv.rules.genotype_code("A-"))
+        self.assertIsNone(arv.rules.genotype_code("XY"))
+        self.assertIsNone(arv.rules.genotype_code("AAA"))
+
+    def test_rule_set(self):
+        genome = arv.loads(b"rs1\t1\t1\tAG\nrs2\t1\t2\tGA\nrs3\t1\t3\tCC\n")
+        rules = arv.rules.compile_rules([
+            arv.rules.Rule("One", "rs1", {"GA": 1, "AG": 2}),
+            arv.rules.Rule("Two", "rs2", {"AG": 3}),
+            arv.rules.Rule("Three", "rs3", {"AG": 3}),
+            arv.rules.Rule("Four", "rs3", {"AG": 3, None: 4.0}),
+            arv.rules.Rule("Five", "rs4", {"AG": 3, None: 4}),
+        ])
+        self.assertEqual(len(rules), 5)
+        self.assertEqual(rules.evaluate(genome), [2, 3, None, 4.0, None])
+        self.assertIsInstance(rules.evaluate(genome)[3], float)
+
+class ArvTraitsReportManyTest(unittest.TestCase):
+    def test_traits_report_many(self):
+        genome = arv.load("tests/fake_genome.txt")
+        filenames = ["tests/fake_genome.txt",
+                "tests/fake_genome_female.txt"] * 3
+        expected = dict((filename, arv.traits.traits_report(
+            arv.load(filename, ethnicity="european"))) for filename in
+            set(filenames))
+
+        results = list(arv.traits.traits_report_many(filenames + [genome],
+            workers=2, window=3, ethnicity="european"))
+        self.assertEqual(len(results), len(filenames) + 1)
+
+        for item, report in results:
+            if item is genome:
+                self.assertEqual(report, arv.traits.traits_report(genome))
+            else:
+                self.assertEqual(report, expected[item])
+
+        self.assertEqual(sorted(item for item, _ in results if item is not
+            genome), sorted(filenames))
+
+    def test_traits_report_many_errors(self):
+        filenames = ["tests/fake_genome.txt", "non-existing-file"]
+
+        with self.assertRaises(RuntimeError):
+            list(arv.traits.traits_report_many(filenames, workers=1))
+
+        results = dict(arv.traits.traits_report_many(filenames, workers=1,
+            return_exceptions=True))
+        self.assertIsInstance(results["non-existing-file"], RuntimeError)
+        self.assertIsInstance(results["tests/fake_genome.txt"], dict)
+
+        with self.assertRaises(ValueError):
+            list(arv.traits.traits_report_many(filenames, window=0))